@@ -1,11 +1,14 @@
 
 from celery.task import periodic_task
 from celery.schedules import crontab
-from flows.statestore.django_store import StateModel
+from flows.statestore import state_store
 
 
 @periodic_task(run_every=crontab(minute='*/5', hour='*'))
 def cleanup_expired_tasks():
-    count = StateModel.objects.remove_expired_state()
+    if not hasattr(state_store, 'remove_expired_state'):
+        # the configured state store removes expired state itself
+        return
+    count = state_store.remove_expired_state()
     logger = cleanup_expired_tasks.get_logger()
     logger.info("Deleted %s expired tasks' state" % count)
\ No newline at end of file
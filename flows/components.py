@@ -4,7 +4,6 @@ from django.forms.forms import Form
 from django.core.exceptions import ImproperlyConfigured
 from django import forms
 import inspect
-from flows import config
 from django.shortcuts import redirect
 from django.utils.safestring import mark_safe
 
@@ -79,6 +78,22 @@ class FlowComponent(object):
     should not be shown to the user again once clicking 'back'.
     """
 
+    loaders = {}
+    """
+    Loaders fetch objects the component needs before `prepare` is called,
+    and are given as a dict of attribute name to loader. The objects needed
+    by all of the components handling a request are fetched together, and
+    set as those attributes. See the `flows.loaders` module.
+    """
+
+    idle_timeout = None
+    """
+    How many seconds a task can be left unused before it expires, for
+    flows entered through this component. If this is not set, the
+    `idle_timeout` of the `FlowHandler` is used, and then the
+    FLOWS_TASK_IDLE_TIMEOUT setting.
+    """
+
 
     def set_url_args(self, *args, **kwargs):
         """
@@ -123,6 +138,15 @@ class FlowComponent(object):
         """
         return response
     
+    def handle_conflict(self, request):
+        """
+        Called on the action when the task state could not be saved because
+        another request, such as a second submission of the same form,
+        changed it since this request loaded it. The default is to send the
+        user back to the same page, which will show the current state.
+        """
+        return redirect(self._flow_position_instance.get_absolute_url())
+    
     def get_url_args(self):
         """
         When constructing a URL, flow components may need to provide some
@@ -246,8 +270,9 @@ class FlowRenderer(object):
         return self.flow_component.get_absolute_url()
 
     def flow_support(self):
-        field = "<input type='hidden' name='%s' value='%s'/>" % (config.FLOWS_TASK_ID_PARAM, self.flow_component.task_id)
-        return mark_safe(field)
+        fields = self.flow_component._flow_position_instance.get_task_fields()
+        html = ''.join("<input type='hidden' name='%s' value='%s'/>" % field for field in fields)
+        return mark_safe(html)
     
 
 class DefaultActionForm(Form):
@@ -275,7 +300,10 @@ class Action(FlowComponent, FormView):
     
     def get_context_data(self, **kwargs):
         ctx = FormView.get_context_data(self, **kwargs)
-        ctx.update(self.state)
+        # templates only read the state, so this doesn't need to count
+        # as handing out values which could be changed
+        for key in self.state:
+            ctx[key] = self.state.peek(key)
         ctx['flows_back_url'] = self._flow_position_instance.get_back_url()
         ctx['flow'] = FlowRenderer(self)
         return ctx
@@ -289,9 +317,8 @@ class Action(FlowComponent, FormView):
     
     def get_form(self, form_class):
         form = FormView.get_form(self, form_class)
-        form.fields[config.FLOWS_TASK_ID_PARAM] = forms.CharField(widget=forms.HiddenInput, 
-                                                                  initial=self.task_id,
-                                                                  required=False)
+        for name, value in self._flow_position_instance.get_task_fields():
+            form.fields[name] = forms.CharField(widget=forms.HiddenInput, initial=value, required=False)
         if '_with_errors' in self.state:
             errors = self.state.pop('_with_errors')
             form.full_clean()
@@ -1,6 +1,8 @@
 # -*- coding: UTF-8 -*-
 
 from django.conf import settings
+import os
+import tempfile
 
 def _get_setting(name, default):
     return getattr( settings, name, default )
@@ -11,12 +13,73 @@ FLOWS_STATE_STORE = _get_setting('FLOWS_STATE_STORE', 'flows.statestore.django_s
 FLOWS_TASK_IDLE_TIMEOUT = _get_setting('FLOWS_TASK_IDLE_TIMEOUT', 20 * 60) # 20 minutes
 FLOWS_TASK_ID_PARAM = _get_setting('FLOWS_TASK_ID_PARAM', '_id')
 FLOWS_SITE_ROOT = _get_setting('FLOWS_SITE_ROOT', '')
+FLOWS_TASK_LEASE_TIMEOUT = _get_setting('FLOWS_TASK_LEASE_TIMEOUT', None) # seconds, None to disable
+FLOWS_TASK_LEASE_MAX_WAIT = _get_setting('FLOWS_TASK_LEASE_MAX_WAIT', 5) # seconds
+FLOWS_LAZY_TASKS = _get_setting('FLOWS_LAZY_TASKS', False)
+FLOWS_TASK_CREATION_LIMIT = _get_setting('FLOWS_TASK_CREATION_LIMIT', None) # tasks per binder value, None to disable
+FLOWS_TASK_CREATION_PERIOD = _get_setting('FLOWS_TASK_CREATION_PERIOD', 60) # seconds
+FLOWS_MAX_TASKS_PER_BINDER = _get_setting('FLOWS_MAX_TASKS_PER_BINDER', None) # None to disable
+FLOWS_DELETE_TASKS_ON_LOGOUT = _get_setting('FLOWS_DELETE_TASKS_ON_LOGOUT', False)
+
+# State serialisation settings
+FLOWS_STATE_CODEC = _get_setting('FLOWS_STATE_CODEC', 'pickle')
+FLOWS_STATE_COMPRESS_THRESHOLD = _get_setting('FLOWS_STATE_COMPRESS_THRESHOLD', 1024) # bytes, None to disable
+FLOWS_STATE_COMPRESS_LEVEL = _get_setting('FLOWS_STATE_COMPRESS_LEVEL', 6)
+FLOWS_STATE_LAZY_DECODE = _get_setting('FLOWS_STATE_LAZY_DECODE', False)
+FLOWS_STATE_MODEL_REFERENCES = _get_setting('FLOWS_STATE_MODEL_REFERENCES', False)
+
+# Django state store settings
+FLOWS_DJANGO_STATE_STORE_TOUCH_INTERVAL = _get_setting('FLOWS_DJANGO_STATE_STORE_TOUCH_INTERVAL', 60) # seconds
+FLOWS_DJANGO_STATE_STORE_BATCH_TOUCHES = _get_setting('FLOWS_DJANGO_STATE_STORE_BATCH_TOUCHES', False)
+FLOWS_DJANGO_STATE_STORE_PER_KEY = _get_setting('FLOWS_DJANGO_STATE_STORE_PER_KEY', False)
+FLOWS_DJANGO_STATE_STORE_CLEANUP_CHUNK_SIZE = _get_setting('FLOWS_DJANGO_STATE_STORE_CLEANUP_CHUNK_SIZE', 1000)
+FLOWS_DJANGO_STATE_STORE_CLEANUP_MAX_ROWS = _get_setting('FLOWS_DJANGO_STATE_STORE_CLEANUP_MAX_ROWS', None)
+FLOWS_DJANGO_STATE_STORE_CLEANUP_MAX_SECONDS = _get_setting('FLOWS_DJANGO_STATE_STORE_CLEANUP_MAX_SECONDS', 60)
 
 # Redis state store settings
 FLOWS_REDIS_STATE_STORE_HOST = _get_setting( 'FLOWS_REDIS_STATE_STORE_HOST', 'localhost' )
 FLOWS_REDIS_STATE_STORE_PASSWORD = _get_setting( 'FLOWS_REDIS_STATE_STORE_PASSWORD', '' )
 FLOWS_REDIS_STATE_STORE_PORT = _get_setting( 'FLOWS_REDIS_STATE_STORE_PORT', 6379)
 FLOWS_REDIS_STATE_STORE_DB = _get_setting( 'FLOWS_REDIS_STATE_STORE_DB', 0 )
+FLOWS_REDIS_STATE_STORE_MAX_CONNECTIONS = _get_setting( 'FLOWS_REDIS_STATE_STORE_MAX_CONNECTIONS', None )
+FLOWS_REDIS_STATE_STORE_SOCKET_TIMEOUT = _get_setting( 'FLOWS_REDIS_STATE_STORE_SOCKET_TIMEOUT', None )
+FLOWS_REDIS_STATE_STORE_SOCKET_CONNECT_TIMEOUT = _get_setting( 'FLOWS_REDIS_STATE_STORE_SOCKET_CONNECT_TIMEOUT', None )
+FLOWS_REDIS_STATE_STORE_PER_KEY = _get_setting( 'FLOWS_REDIS_STATE_STORE_PER_KEY', False )
+FLOWS_REDIS_STATE_STORE_NODES = _get_setting( 'FLOWS_REDIS_STATE_STORE_NODES', [] )
+FLOWS_REDIS_STATE_STORE_VIRTUAL_NODES = _get_setting( 'FLOWS_REDIS_STATE_STORE_VIRTUAL_NODES', 160 )
+
+# SQLite state store settings
+FLOWS_SQLITE_STATE_STORE_PATH = _get_setting( 'FLOWS_SQLITE_STATE_STORE_PATH', os.path.join(tempfile.gettempdir(), 'flows-state.sqlite3') )
+FLOWS_SQLITE_STATE_STORE_TIMEOUT = _get_setting( 'FLOWS_SQLITE_STATE_STORE_TIMEOUT', 5 ) # seconds
+FLOWS_SQLITE_STATE_STORE_TOUCH_INTERVAL = _get_setting( 'FLOWS_SQLITE_STATE_STORE_TOUCH_INTERVAL', 60 ) # seconds
+FLOWS_SQLITE_STATE_STORE_CLEANUP_INTERVAL = _get_setting( 'FLOWS_SQLITE_STATE_STORE_CLEANUP_INTERVAL', 5 * 60 ) # seconds
+
+# Temporary file state store settings
+FLOWS_TMPFILE_STATE_STORE_ROOT = _get_setting( 'FLOWS_TMPFILE_STATE_STORE_ROOT', os.path.join(tempfile.gettempdir(), 'flows-state') )
+FLOWS_TMPFILE_STATE_STORE_TOUCH_INTERVAL = _get_setting( 'FLOWS_TMPFILE_STATE_STORE_TOUCH_INTERVAL', 60 ) # seconds
+
+# Cache state store settings
+FLOWS_CACHE_STATE_STORE_ALIAS = _get_setting( 'FLOWS_CACHE_STATE_STORE_ALIAS', 'default' )
+FLOWS_CACHE_STATE_STORE_KEY_PREFIX = _get_setting( 'FLOWS_CACHE_STATE_STORE_KEY_PREFIX', 'flows-state:' )
+FLOWS_CACHE_STATE_STORE_TOUCH_INTERVAL = _get_setting( 'FLOWS_CACHE_STATE_STORE_TOUCH_INTERVAL', 60 ) # seconds
+
+# Signed state store settings
+FLOWS_SIGNED_STATE_STORE_FALLBACK = _get_setting( 'FLOWS_SIGNED_STATE_STORE_FALLBACK', 'flows.statestore.django_store' )
+FLOWS_SIGNED_STATE_STORE_MAX_SIZE = _get_setting( 'FLOWS_SIGNED_STATE_STORE_MAX_SIZE', 1024 ) # characters
+FLOWS_SIGNED_STATE_STORE_COOKIE = _get_setting( 'FLOWS_SIGNED_STATE_STORE_COOKIE', False )
+FLOWS_SIGNED_STATE_STORE_COOKIE_PREFIX = _get_setting( 'FLOWS_SIGNED_STATE_STORE_COOKIE_PREFIX', 'flows_' )
+FLOWS_SIGNED_STATE_STORE_ENCRYPT = _get_setting( 'FLOWS_SIGNED_STATE_STORE_ENCRYPT', False )
+
+# Memory state store settings
+FLOWS_MEMORY_STATE_STORE_MAX_ENTRIES = _get_setting( 'FLOWS_MEMORY_STATE_STORE_MAX_ENTRIES', 10000 )
+FLOWS_MEMORY_STATE_STORE_MAX_BYTES = _get_setting( 'FLOWS_MEMORY_STATE_STORE_MAX_BYTES', None )
+
+# Cached state store settings
+FLOWS_CACHED_STATE_STORE_BACKEND = _get_setting( 'FLOWS_CACHED_STATE_STORE_BACKEND', 'flows.statestore.django_store' )
+FLOWS_CACHED_STATE_STORE_MAX_ENTRIES = _get_setting( 'FLOWS_CACHED_STATE_STORE_MAX_ENTRIES', 1000 )
+FLOWS_CACHED_STATE_STORE_TTL = _get_setting( 'FLOWS_CACHED_STATE_STORE_TTL', 30 ) # seconds
+FLOWS_CACHED_STATE_STORE_CHANNEL = _get_setting( 'FLOWS_CACHED_STATE_STORE_CHANNEL', 'flows.statestore.cached_store.LocalChannel' )
+FLOWS_CACHED_STATE_STORE_CHANNEL_NAME = _get_setting( 'FLOWS_CACHED_STATE_STORE_CHANNEL_NAME', 'flows-state-invalidation' )
 
 
 # Task ID binder
@@ -1,20 +1,27 @@
 # -*- coding: UTF-8 -*-
 from weakref import WeakSet
 from django.conf.urls import patterns, url, include
+from django.core import signing
 from django.core.exceptions import ImproperlyConfigured
 from django.core.urlresolvers import reverse
 from django.http import HttpResponseRedirect, Http404, HttpResponse
 from django.shortcuts import redirect
 from django.conf import settings
+from django.utils import baseconv
 from flows import config
 from flows.components import Scaffold, Action, name_for_flow, COMPLETE, \
     get_by_class_or_name
 from flows.history import FlowHistory
+from flows.loaders import get_request_loader
 from flows.statestore import state_store as default_state_store
-from flows.statestore.base import StateNotFound
+from flows.statestore import serialisation
+from flows.statestore.base import StateNotFound, StateConflict
+from flows.statestore.tracking import TrackedState
+import hashlib
 import inspect
 import logging
 import re
+import time
 import uuid
 from flows.binder import binder
 import urlparse
@@ -23,6 +30,15 @@ import urllib
 
 logger = logging.getLogger(__name__)
 
+# how often a duplicate submission checks whether the first one is done
+_LEASE_POLL_INTERVAL = 0.05 # seconds
+
+# new tasks which have not been stored yet carry their state in URLs as a
+# signed token in this parameter, see FLOWS_LAZY_TASKS
+_NEW_TASK_PARAM = '_new'
+_NEW_TASK_SALT = 'flows.handler.new_task'
+_NEW_TASK_CODEC = 'json'
+
 try:
     import pydot
     has_pydot = True
@@ -31,6 +47,85 @@ except ImportError:
     
 
 
+class TooManyTasks(Exception):
+    """
+    Raised when a binder value has created more tasks than
+    FLOWS_TASK_CREATION_LIMIT allows in the current period.
+    """
+    pass
+
+
+def _count_new_task(state_store, bound_to):
+    limit = config.FLOWS_TASK_CREATION_LIMIT
+    if limit is None:
+        return
+    count = state_store.count_created(bound_to, config.FLOWS_TASK_CREATION_PERIOD)
+    if count is None:
+        raise ImproperlyConfigured('FLOWS_TASK_CREATION_LIMIT needs a state store which counts created tasks')
+    if count > limit:
+        logger.info('Refusing to create a task for %s, which created %d recently' % (bound_to, count - 1))
+        raise TooManyTasks
+
+
+def _limit_binder_tasks(state_store, bound_to, task_id):
+    """
+    Deletes the oldest tasks bound to the same value as a new task, so that
+    there are no more than FLOWS_MAX_TASKS_PER_BINDER including it.
+    """
+    max_tasks = config.FLOWS_MAX_TASKS_PER_BINDER
+    if max_tasks is None:
+        return
+    task_ids = state_store.get_binder_tasks(bound_to)
+    if task_ids is None:
+        raise ImproperlyConfigured('FLOWS_MAX_TASKS_PER_BINDER needs a state store which indexes tasks by binder value')
+    # the new task may not have been written yet if writes are batched
+    older = [other for other in task_ids if other != task_id]
+    for old_task_id in older[:max(0, len(older) - max_tasks + 1)]:
+        logger.debug('Removing task %s, as %s has too many' % (old_task_id, bound_to))
+        state_store.delete_state(old_task_id)
+
+
+def _new_task_signer(bound_to):
+    # tokens are only valid for the binder value they were made for
+    return signing.TimestampSigner(salt='%s:%s' % (_NEW_TASK_SALT, bound_to))
+
+
+def _sign_new_task(state):
+    # tokens can be read by anyone who sees them, so the binder value, which
+    # is usually the session key, is left out
+    state = dict(state)
+    bound_to = state.pop('_bound_to', None)
+    data = serialisation.encode(state, serialisation.get_codec(_NEW_TASK_CODEC))
+    return _new_task_signer(bound_to).sign(signing.b64_encode(data))
+
+
+def _unsign_new_task(token, bound_to):
+    """
+    Returns the state of a new task from its token, or None if the token is
+    not valid for the binder value, or is older than the idle timeout of
+    the task.
+    """
+    signer = _new_task_signer(bound_to)
+    try:
+        # the age can only be checked once the state, which holds the idle
+        # timeout, has been decoded
+        value, timestamp = signing.Signer.unsign(signer, token).rsplit(':', 1)
+        found = []
+        data = serialisation.decode(signing.b64_decode(value.encode('ascii')), found,
+                                    codec=serialisation.get_codec(_NEW_TASK_CODEC))
+        data['_bound_to'] = bound_to
+        state = TrackedState(data, found_references=found)
+        timeout = state.peek('_idle_timeout')
+        if timeout is None:
+            timeout = config.FLOWS_TASK_IDLE_TIMEOUT
+        if time.time() - baseconv.base62.decode(timestamp) > timeout:
+            return None
+    except (signing.BadSignature, TypeError, ValueError):
+        return None
+    return state
+
+
+
 class FlowHandlerBase(object):
     registry = WeakSet()
 
@@ -70,16 +165,25 @@ class FlowHandlerBase(object):
 
 class FlowHandler(FlowHandlerBase):
 
-    def __init__(self, app_namespace=None, state_store=None, *args, **kwargs):
+    def __init__(self, app_namespace=None, state_store=None, idle_timeout=None, *args, **kwargs):
         super(FlowHandler, self).__init__(*args, **kwargs)
         self._entry_points = []
         self.app_namespace = app_namespace
         self.state_store = state_store or default_state_store
+        # the default idle timeout for tasks of flows which do not set their own
+        self.idle_timeout = idle_timeout
+        self._check_lazy_tasks()
+    
+    def _check_lazy_tasks(self):
+        # the links of a lazy task must be refused once it has been used, or
+        # a completed task could be started again from them
+        if config.FLOWS_LAZY_TASKS and not self.state_store.supports_leases:
+            raise ImproperlyConfigured('FLOWS_LAZY_TASKS needs a state store which supports leases')
         
     
     def _get_state(self, task_id):
         
-        if not re.match('^[0-9a-f]{32}$', task_id):
+        if not re.match(self.state_store.reference_pattern, task_id):
             # someone is messing with the task ID - don't even try
             # to do anything with it
             raise StateNotFound
@@ -90,54 +194,202 @@ class FlowHandler(FlowHandlerBase):
     def _view(self, position):
         
         def handle_view(request, *args, **kwargs):
-            # first get the state for this task, or create state if
-            # this is an entry point with no state
-            if config.FLOWS_TASK_ID_PARAM in request.REQUEST:
-                task_id = request.REQUEST[config.FLOWS_TASK_ID_PARAM]
-                
-                try:
-                    state = self._get_state(task_id)
-                except StateNotFound:
+            self.state_store.process_request(request)
+            response = None
+            try:
+                lease, response = self._acquire_lease(request)
+                if response is None:
+                    try:
+                        # any writes to the state store are sent together once the
+                        # request has been handled
+                        with self.state_store.batch():
+                            try:
+                                response = self._handle_request(position, request, *args, **kwargs)
+                            except TooManyTasks:
+                                response = self.too_many_tasks(request)
+                    finally:
+                        # only once the writes were sent, so that duplicates
+                        # reusing the response will see them
+                        if lease is not None:
+                            self._release_lease(lease, response)
+            finally:
+                # stores which keep state on the client add it to the response
+                response = self.state_store.process_response(request, response)
+            return response
+
+        return handle_view
+    
+    def _acquire_lease(self, request):
+        """
+        Takes the lease on the task when a form is submitted, if leases are
+        enabled, so that duplicates of the submission are not handled at
+        the same time. A duplicate waits for the lease, then reuses the
+        redirect the first one gave if there was one. Returns the lease, if
+        taken, and the response to reuse, if any.
+        """
+        timeout = config.FLOWS_TASK_LEASE_TIMEOUT
+        if timeout is None or request.method != 'POST' or config.FLOWS_TASK_ID_PARAM not in request.REQUEST:
+            return None, None
+        
+        task_id = request.REQUEST[config.FLOWS_TASK_ID_PARAM]
+        if not re.match(self.state_store.reference_pattern, task_id):
+            # the task will not be found anyway, so there is nothing to lease
+            return None, None
+        
+        if not self._may_lease(request, task_id):
+            # handling the request will refuse it, without holding up the
+            # requests of the user the task belongs to
+            return None, None
+        
+        key = self._get_submission_key(request)
+        token = uuid.uuid4().hex
+        give_up_at = time.time() + config.FLOWS_TASK_LEASE_MAX_WAIT
+        while True:
+            location = self.state_store.get_lease_result(task_id, key)
+            if location is not None:
+                logger.debug('Reusing the response to a duplicate submission for task %s' % task_id)
+                return None, HttpResponseRedirect(location)
+            taken = self.state_store.acquire_lease(task_id, token, timeout)
+            if taken is None:
+                # the state store does not support leases
+                return None, None
+            if taken:
+                return (task_id, token, key), None
+            if time.time() >= give_up_at:
+                logger.info('Gave up waiting for the lease on task %s' % task_id)
+                return None, self.duplicate_submission(request)
+            time.sleep(_LEASE_POLL_INTERVAL)
+    
+    def too_many_tasks(self, request):
+        """
+        Returns the response given when a new task is refused because its
+        binder value has created too many recently.
+        """
+        return HttpResponse('Too many tasks have been started, please try again later', status=429)
+    
+    def _may_lease(self, request, task_id):
+        """
+        Returns whether the request may take the lease on the task, which
+        it may not if the task is bound to another binder value.
+        """
+        bind_to = binder(request)
+        if bind_to is None:
+            return False
+        try:
+            state = self._get_state(task_id)
+        except StateNotFound:
+            # the task may have been completed by the submission this one
+            # duplicates, unless it has not been stored yet
+            token = request.REQUEST.get(_NEW_TASK_PARAM)
+            return token is None or _unsign_new_task(token, bind_to) is not None
+        return state.get('_bound_to') == bind_to
+    
+    def duplicate_submission(self, request):
+        """
+        Returns the response given to a submission for a task which is
+        still being handled for another one after FLOWS_TASK_LEASE_MAX_WAIT.
+        """
+        return HttpResponse('This task is busy with another request, please try again later', status=409)
+    
+    def _get_submission_key(self, request):
+        # duplicates post the same data to the same URL
+        submission = (request.get_full_path(), sorted(request.POST.lists()))
+        return hashlib.sha1(repr(submission)).hexdigest()
+    
+    def _release_lease(self, lease, response):
+        task_id, token, key = lease
+        if isinstance(response, HttpResponseRedirect):
+            self.state_store.set_lease_result(task_id, key, response['Location'], config.FLOWS_TASK_LEASE_TIMEOUT)
+        self.state_store.release_lease(task_id, token)
+    
+    def _handle_request(self, position, request, *args, **kwargs):
+        # first get the state for this task, or create state if
+        # this is an entry point with no state
+        new_task = False
+        if config.FLOWS_TASK_ID_PARAM in request.REQUEST:
+            task_id = request.REQUEST[config.FLOWS_TASK_ID_PARAM]
+            bind_to = binder(request)
+            
+            try:
+                state = self._get_state(task_id)
+            except StateNotFound:
+                # the task may not have been stored yet
+                state = self._get_new_task(task_id, request.REQUEST.get(_NEW_TASK_PARAM), bind_to)
+                if state is None:
                     logger.debug("Could not find task with ID %s" % task_id)
                     raise Http404
-                
-                bound_to = state.get('_bound_to', None)
-                bind_to = binder(request)
-                
-                if bound_to is None or bind_to is None or bind_to != bound_to:
-                    logger.debug('Will not give task %s as it is bound to %s, not %s' % (task_id, bound_to, bind_to))
-                    raise Http404
-                
+                new_task = True
+            
+            bound_to = state.get('_bound_to', None)
+            
+            if bound_to is None or bind_to is None or bind_to != bound_to:
+                logger.debug('Will not give task %s as it is bound to %s, not %s' % (task_id, bound_to, bind_to))
+                raise Http404
+            
+        else:
+            # are we at an entry point? if so, then create some new state
+            # otherwise we're trying to enter the middle of a flow, which
+            # is not allowed
+            if position.is_entry_point():
+                initial = {}
+                if '_on_complete' in request.REQUEST:
+                    initial['_on_complete'] = request.REQUEST['_on_complete']
+                state = self._new_state(request, position, **initial)
+                new_task = config.FLOWS_LAZY_TASKS
             else:
-                # are we at an entry point? if so, then create some new state
-                # otherwise we're trying to enter the middle of a flow, which
-                # is not allowed
-                if position.is_entry_point():
-                    initial = {}
-                    if '_on_complete' in request.REQUEST:
-                        initial['_on_complete'] = request.REQUEST['_on_complete']
-                    state = self._new_state(request, **initial)
-                else:
-                    logger.debug('Flow position is not an entry point: %s' % position)
-                    raise Http404
-                
-            # create the instances required to handle the request 
-            flow_instance = position.create_instance(state, self.state_store, args, kwargs)
-                
-            # deal with the request
-            return flow_instance.handle(request, *args, **kwargs)
-
-        return handle_view
+                logger.debug('Flow position is not an entry point: %s' % position)
+                raise Http404
+            
+        # create the instances required to handle the request 
+        flow_instance = position.create_instance(state, self.state_store, args, kwargs, new_task=new_task)
+            
+        # deal with the request
+        return flow_instance.handle(request, *args, **kwargs)
+    
+    def _get_idle_timeout(self, position):
+        for flow_component_class in position.flow_component_classes:
+            if flow_component_class.idle_timeout is not None:
+                return flow_component_class.idle_timeout
+        return self.idle_timeout
     
-    def _new_state(self, request, **initial_state):
+    def _get_new_task(self, task_id, token, bind_to):
+        if token is None or bind_to is None or not config.FLOWS_LAZY_TASKS:
+            return None
+        if not self.state_store.supports_leases:
+            # there would be no way to tell whether the token has been used
+            return None
+        state = _unsign_new_task(token, bind_to)
+        if state is None or state.get('_id') != task_id:
+            return None
+        if self.state_store.get_lease_result(task_id, _NEW_TASK_PARAM) is not None:
+            # the task has been stored since, and so may have been
+            # completed and deleted
+            logger.debug('Refusing the token of task %s, which has been used' % task_id)
+            return None
+        return state
+    
+    def _new_state(self, request, position, **initial_state):
         task_id = re.sub('-', '', str(uuid.uuid4()))
         bind_to = binder(request)
         if bind_to is None:
             raise ImproperlyConfigured('A value is required to bind the task to')
         
-        state = {'_id': task_id, '_bound_to': bind_to}
+        state = TrackedState({'_id': task_id, '_bound_to': bind_to})
+        # the state stores use this to expire the task, so it is only stored
+        # if the flow has its own, and otherwise follows the setting
+        idle_timeout = self._get_idle_timeout(position)
+        if idle_timeout is not None:
+            state['_idle_timeout'] = idle_timeout
         state.update( initial_state )
-        self.state_store.put_state(task_id, state)
+        # with lazy tasks, the state is only stored once there is something
+        # worth keeping, so that visitors who never use the flow cost nothing
+        if config.FLOWS_LAZY_TASKS:
+            self._check_lazy_tasks()
+        else:
+            _count_new_task(self.state_store, bind_to)
+            self.state_store.put_state(task_id, state)
+            _limit_binder_tasks(self.state_store, bind_to, task_id)
+        state.mark_saved()
         
         return state
     
@@ -257,6 +509,9 @@ class FlowHandler(FlowHandlerBase):
           state object for every pageview regardless of the user's intention. It is much
           better if the user has performed an action, such as submitted a form, which
           implies they want to immediately enter a flow. See also `url_args` and `url_kwargs`.
+          With FLOWS_LAZY_TASKS, the initial state is instead signed and carried in the URL
+          until the user changes it or submits a form, so nothing is stored for links which
+          are never followed, at the cost of a longer URL.
 
         flow_namespace : str
 
@@ -286,10 +541,11 @@ class FlowHandler(FlowHandlerBase):
         if with_state:
             if on_complete_url is not None:
                 initial_state['_on_complete'] = on_complete_url
-            state = self._new_state(request, **initial_state)
+            state = self._new_state(request, position, **initial_state)
         else:
             state = {'_id': ''}  # TODO: this is a bit of a hack, but task_id is required...
-        instance = position.create_instance(state, self.state_store, url_args=url_args, url_kwargs=url_kwargs)
+        instance = position.create_instance(state, self.state_store, url_args=url_args, url_kwargs=url_kwargs,
+                                            new_task=with_state and config.FLOWS_LAZY_TASKS)
 
         # if we have state, then we need to include the task ID in the URL
         # returned, otherwise it'll be seen as a "new entry" and new empty
@@ -352,10 +608,13 @@ class FlowPositionInstance(object):
     that is, a user is currently performing an action as part of a flow
     """
     
-    def __init__(self, app_namespace, flow_namespace, position, state, state_store, url_args, url_kwargs):
+    def __init__(self, app_namespace, flow_namespace, position, state, state_store, url_args, url_kwargs,
+                 new_task=False):
         self._app_namespace = app_namespace
         self._flow_namespace = flow_namespace
         self._position = position
+        if not isinstance(state, TrackedState):
+            state = TrackedState(state)
         self._state = state
         self._flow_components = []
         self.state_store = state_store
@@ -375,6 +634,12 @@ class FlowPositionInstance(object):
             self._flow_components.append( flow_component )
             
         self._history = FlowHistory(self)    
+        
+        # a new task which has not been stored yet is carried in the URLs
+        # given out, until the state is changed or a form is submitted
+        self._new_task = new_task
+        self._new_task_data = self._encode_new_task() if new_task else None
+        self._displaying = False
             
         self._validate()
         
@@ -386,6 +651,78 @@ class FlowPositionInstance(object):
     @property
     def task_id(self):
         return self._state['_id']
+    
+    @property
+    def task_reference(self):
+        """
+        The value identifying the task in URLs and forms, which depends on
+        the state store.
+        """
+        return self.state_store.get_reference(self.task_id, self._state)
+    
+    def add_task_reference(self, url):
+        separator = '&' if '?' in url else '?'
+        url = '%s%s%s=%s' % (url, separator, config.FLOWS_TASK_ID_PARAM, self.task_reference)
+        token = self.get_new_task_token()
+        if token is not None:
+            url = '%s&%s=%s' % (url, _NEW_TASK_PARAM, token)
+        return url
+    
+    def get_task_fields(self):
+        """
+        Returns the (name, value) pairs which forms must submit to continue
+        the task.
+        """
+        fields = [(config.FLOWS_TASK_ID_PARAM, self.task_reference)]
+        token = self.get_new_task_token()
+        if token is not None:
+            fields.append((_NEW_TASK_PARAM, token))
+        return fields
+    
+    def _encode_new_task(self):
+        # the history only records which pages were seen, so changing it is
+        # not a reason to store a new task
+        state = dict(self._state.as_dict())
+        state.pop('_history', None)
+        return serialisation.encode(state)
+    
+    def get_new_task_token(self):
+        """
+        Returns the signed state of a task which has not been stored yet,
+        or None if the task is found by its reference alone.
+        """
+        if not self._new_task or self.task_reference != self.task_id:
+            # stores which sign their references already carry the state
+            return None
+        state = dict(self._state.as_dict())
+        if self._displaying:
+            # links are made while the page is rendered, before the page is
+            # added to the history
+            state['_history'] = self._history.get_history_with(self)
+        return _sign_new_task(state)
+    
+    def _use_new_task(self):
+        _count_new_task(self.state_store, self._state.peek('_bound_to'))
+        # from now on the task is found by its ID alone, and its token is
+        # refused, so that it cannot be started again once it is completed
+        self._new_task = False
+        timeout = self._state.peek('_idle_timeout')
+        if timeout is None:
+            timeout = config.FLOWS_TASK_IDLE_TIMEOUT
+        self.state_store.set_lease_result(self.task_id, _NEW_TASK_PARAM, 'used', timeout)
+    
+    def _save_state(self, store_new_task):
+        if self._new_task:
+            if self._encode_new_task() == self._new_task_data:
+                return
+            self._use_new_task()
+            store_new_task = True
+        if store_new_task:
+            self.state_store.put_state(self.task_id, self._state)
+            self._state.mark_saved()
+            _limit_binder_tasks(self.state_store, self._state.peek('_bound_to'), self.task_id)
+        else:
+            self.state_store.update_state(self.task_id, self._state)
             
     def get_root_component(self):
         return self._flow_components[0]
@@ -407,17 +744,10 @@ class FlowPositionInstance(object):
         url_name = self._position.url_name
         url = reverse(url_name, args=args, kwargs=kwargs)
         
+        url = '%(root)s%(url)s' % { 'root': config.FLOWS_SITE_ROOT, 'url': url }
         if include_flow_id:
-        
-            separator = '&' if '?' in url else '?'
-            
-            return '%(root)s%(url)s%(separator)s%(task_id_param_name)s=%(task_id)s' % { 
-                                     'root': config.FLOWS_SITE_ROOT,
-                                     'url': url, 'separator': separator,
-                                     'task_id_param_name': config.FLOWS_TASK_ID_PARAM,
-                                     'task_id': self.task_id  }
-        else:
-            return '%(root)s%(url)s' % { 'root': config.FLOWS_SITE_ROOT, 'url': url }
+            url = self.add_task_reference(url)
+        return url
 
     def position_instance_for(self, component_class_or_name):
         # figure out where we're being sent to
@@ -458,10 +788,35 @@ class FlowPositionInstance(object):
         # subtree to get the new position
         new_position = PossibleFlowPosition(self._app_namespace, self._flow_namespace, tree_root + new_subtree)
         
-        # now create an instance of the position with the current state
-        return new_position.create_instance(self._state, self.state_store, self._url_args, self._url_kwargs)
+        # now create an instance of the position with the current state, which
+        # carries the task in the same way while it has not been stored
+        return new_position.create_instance(self._state, self.state_store, self._url_args, self._url_kwargs,
+                                            new_task=self._new_task)
+    
+    def _run_loaders(self, request):
+        # collect the keys needed by every component first, so that the
+        # objects can all be fetched together
+        wanted = []
+        for flow_component in self._flow_components:
+            for name, loader in flow_component.loaders.iteritems():
+                wanted.append((flow_component, name, loader, loader.get_key(flow_component)))
+        if not wanted:
+            return
+        
+        objects = get_request_loader(request).load_many([(loader, key) for _, _, loader, key in wanted])
+        for (flow_component, name, _, _), obj in zip(wanted, objects):
+            setattr(flow_component, name, obj)
     
     def handle(self, request, *args, **kwargs):
+        # a new task is stored once a form is submitted for it, whether or
+        # not the state changes, so links made while handling the
+        # submission do not need to carry it
+        store_new_task = self._new_task and request.method == 'POST'
+        if store_new_task:
+            # refused before the form is handled, rather than after
+            self._use_new_task()
+        self._displaying = request.method == 'GET'
+        
         # first validate that we can actually run by checking for
         # required state, for example
         response = None
@@ -471,6 +826,8 @@ class FlowPositionInstance(object):
                 break
         
         if response is None:
+            self._run_loaders(request)
+            
             # now call each of the prepare methods for the components
             for flow_component in self._flow_components:
                 # TODO: passing in *args and **kwargs to prepare is deprecated
@@ -521,7 +878,14 @@ class FlowPositionInstance(object):
             
         else:
             # update the state if necessary
-            self.state_store.put_state(self.task_id, self._state)
+            try:
+                self._save_state(store_new_task)
+            except StateConflict:
+                # another request changed the state since this one loaded
+                # it, so what this one did is dropped rather than
+                # overwriting what the other did
+                logger.info('Task %s was changed by another request' % self.task_id)
+                response = self.get_action().handle_conflict(request)
             
             if inspect.isclass(response):
                 # we got given a class, which implies the code should redirect
@@ -562,9 +926,9 @@ class PossibleFlowPosition(object):
 
         PossibleFlowPosition.all_positions[self.url_name] = self
             
-    def create_instance(self, state, state_store, url_args, url_kwargs):
+    def create_instance(self, state, state_store, url_args, url_kwargs, new_task=False):
         return FlowPositionInstance(self.app_namespace, self.flow_namespace, self, state,
-                                    state_store, url_args, url_kwargs)
+                                    state_store, url_args, url_kwargs, new_task)
     
     def _url_name_from_components(self, components, include_app_namespace=True):
         if self.flow_namespace is None:
@@ -5,7 +5,9 @@ class FlowHistory(object):
 
     def __init__(self, flow_position_instance):
         state = flow_position_instance._state
-        self._history = state['_history'] if '_history' in state else []
+        # the history is never changed in place, so it does not need to be
+        # tracked as a possible change to the state
+        self._loaded = self._history = self._as_entries(state.peek('_history', ()))
 
         url_name = flow_position_instance._position.url_name
 
@@ -17,18 +19,44 @@ class FlowHistory(object):
                 break
 
         self._back_url = self._history[-1][1] if len(self._history) > 0 else None
+        self._flow_position_instance = flow_position_instance
 
+    def _as_entries(self, history):
+        # some codecs return tuples as lists
+        return tuple(tuple(entry) for entry in history)
 
-    def add_to_history(self, flow_position_instance):
+    def _entry(self, flow_position_instance):
         url_name = flow_position_instance._position.url_name
 
-        url = flow_position_instance.get_absolute_url()
+        # the task is added when the URL is used, as how it is referred to
+        # can change, and can include the state itself
+        url = flow_position_instance.get_absolute_url(include_flow_id=False)
         current_action = flow_position_instance.get_action()
         skip_on_back = getattr(current_action, 'skip_on_back', False)
 
-        self._history.append((url_name, url, skip_on_back))
-        flow_position_instance._state['_history'] = self._history
+        return (url_name, url, skip_on_back)
+
+    def get_history_with(self, flow_position_instance):
+        """
+        Returns the history as it will be once the page of the given flow
+        position has been shown.
+        """
+        url_name = flow_position_instance._position.url_name
+        if self._history and self._history[-1][0] == url_name:
+            # the page has already been added, as it is when the response
+            # is rendered after the request was handled
+            return self._history
+        return self._history + (self._entry(flow_position_instance),)
+
+    def add_to_history(self, flow_position_instance):
+        self._history = self.get_history_with(flow_position_instance)
+        # re-displaying the same page leaves the history as it was, in which
+        # case the state does not need to be changed
+        if self._history != self._loaded:
+            flow_position_instance._state['_history'] = self._history
 
 
     def get_back_url(self):
-        return self._back_url
+        if self._back_url is None:
+            return None
+        return self._flow_position_instance.add_task_reference(self._back_url)
@@ -0,0 +1,134 @@
+# -*- coding: UTF-8 -*-
+"""
+Loaders fetch the objects that flow components need before their `prepare`
+methods are called. Each component declares what it needs in its `loaders`
+attribute, and the keys needed by every component in the flow are
+collected first so that they can be fetched together, with one query for
+each kind of object rather than one for each component.
+
+Objects are cached for the rest of the request, so other code handling the
+same request can use `get_request_loader(request)` to share them.
+"""
+from django.core.exceptions import ValidationError
+
+
+class Loader(object):
+    """
+    Base class for loaders. `get_key` returns the key of the object the
+    component needs, or None if it needs nothing, and `load_many` fetches
+    the objects for several keys at once. Loaders with the same batch key
+    share their queries and cached objects.
+    """
+
+    def get_key(self, component):
+        raise NotImplementedError
+
+    def get_batch_key(self):
+        return self
+
+    def load_many(self, keys):
+        """
+        Returns a dict of key to object for those of the keys which exist.
+        """
+        raise NotImplementedError
+
+
+class ModelLoader(Loader):
+    """
+    Loads a model instance whose key is taken from the task state, from the
+    URL keyword arguments of the component, or by calling `key` with the
+    component. The instance is matched on `field`, the primary key by
+    default, and is None if it does not exist.
+    """
+
+    def __init__(self, model, state_key=None, url_kwarg=None, key=None, field='pk', queryset=None):
+        self.model = model
+        self.state_key = state_key
+        self.url_kwarg = url_kwarg
+        self.key = key
+        self.field = field
+        self.queryset = queryset
+
+    def _get_field(self):
+        opts = self.model._meta
+        return opts.pk if self.field == 'pk' else opts.get_field(self.field)
+
+    def get_key(self, component):
+        if self.key is not None:
+            key = self.key(component)
+        elif self.state_key is not None:
+            key = component.state.get(self.state_key)
+        else:
+            key = component.kwargs.get(self.url_kwarg)
+        if key is None:
+            return None
+        try:
+            # URL arguments are strings, whatever the type of the field
+            return self._get_field().to_python(key)
+        except ValidationError:
+            return None
+
+    def get_batch_key(self):
+        if self.queryset is not None:
+            # a custom queryset could filter out some of the objects
+            return self
+        return self.model, self.field
+
+    def load_many(self, keys):
+        queryset = self.queryset
+        if queryset is None:
+            queryset = self.model._default_manager.all()
+        if self.field == 'pk':
+            return queryset.in_bulk(keys)
+        return dict((getattr(obj, self.field), obj)
+                    for obj in queryset.filter(**{'%s__in' % self.field: keys}))
+
+    def __repr__(self):
+        return 'ModelLoader: %s.%s' % (self.model.__name__, self.field)
+
+
+class RequestLoader(object):
+    """
+    Fetches objects for loaders in batches, and caches them for the rest
+    of the request.
+    """
+
+    def __init__(self):
+        # batch key -> {key: object}
+        self._cache = {}
+
+    def load_many(self, wanted):
+        """
+        Takes a list of (loader, key) pairs and returns the list of objects,
+        fetching the ones which are not cached with one `load_many` call
+        for each batch key.
+        """
+        missing = {}
+        for loader, key in wanted:
+            if key is None:
+                continue
+            batch_key = loader.get_batch_key()
+            if key not in self._cache.get(batch_key, {}):
+                missing.setdefault(batch_key, (loader, set()))[1].add(key)
+
+        for batch_key, (loader, keys) in missing.iteritems():
+            found = loader.load_many(list(keys))
+            cache = self._cache.setdefault(batch_key, {})
+            for key in keys:
+                cache[key] = found.get(key)
+
+        return [None if key is None else self._cache[loader.get_batch_key()][key]
+                for loader, key in wanted]
+
+    def load(self, loader, key):
+        return self.load_many([(loader, key)])[0]
+
+
+def get_request_loader(request):
+    """
+    Returns the `RequestLoader` for a request, creating it if needed.
+    """
+    request_loader = getattr(request, '_flows_loader', None)
+    if request_loader is None:
+        request_loader = request._flows_loader = RequestLoader()
+    return request_loader
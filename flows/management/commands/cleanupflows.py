@@ -1,9 +1,18 @@
 from django.core.management.base import NoArgsCommand
-from flows.statestore.django_store import StateModel
+from flows.statestore import state_store
 
 class Command(NoArgsCommand):
-    help = "Removes expired flow state from the database (only valid if using the Django state store)"
+    help = "Removes expired flow state (only needed for state stores which do not expire state themselves)"
 
     def handle_noargs(self, **options):
-        count = StateModel.objects.remove_expired_state()
+        if not hasattr(state_store, 'remove_expired_state'):
+            print 'The configured state store removes expired state itself'
+            return
+
+        progress = None
+        if int(options.get('verbosity', 1)) > 1:
+            def progress(count):
+                print 'Deleted %d so far...' % count
+
+        count = state_store.remove_expired_state(progress=progress)
         print 'Deleted %d expired tasks\' state' % count
\ No newline at end of file
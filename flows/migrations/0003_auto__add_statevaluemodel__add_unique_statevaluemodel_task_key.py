@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'StateValueModel'
+        db.create_table('flows_statevaluemodel', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('task', self.gf('django.db.models.fields.related.ForeignKey')(related_name='state_values', to_field='task_id', to=orm['flows.StateModel'])),
+            ('key', self.gf('django.db.models.fields.CharField')(max_length=255)),
+            ('value', self.gf('django.db.models.fields.TextField')()),
+        ))
+        db.send_create_signal('flows', ['StateValueModel'])
+
+        # Adding unique constraint on 'StateValueModel', fields ['task', 'key']
+        db.create_unique('flows_statevaluemodel', ['task_id', 'key'])
+
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'StateValueModel', fields ['task', 'key']
+        db.delete_unique('flows_statevaluemodel', ['task_id', 'key'])
+
+        # Deleting model 'StateValueModel'
+        db.delete_table('flows_statevaluemodel')
+
+
+    models = {
+        'flows.statemodel': {
+            'Meta': {'object_name': 'StateModel'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_access': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'state': ('django.db.models.fields.TextField', [], {'null': 'True'}),
+            'task_id': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '32'})
+        },
+        'flows.statevaluemodel': {
+            'Meta': {'unique_together': "(('task', 'key'),)", 'object_name': 'StateValueModel'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'key': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'task': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'state_values'", 'to_field': "'task_id'", 'to': "orm['flows.StateModel']"}),
+            'value': ('django.db.models.fields.TextField', [], {})
+        }
+    }
+
+    complete_apps = ['flows']
\ No newline at end of file
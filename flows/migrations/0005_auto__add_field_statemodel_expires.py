@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding field 'StateModel.expires'
+        db.add_column('flows_statemodel', 'expires',
+                      self.gf('django.db.models.fields.DateTimeField')(null=True, db_index=True),
+                      keep_default=False)
+
+
+    def backwards(self, orm):
+        # Deleting field 'StateModel.expires'
+        db.delete_column('flows_statemodel', 'expires')
+
+
+    models = {
+        'flows.statemodel': {
+            'Meta': {'object_name': 'StateModel'},
+            'expires': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_access': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'state': ('django.db.models.fields.TextField', [], {'null': 'True'}),
+            'task_id': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '32'})
+        },
+        'flows.statevaluemodel': {
+            'Meta': {'unique_together': "(('task', 'key'),)", 'object_name': 'StateValueModel'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'key': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'task': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'state_values'", 'to_field': "'task_id'", 'to': "orm['flows.StateModel']"}),
+            'value': ('django.db.models.fields.TextField', [], {})
+        }
+    }
+
+    complete_apps = ['flows']
\ No newline at end of file
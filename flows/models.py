@@ -7,4 +7,9 @@
 
 from flows import config
 if config.FLOWS_STATE_STORE == 'flows.statestore.django_store':
-    from flows.statestore.django_store import StateModel #@UnusedImport only used to registed with django ORM
\ No newline at end of file
+    from flows.statestore.django_store import StateModel, StateValueModel, StateLeaseModel #@UnusedImport only used to registed with django ORM
+
+if config.FLOWS_DELETE_TASKS_ON_LOGOUT:
+    from django.contrib.auth.signals import user_logged_out
+    from flows.signals import delete_binder_tasks
+    user_logged_out.connect(delete_binder_tasks, dispatch_uid='flows.delete_binder_tasks')
\ No newline at end of file
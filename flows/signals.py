@@ -0,0 +1,29 @@
+# -*- coding: UTF-8 -*-
+"""
+Signal receivers which delete the tasks of a user when their requests will
+no longer be able to use them, such as when they log out. Connect them to
+any signal which is sent with the request, for example:
+
+    from django.contrib.auth.signals import user_logged_out
+    from flows.signals import delete_binder_tasks
+
+    user_logged_out.connect(delete_binder_tasks)
+
+This is done for `user_logged_out` by setting FLOWS_DELETE_TASKS_ON_LOGOUT.
+"""
+from flows.binder import binder
+
+
+def delete_binder_tasks(sender, request=None, **kwargs):
+    """
+    Deletes the tasks bound to the same value as `request`, in the default
+    state store.
+    """
+    if request is None:
+        return
+    bound_to = binder(request)
+    if bound_to is None:
+        return
+    # imported here, as the store may need the models to be loaded first
+    from flows.statestore import state_store
+    state_store.delete_for_binder(bound_to)
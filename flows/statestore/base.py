@@ -1,18 +1,228 @@
-
+from contextlib import contextmanager
+from flows import config
+from flows.statestore import serialisation
+from flows.statestore.tracking import TrackedState
+import hashlib
 import pickle
 import base64
 
 class StateNotFound(Exception):
     pass
 
+class StateConflict(Exception):
+    """
+    Raised when writing state which another request changed or deleted
+    since it was loaded.
+    """
+    pass
+
 class StateStoreBase(object):
     
+    # what the value identifying a task in URLs and forms must look like
+    reference_pattern = '^[0-9a-f]{32}$'
+    
+    def _encode(self, state):
+        """
+        Encodes the state as bytes using the configured codec. Stores which
+        can hold binary data should use this rather than `_serialise`.
+        """
+        if isinstance(state, TrackedState) and state._encoded is not None:
+            return state._encoded
+        if config.FLOWS_STATE_LAZY_DECODE:
+            # encode each key separately so that they can be decoded only
+            # when they are used
+            return serialisation.encode_values(self._encode_values(state))
+        if isinstance(state, TrackedState):
+            state = state.as_dict()
+        return serialisation.encode(state)
+    
+    def _decode(self, data):
+        digest = self._digest(data)
+        if not serialisation.is_encoded(data):
+            # state written by earlier versions was always base64'd pickle
+            return TrackedState(pickle.loads(base64.b64decode(data)), digest)
+        if serialisation.is_values(data):
+            return TrackedState(digest=digest, encoded_values=serialisation.decode_values(data))
+        found = []
+        return TrackedState(serialisation.decode(data, found), digest, found_references=found)
+    
     def _serialise(self, state):
-        data = pickle.dumps(state)
-        return base64.b64encode(data)
+        """
+        Encodes the state as text, for stores which cannot hold binary data.
+        """
+        return base64.b64encode(self._encode(state))
     
     def _deserialise(self, data):
-        return pickle.loads(base64.b64decode(data))
+        data = base64.b64decode(data)
+        if not serialisation.is_encoded(data):
+            return TrackedState(pickle.loads(data), self._digest(data))
+        return self._decode(data)
+    
+    def _encode_values(self, state):
+        """
+        Encodes each key of the state separately. Keys which cannot have
+        changed since they were loaded are not encoded again.
+        """
+        if not isinstance(state, TrackedState):
+            return dict((key, serialisation.encode(value)) for key, value in state.iteritems())
+        values = {}
+        for key in state:
+            data = state.encoded_value(key)
+            if data is None:
+                data = serialisation.encode(state.peek(key))
+            values[key] = data
+        return values
+    
+    def _decode_values(self, values):
+        """
+        Returns the state for a dict of separately encoded keys, for stores
+        which keep the keys separately. Each is decoded when it is first used.
+        """
+        return TrackedState(encoded_values=values)
+    
+    def _changed_values(self, state):
+        """
+        Returns the encoded values of the keys which were changed since the
+        state was loaded, and the keys which were removed. This needs the
+        state to have been loaded as separately encoded keys.
+        """
+        changed = {}
+        for key in state.changed_keys:
+            changed[key] = serialisation.encode(state.peek(key))
+        for key in state.exposed_keys - state.changed_keys - state.removed_keys:
+            data = serialisation.encode(state.peek(key))
+            if data != state.encoded_values.get(key):
+                changed[key] = data
+        return changed, state.removed_keys
+    
+    def _update_values(self, task_id, state):
+        """
+        Writes only the keys of the state which changed, for stores which
+        keep the keys separately. These must implement `_put_values`.
+        """
+        timeout = self._get_idle_timeout(state)
+        if not isinstance(state, TrackedState):
+            self._put_values(task_id, self._encode_values(state), None, timeout, 1)
+            return
+        if not state.is_changed and not state.exposed_keys:
+            return
+        
+        if state.encoded_values is None:
+            # we don't know what was stored before, so replace all of it
+            changed, removed = self._encode_values(state), None
+            encoded_values = {}
+        else:
+            changed, removed = self._changed_values(state)
+            encoded_values = dict(state.encoded_values)
+            for key in removed:
+                encoded_values.pop(key, None)
+        
+        if removed is None or changed or removed:
+            version = self._next_version(state)
+            self._put_values(task_id, changed, removed, timeout, version,
+                             check_version=state.version is not None)
+            state.version = version
+        encoded_values.update(changed)
+        state.mark_saved(encoded_values=encoded_values)
+    
+    def _put_values(self, task_id, values, removed, timeout, version, check_version=False):
+        """
+        Stores the encoded `values` of the given keys and deletes the keys
+        in `removed`. If `removed` is None, `values` replace all of the
+        existing state. `timeout` is the idle timeout of the task, and
+        `version` its new version. If `check_version` is true, nothing is
+        written and StateConflict is raised unless the stored version is
+        the one before.
+        """
+        raise NotImplementedError
+    
+    def _digest(self, data):
+        return hashlib.sha1(data).digest()
+    
+    def _next_version(self, state):
+        """
+        Returns the version to store along with the state. Every write
+        increases it, so that a store can tell if the state changed since
+        it was loaded.
+        """
+        return (getattr(state, 'version', None) or 0) + 1
+    
+    def _saved(self, state, version):
+        if isinstance(state, TrackedState):
+            state.version = version
+    
+    def _get_idle_timeout(self, state):
+        """
+        Returns how many seconds the task can be idle for before it expires.
+        This is FLOWS_TASK_IDLE_TIMEOUT unless its flow declared its own.
+        """
+        if isinstance(state, TrackedState):
+            timeout = state.peek('_idle_timeout')
+        else:
+            timeout = state.get('_idle_timeout')
+        if timeout is None:
+            return config.FLOWS_TASK_IDLE_TIMEOUT
+        return timeout
+    
+    def _get_bound_to(self, state):
+        """
+        Returns the binder value the task is bound to, if any, for stores
+        which index tasks by it.
+        """
+        if isinstance(state, TrackedState):
+            return state.peek('_bound_to')
+        return state.get('_bound_to')
+    
+    def has_changed(self, state):
+        """
+        Returns whether `state` differs from what was loaded from the store.
+        State which is not tracked is always assumed to have changed.
+        """
+        return self._check_changed(state)[0]
+    
+    def _check_changed(self, state):
+        if not isinstance(state, TrackedState) or state.is_changed:
+            return True, None
+        if not state.exposed_keys:
+            return False, None
+        # values which could have been modified in place were handed out,
+        # so compare against the state as it was loaded
+        if state.encoded_values is not None:
+            return bool(self._changed_values(state)[0]), None
+        encoded = self._encode(state)
+        return state.digest is None or self._digest(encoded) != state.digest, encoded
+    
+    @contextmanager
+    def batch(self):
+        """
+        Groups together the writes made while handling a single request.
+        Stores which can send several writes at once should defer `put_state`
+        and `delete_state` calls made inside the block and send them when it
+        exits, and discard them if it exits with an exception. By default
+        writes happen immediately.
+        """
+        yield
+    
+    def get_reference(self, task_id, state):
+        """
+        Returns the value which identifies the task in URLs and forms. This
+        is the task ID, unless the store keeps the state on the client.
+        """
+        return task_id
+    
+    def process_request(self, request):
+        """
+        Called before a flow handles a request.
+        """
+        pass
+    
+    def process_response(self, request, response):
+        """
+        Called once a flow has handled a request, to allow stores which keep
+        the state on the client to add it to the response. `response` is None
+        if handling the request failed.
+        """
+        return response
     
     def get_state(self, task_id):
         raise NotImplementedError
@@ -20,5 +230,145 @@ class StateStoreBase(object):
     def put_state(self, task_id, state):
         raise NotImplementedError
     
+    def update_state(self, task_id, state):
+        """
+        Writes the state for a task at the end of a request, unless nothing
+        was changed.
+        """
+        changed, encoded = self._check_changed(state)
+        if not changed:
+            return
+        if not isinstance(state, TrackedState):
+            self.put_state(task_id, state)
+            return
+        # avoid encoding the state twice if that was needed to find changes
+        if encoded is not None:
+            state._encoded = encoded
+        try:
+            if state.version is None:
+                self.put_state(task_id, state)
+            else:
+                self._put_if_version(task_id, state, state.version)
+        finally:
+            state.mark_saved()
+    
+    def _put_if_version(self, task_id, state, version):
+        """
+        Writes the state only if the stored version of the task is still
+        `version`, and raises StateConflict if another request changed or
+        deleted it since. Stores which cannot check the version write the
+        state regardless.
+        """
+        self.put_state(task_id, state)
+    
     def delete_state(self, task_id):
-        raise NotImplementedError
\ No newline at end of file
+        raise NotImplementedError
+    
+    # Leases let only one request at a time handle a form submitted for a
+    # task, so that duplicate submissions can wait for the first and reuse
+    # its result; see FLOWS_TASK_LEASE_TIMEOUT. They are always sent at once
+    # rather than batched. Lazy tasks also keep a lease result to refuse the
+    # links of a task which has been used, so need a store which supports them.
+    
+    supports_leases = False
+    
+    def acquire_lease(self, task_id, token, timeout):
+        """
+        Takes the lease on a task for `timeout` seconds, identified by
+        `token`, unless another request holds it. Returns whether the lease
+        was taken, or None if the store does not support leases.
+        """
+        return None
+    
+    def release_lease(self, task_id, token):
+        """
+        Gives up the lease on a task, if it is still held with `token`.
+        """
+        pass
+    
+    def set_lease_result(self, task_id, key, result, timeout):
+        """
+        Keeps the result of handling a request for `timeout` seconds, so
+        that duplicates of the request, which have the same `key`, can
+        reuse it.
+        """
+        pass
+    
+    def get_lease_result(self, task_id, key):
+        return None
+    
+    # Stores can index tasks by the binder value they are bound to, and
+    # count how many each binder value creates, so that one client cannot
+    # fill the store; see FLOWS_MAX_TASKS_PER_BINDER and
+    # FLOWS_TASK_CREATION_LIMIT. The index also lets all of the tasks of a
+    # user be deleted at once. Tasks are indexed when their state is put.
+    
+    def get_binder_tasks(self, bound_to):
+        """
+        Returns the IDs of the tasks bound to `bound_to` which have not
+        expired, oldest first, or None if the store does not index tasks by
+        binder value.
+        """
+        return None
+    
+    def delete_for_binder(self, bound_to):
+        """
+        Deletes all of the tasks bound to `bound_to`, for example when its
+        user logs out, and returns how many there were. Stores which do not
+        index tasks by binder value look through every task instead, and
+        None is returned if the store cannot list its tasks either.
+        """
+        task_ids = self.get_binder_tasks(bound_to)
+        if task_ids is None:
+            if not hasattr(self, 'iter_states'):
+                return None
+            task_ids = [task_id for task_id, state in self.iter_states()
+                        if self._get_bound_to(state) == bound_to]
+        self.delete_many(task_ids)
+        return len(task_ids)
+    
+    def count_created(self, bound_to, period):
+        """
+        Counts a new task bound to `bound_to`, and returns how many it has
+        created in the current `period` seconds, including this one, or None
+        if the store does not count them. This is always sent at once rather
+        than batched.
+        """
+        return None
+    
+    # Operations on many tasks at once, for tools such as cleanup jobs and
+    # migrations. Stores should override them where they can do better than
+    # one task at a time, in which case reading state with them does not
+    # count as using the tasks, so does not affect when they expire.
+    # Stores which can list their tasks also have an `iter_states()` method,
+    # which yields a (task ID, state) pair for every task which has not
+    # expired, loading a few at a time rather than all at once.
+    
+    # how many tasks are loaded at a time by iter_states
+    chunk_size = 500
+    
+    def get_many(self, task_ids):
+        """
+        Returns a dict of task ID to state for those of the given tasks
+        which exist.
+        """
+        states = {}
+        for task_id in task_ids:
+            try:
+                states[task_id] = self.get_state(task_id)
+            except StateNotFound:
+                pass
+        return states
+    
+    def put_many(self, states):
+        """
+        Stores a dict of task ID to state.
+        """
+        with self.batch():
+            for task_id, state in states.iteritems():
+                self.put_state(task_id, state)
+    
+    def delete_many(self, task_ids):
+        with self.batch():
+            for task_id in task_ids:
+                self.delete_state(task_id)
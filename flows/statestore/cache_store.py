@@ -0,0 +1,188 @@
+"""
+Stores task state using the Django cache framework, so any configured
+cache - memcached, the database cache, local memory and so on - can be
+used. The cache's own timeout is used to expire idle tasks, set from the
+idle timeout of each task's flow.
+
+Note that a cache may drop entries before they time out, for example when
+memcached runs out of memory, which will end the user's flow.
+
+The version of each task is kept in a separate key, which writers that
+check it increase atomically with `incr`, so only one of two requests
+which loaded the same version can write. Caches cannot write two keys at
+once though, so a request which reads the task just as another one
+writes it can see the new version with the old state.
+"""
+from contextlib import contextmanager
+from flows import config
+from flows.statestore.base import StateStoreBase, StateNotFound, StateConflict
+import hashlib
+import threading
+import time
+
+try:
+    from django.core.cache import caches
+    def _get_cache(alias):
+        return caches[alias]
+except ImportError:
+    # django < 1.7
+    from django.core.cache import get_cache as _get_cache
+
+
+class StateStore(StateStoreBase):
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _get_cache(self):
+        return _get_cache(config.FLOWS_CACHE_STATE_STORE_ALIAS)
+
+    def _key(self, task_id):
+        return '%s%s' % (config.FLOWS_CACHE_STATE_STORE_KEY_PREFIX, task_id)
+
+    def _version_key(self, task_id):
+        return self._key(task_id) + ':version'
+
+    @contextmanager
+    def batch(self):
+        if self._get_pending() is not None:
+            # already batching - the outermost block will send the writes
+            yield
+            return
+
+        self._local.pending = pending = {}
+        try:
+            yield
+        finally:
+            self._local.pending = None
+        self._send(pending)
+
+    def _get_pending(self):
+        return getattr(self._local, 'pending', None)
+
+    def _send(self, writes):
+        """
+        Sends a dict of cache key to a (value, timeout) pair, or to None if
+        the key should be deleted.
+        """
+        cache = self._get_cache()
+        # one call for each idle timeout, of which there are only a few
+        by_timeout = {}
+        for key, write in writes.iteritems():
+            if write is not None:
+                value, timeout = write
+                by_timeout.setdefault(timeout, {})[key] = value
+        deleted = [key for key, write in writes.iteritems() if write is None]
+        for timeout, values in by_timeout.iteritems():
+            cache.set_many(values, timeout)
+        if deleted:
+            cache.delete_many(deleted)
+
+    def _write(self, task_id, data, version, timeout):
+        # the state and its version are written together, or both deleted
+        # if `data` is None
+        if data is None:
+            writes = {self._key(task_id): None, self._version_key(task_id): None}
+        else:
+            writes = {self._key(task_id): ((time.time(), data), timeout),
+                      self._version_key(task_id): (version, timeout)}
+        pending = self._get_pending()
+        if pending is None:
+            self._send(writes)
+        else:
+            pending.update(writes)
+
+    def _flush_pending(self, keys):
+        # make sure we read our own writes
+        pending = self._get_pending()
+        if pending is not None and any(key in pending for key in keys):
+            self._send(dict((key, pending.pop(key)) for key in keys if key in pending))
+
+    def get_state(self, task_id):
+        key = self._key(task_id)
+        version_key = self._version_key(task_id)
+        self._flush_pending([key, version_key])
+
+        values = self._get_cache().get_many([key, version_key])
+        if key not in values:
+            raise StateNotFound
+        written, data = values[key]
+        version = values.get(version_key, 0)
+        state = self._decode(data)
+        self._saved(state, version)
+
+        if time.time() - written > config.FLOWS_CACHE_STATE_STORE_TOUCH_INTERVAL:
+            self._touch(task_id, data, version, self._get_idle_timeout(state))
+
+        return state
+
+    def _touch(self, task_id, data, version, timeout):
+        """
+        Restarts the timeout of a task which has been read, without undoing
+        any write made since. This is sent at once, even when batching, as
+        the state it writes is only current now.
+        """
+        key = self._key(task_id)
+        version_key = self._version_key(task_id)
+        cache = self._get_cache()
+        if hasattr(cache, 'touch'):
+            # django >= 2.1
+            cache.touch(key, timeout)
+            cache.touch(version_key, timeout)
+            return
+        # otherwise the value has to be written again, which is only done if
+        # no other request has written it since it was read - a write also
+        # restarts the timeout
+        if cache.get(version_key, 0) != version:
+            return
+        cache.set_many({key: (time.time(), data), version_key: version}, timeout)
+
+    def put_state(self, task_id, state):
+        version = self._next_version(state)
+        self._write(task_id, self._encode(state), version, self._get_idle_timeout(state))
+        self._saved(state, version)
+
+    def _put_if_version(self, task_id, state, version):
+        version_key = self._version_key(task_id)
+        self._flush_pending([self._key(task_id), version_key])
+
+        cache = self._get_cache()
+        timeout = self._get_idle_timeout(state)
+        if version == 0:
+            # state written before it had versions
+            won = cache.add(version_key, 1, timeout)
+        else:
+            try:
+                won = cache.incr(version_key) == version + 1
+            except ValueError:
+                # the task expired or was deleted
+                won = False
+        if not won:
+            raise StateConflict
+        # sent at once, as the version has already changed
+        writes = {self._key(task_id): ((time.time(), self._encode(state)), timeout),
+                  version_key: (version + 1, timeout)}
+        self._send(writes)
+        self._saved(state, version + 1)
+
+    def delete_state(self, task_id):
+        self._write(task_id, None, None, None)
+
+    def count_created(self, bound_to, period):
+        number = int(time.time() // period)
+        digest = hashlib.sha1(unicode(bound_to).encode('utf-8')).hexdigest()
+        key = '%screated:%s:%d' % (config.FLOWS_CACHE_STATE_STORE_KEY_PREFIX, digest, number)
+        cache = self._get_cache()
+        cache.add(key, 0, period)
+        try:
+            return cache.incr(key)
+        except ValueError:
+            # the cache dropped it in the meantime
+            cache.add(key, 1, period)
+            return 1
+
+    def get_many(self, task_ids):
+        keys = dict((self._key(task_id), task_id) for task_id in task_ids)
+        self._flush_pending(keys)
+        values = self._get_cache().get_many(keys.keys())
+        return dict((keys[key], self._decode(data)) for key, (_, data) in values.iteritems())
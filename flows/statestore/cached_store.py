@@ -0,0 +1,241 @@
+"""
+A state store which keeps recently used state in memory in front of
+another state store, so that a user who keeps hitting the same process
+during a flow does not need a round trip to the real store for each step.
+
+Each process caches the encoded state of up to
+FLOWS_CACHED_STATE_STORE_MAX_ENTRIES tasks, for at most
+FLOWS_CACHED_STATE_STORE_TTL seconds. Every write is published on an
+invalidation channel along with the new version of the task's state - a
+digest of its encoded form - and other processes drop their cached copy
+unless it is already that version.
+
+Cached entries also keep the version number the backend gave the state,
+so that a write based on a stale cached copy is refused by the backend
+like any other conflicting write, and drops the copy.
+"""
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from django.utils.importlib import import_module
+from flows import config
+from flows.statestore.base import StateStoreBase, StateConflict
+from flows.statestore.tracking import TrackedState
+import os
+import threading
+import time
+
+
+def _import(path):
+    module_name, attr_name = path.rsplit('.', 1)
+    return getattr(import_module(module_name), attr_name)
+
+
+class LocalChannel(object):
+    """
+    An in-memory stand-in for a pub/sub channel, which only delivers
+    messages within the current process. This is useful for tests, and
+    for single process deployments.
+    """
+    _subscribers = defaultdict(list)
+
+    def __init__(self, name):
+        self.name = name
+
+    def subscribe(self, callback):
+        LocalChannel._subscribers[self.name].append(callback)
+
+    def publish(self, task_id, version):
+        for callback in LocalChannel._subscribers[self.name]:
+            callback(task_id, version)
+
+
+class StateStore(StateStoreBase):
+
+    def __init__(self, backend=None, channel=None):
+        if backend is None:
+            backend = import_module(config.FLOWS_CACHED_STATE_STORE_BACKEND).StateStore()
+        if channel is None:
+            channel_class = _import(config.FLOWS_CACHED_STATE_STORE_CHANNEL)
+            channel = channel_class(config.FLOWS_CACHED_STATE_STORE_CHANNEL_NAME)
+        self.backend = backend
+        self.channel = channel
+
+        # task ID -> (encoded state, version, expiry time, backend version),
+        # least recently used first
+        self._entries = OrderedDict()
+        # tasks being fetched from the backend, and those of them which
+        # were invalidated while the fetch was happening
+        self._fetching = defaultdict(int)
+        self._stale = set()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._subscribed_pid = None
+
+    def _ensure_subscribed(self):
+        # subscribing is done lazily so that each process of a pre-forking
+        # server has its own subscription, and starts with an empty cache
+        pid = os.getpid()
+        if self._subscribed_pid != pid:
+            with self._lock:
+                if self._subscribed_pid != pid:
+                    self._entries.clear()
+                    self.channel.subscribe(self._invalidate)
+                    self._subscribed_pid = pid
+
+    def _version(self, data):
+        return self._digest(data).encode('hex')
+
+    def _invalidate(self, task_id, version):
+        with self._lock:
+            entry = self._entries.get(task_id)
+            if entry is not None and entry[1] != version:
+                del self._entries[task_id]
+            if task_id in self._fetching:
+                self._stale.add(task_id)
+
+    def _get_cached(self, task_id):
+        with self._lock:
+            entry = self._entries.pop(task_id, None)
+            if entry is None or entry[2] < time.time():
+                return None
+            # re-insert to mark it as the most recently used
+            self._entries[task_id] = entry
+            return entry[0], entry[3]
+
+    def _cache(self, task_id, data, timeout=None, backend_version=None):
+        with self._lock:
+            self._cache_locked(task_id, data, timeout, backend_version)
+
+    def _cache_locked(self, task_id, data, timeout, backend_version=None):
+        self._entries.pop(task_id, None)
+        if data is not None:
+            # reads from the cache do not keep the task alive in the
+            # backend, so entries must not outlive the task's idle timeout
+            ttl = min(config.FLOWS_CACHED_STATE_STORE_TTL, timeout)
+            self._entries[task_id] = (data, self._version(data), time.time() + ttl, backend_version)
+            while len(self._entries) > config.FLOWS_CACHED_STATE_STORE_MAX_ENTRIES:
+                self._entries.popitem(last=False)
+
+    def _get_pending(self):
+        return getattr(self._local, 'pending', None)
+
+    def _written(self, task_id, data, timeout=None, backend_version=None):
+        """
+        Updates the cache and tells other processes once state has been
+        written to the backend, or deleted if `data` is None.
+        """
+        pending = self._get_pending()
+        if pending is not None:
+            # the backend will only really write it at the end of the batch
+            pending[task_id] = (data, timeout, backend_version)
+            return
+        self._cache(task_id, data, timeout, backend_version)
+        self.channel.publish(task_id, None if data is None else self._version(data))
+
+    @contextmanager
+    def batch(self):
+        if self._get_pending() is not None:
+            yield
+            return
+
+        self._local.pending = pending = {}
+        try:
+            with self.backend.batch():
+                yield
+        finally:
+            self._local.pending = None
+        for task_id, (data, timeout, backend_version) in pending.iteritems():
+            self._written(task_id, data, timeout, backend_version)
+
+    def get_state(self, task_id):
+        self._ensure_subscribed()
+
+        pending = self._get_pending()
+        if pending is None or task_id not in pending:
+            cached = self._get_cached(task_id)
+            if cached is not None:
+                state = self._decode(cached[0])
+                self._saved(state, cached[1])
+                return state
+
+        with self._lock:
+            self._fetching[task_id] += 1
+        try:
+            state = self.backend.get_state(task_id)
+            data = self._encode(state)
+        finally:
+            with self._lock:
+                self._fetching[task_id] -= 1
+                stale = task_id in self._stale
+                if not self._fetching[task_id]:
+                    del self._fetching[task_id]
+                    self._stale.discard(task_id)
+        if not stale:
+            self._cache(task_id, data, self._get_idle_timeout(state), getattr(state, 'version', None))
+        return state
+
+    def put_state(self, task_id, state):
+        self._ensure_subscribed()
+        data = self._encode(state)
+        if not isinstance(state, TrackedState):
+            # so that the backend can record the version it wrote
+            state = TrackedState(state)
+        # don't make the backend encode it all over again
+        state._encoded = data
+        self.backend.put_state(task_id, state)
+        self._written(task_id, data, self._get_idle_timeout(state), getattr(state, 'version', None))
+
+    def update_state(self, task_id, state):
+        self._ensure_subscribed()
+        changed, data = self._check_changed(state)
+        if not changed:
+            return
+        if data is None:
+            data = self._encode(state)
+        if isinstance(state, TrackedState):
+            state._encoded = data
+        # the backend may be able to write only what changed
+        try:
+            self.backend.update_state(task_id, state)
+        except StateConflict:
+            # the cached copy, here or elsewhere, may be what was out of
+            # date, so is dropped at once even when batching
+            self._cache(task_id, None)
+            self.channel.publish(task_id, None)
+            raise
+        self._written(task_id, data, self._get_idle_timeout(state), getattr(state, 'version', None))
+
+    def delete_state(self, task_id):
+        self._ensure_subscribed()
+        self.backend.delete_state(task_id)
+        self._written(task_id, None)
+
+    @property
+    def supports_leases(self):
+        return self.backend.supports_leases
+
+    def acquire_lease(self, task_id, token, timeout):
+        return self.backend.acquire_lease(task_id, token, timeout)
+
+    def release_lease(self, task_id, token):
+        self.backend.release_lease(task_id, token)
+
+    def set_lease_result(self, task_id, key, result, timeout):
+        self.backend.set_lease_result(task_id, key, result, timeout)
+
+    def get_lease_result(self, task_id, key):
+        return self.backend.get_lease_result(task_id, key)
+
+    def get_binder_tasks(self, bound_to):
+        return self.backend.get_binder_tasks(bound_to)
+
+    def count_created(self, bound_to, period):
+        return self.backend.count_created(bound_to, period)
+
+    def get_many(self, task_ids):
+        return self.backend.get_many(task_ids)
+
+    @property
+    def iter_states(self):
+        # only there if the backend can list its tasks
+        return self.backend.iter_states
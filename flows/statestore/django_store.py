@@ -1,28 +1,205 @@
-from flows.statestore.base import StateStoreBase, StateNotFound
-from django.db import models
+from flows.statestore.base import StateStoreBase, StateNotFound, StateConflict
+from django.core.signals import request_finished
+from django.db import models, connections, router, transaction, IntegrityError
+from django.db.models import Q
 from django.utils import timezone
 from flows import config
 from datetime import timedelta
+from itertools import groupby
+from operator import itemgetter
+import base64
+import hashlib
+import logging
+import threading
+import time
 
 
+logger = logging.getLogger(__name__)
+
+
+# Backends which can "insert or update" in a single statement, along with
+# the minimum server version which can
+_upsert_backends = {'postgresql': (9, 5), 'sqlite': (3, 24), 'mysql': ()}
+
+
+def _server_version(connection):
+    if connection.vendor == 'postgresql':
+        version = connection.pg_version
+        return (version // 10000, version // 100 % 100)
+    if connection.vendor == 'sqlite':
+        import sqlite3
+        return sqlite3.sqlite_version_info
+    return ()
+
+
+def _atomic(using):
+    # transaction.atomic only exists from Django 1.6
+    if hasattr(transaction, 'atomic'):
+        return transaction.atomic(using=using)
+    return transaction.commit_on_success(using=using)
+
+
+def _get_upsert_sql(connection, model, fields, unique_fields, row_count):
+    vendor = connection.vendor
+    if vendor not in _upsert_backends or _server_version(connection) < _upsert_backends[vendor]:
+        return None
+
+    qn = connection.ops.quote_name
+    opts = model._meta
+    columns = [qn(opts.get_field(f).column) for f in fields]
+    row = '(%s)' % ', '.join(['%s'] * len(fields))
+    sql = 'INSERT INTO %s (%s) VALUES %s' % (qn(opts.db_table), ', '.join(columns), ', '.join([row] * row_count))
+
+    updated = [c for f, c in zip(fields, columns) if f not in unique_fields]
+    if vendor == 'mysql':
+        return '%s ON DUPLICATE KEY UPDATE %s' % (sql, ', '.join('%s = VALUES(%s)' % (c, c) for c in updated))
+    unique_columns = [qn(opts.get_field(f).column) for f in unique_fields]
+    return '%s ON CONFLICT (%s) DO UPDATE SET %s' % (sql, ', '.join(unique_columns),
+                                                     ', '.join('%s = EXCLUDED.%s' % (c, c) for c in updated))
+
+
+def _upsert(model, unique_fields, rows):
+    """
+    Inserts the rows (dicts of field name to value), or updates the existing
+    rows with the same values for `unique_fields`. This is a single statement
+    on backends which support it, otherwise an UPDATE followed by an INSERT
+    for each row if there was nothing to update.
+    """
+    using = router.db_for_write(model)
+    connection = connections[using]
+    opts = model._meta
+    fields = sorted(rows[0])
+
+    sql = _get_upsert_sql(connection, model, fields, unique_fields, len(rows))
+    if sql is not None:
+        params = []
+        for row in rows:
+            params.extend(opts.get_field(f).get_db_prep_save(row[f], connection) for f in fields)
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        if not hasattr(transaction, 'atomic'):
+            transaction.commit_unless_managed(using=using)
+        return
+
+    for row in rows:
+        # the base manager is used so that expired state is updated rather
+        # than causing a duplicate key error
+        existing = model._base_manager.using(using).filter(**dict((f, row[f]) for f in unique_fields))
+        values = dict((f, v) for f, v in row.iteritems() if f not in unique_fields)
+        if existing.update(**values):
+            continue
+        try:
+            with _atomic(using):
+                obj = model(**dict((opts.get_field(f).attname, v) for f, v in row.iteritems()))
+                obj.save(force_insert=True, using=using)
+        except IntegrityError:
+            # another request created it in the meantime
+            existing.update(**values)
+
+
+def _state_row(task_id, state, now, timeout, version, bound_to):
+    return {'task_id': task_id, 'state': state, 'last_access': now,
+            'expires': now + timedelta(seconds=timeout), 'version': version, 'bound_to': bound_to}
+
+
+# the columns read for the state of a task, and those of its keys, which
+# are only joined when FLOWS_DJANGO_STATE_STORE_PER_KEY is set
+_STATE_FIELDS = ('pk', 'last_access', 'expires', 'version', 'state')
+_VALUE_FIELDS = ('state_values__key', 'state_values__value')
+
+
+def _state_fields(per_key):
+    return _STATE_FIELDS + _VALUE_FIELDS if per_key else _STATE_FIELDS
+
+
+def _default_cutoff(now):
+    # state written before tasks had their own expiry time
+    return now - timedelta(seconds=config.FLOWS_TASK_IDLE_TIMEOUT)
+
 
 class StateModelManager(models.Manager):
     def get_query_set(self):
-        timeout = timezone.now() - timedelta(seconds=config.FLOWS_TASK_IDLE_TIMEOUT)
-        return super(StateModelManager, self).get_query_set().filter( last_access__gte=timeout )
+        now = timezone.now()
+        live = Q(expires__gte=now) | Q(expires__isnull=True, last_access__gte=_default_cutoff(now))
+        return super(StateModelManager, self).get_query_set().filter(live)
+
+    def _expired(self, now):
+        return Q(expires__lt=now) | Q(expires__isnull=True, last_access__lt=_default_cutoff(now))
 
-    def remove_expired_state(self):
-        timeout = config.FLOWS_TASK_IDLE_TIMEOUT
-        cutoff = timezone.now() - timedelta(seconds=timeout)
+    def remove_expired_state(self, chunk_size=None, max_rows=None, max_seconds=None, progress=None):
+        """
+        Deletes expired state a chunk of tasks at a time, in order of primary
+        key, so that the table is never locked for long. Each chunk is
+        committed separately, and the run stops once `max_rows` tasks have
+        been deleted or `max_seconds` have passed, leaving the rest for the
+        next run. Budgets default to the FLOWS_DJANGO_STATE_STORE_CLEANUP_*
+        settings. `progress` is called with the number of tasks deleted so
+        far after each chunk. Returns the number of tasks deleted.
+        """
+        if chunk_size is None:
+            chunk_size = config.FLOWS_DJANGO_STATE_STORE_CLEANUP_CHUNK_SIZE
+        if max_rows is None:
+            max_rows = config.FLOWS_DJANGO_STATE_STORE_CLEANUP_MAX_ROWS
+        if max_seconds is None:
+            max_seconds = config.FLOWS_DJANGO_STATE_STORE_CLEANUP_MAX_SECONDS
+
+        expired = self._expired(timezone.now())
+        using = router.db_for_write(self.model)
+        started = time.time()
+        count = 0
+        last_pk = 0
+
+        while True:
+            if max_rows is not None:
+                if count >= max_rows:
+                    break
+                chunk_size = min(chunk_size, max_rows - count)
+            if max_seconds is not None and time.time() - started >= max_seconds:
+                break
+
+            pks = list(self._all().filter(expired, pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+            if not pks:
+                return count
+            last_pk = pks[-1]
+            with _atomic(using):
+                # the task may have been used since it was selected
+                deleted = self._all().filter(expired, pk__in=pks)
+                count += deleted.count()
+                deleted.delete()
+            if progress is not None:
+                progress(count)
+
+        logger.info('Stopped removing expired state after %d tasks; the rest will be removed by the next run' % count)
+        return count
 
+    def _all(self):
         # directly call the superclass's queryset method because
         # in our own we filter out expired state!
-        qs = super(StateModelManager, self).get_query_set()
+        return super(StateModelManager, self).get_query_set()
 
-        expired = qs.filter(last_access__lte=cutoff)
-        count = expired.count()
-        expired.delete()
-        return count
+    def upsert(self, task_id, state, timeout, version, bound_to=None):
+        """
+        Creates or replaces the state for a task, marking it as accessed now
+        and setting it to expire once it has been idle for `timeout` seconds.
+        The binder value the task is bound to is kept unless one is given.
+        """
+        row = _state_row(task_id, state, timezone.now(), timeout, version, bound_to)
+        if bound_to is None:
+            del row['bound_to']
+        _upsert(self.model, ('task_id',), [row])
+
+    def update_if_version(self, task_id, state, timeout, version):
+        """
+        Replaces the state for a task with `version`, but only if the stored
+        version is the one before, and raises StateConflict otherwise. The
+        version is checked by the UPDATE itself, so two requests can never
+        both succeed.
+        """
+        now = timezone.now()
+        updated = self.filter(task_id=task_id, version=version - 1).update(
+            state=state, version=version, last_access=now, expires=now + timedelta(seconds=timeout))
+        if not updated:
+            raise StateConflict
 
 
 class StateModel(models.Model):
@@ -35,28 +212,305 @@ class StateModel(models.Model):
     task_id = models.CharField(max_length=32, unique=True)
     state = models.TextField(null=True)
 
-    last_access = models.DateTimeField(auto_now_add=True)
+    last_access = models.DateTimeField(auto_now_add=True, db_index=True)
+    # when the task expires unless it is used again, which depends on the
+    # idle timeout of its flow
+    expires = models.DateTimeField(null=True, db_index=True)
+    # increased by every write, so that a request does not overwrite
+    # changes made by another since it loaded the state
+    version = models.IntegerField(default=0)
+    # the binder value the task is bound to, so that the tasks of each can
+    # be found without decoding every state
+    bound_to = models.CharField(max_length=255, null=True, db_index=True)
 
     def __unicode__(self):
         return 'State for task %s' % self.task_id
+
+
+class StateValueModel(models.Model):
+    """
+    A single key of the state of a task, used instead of `StateModel.state`
+    when FLOWS_DJANGO_STATE_STORE_PER_KEY is set.
+    """
+
+    class Meta:
+        app_label = 'flows'
+        unique_together = ('task', 'key')
+
+    task = models.ForeignKey(StateModel, to_field='task_id', related_name='state_values')
+    key = models.CharField(max_length=255)
+    value = models.TextField()
+
+    def __unicode__(self):
+        return '%s for task %s' % (self.key, self.task_id)
+
+
+class StateLeaseModel(models.Model):
+    """
+    The lease on a task, keyed by the task ID, or the result of the request
+    which held it, keyed by the task ID and the request's key. Rows are used
+    rather than database locks so that leases work the same on every
+    backend, and outlive the transaction of the request taking them. The
+    number of tasks each binder value created in the current period is
+    kept here too, keyed by a hash of the value and the period.
+    """
+
+    class Meta:
+        app_label = 'flows'
+
+    key = models.CharField(max_length=100, unique=True)
+    value = models.TextField()
+    expires = models.DateTimeField(db_index=True)
+
+    def __unicode__(self):
+        return 'Lease %s' % self.key
     
 
 class StateStore(StateStoreBase):
     
+    supports_leases = True
+    
+    def __init__(self):
+        # primary key -> idle timeout of the tasks to touch
+        self._pending_touches = {}
+        self._touch_lock = threading.Lock()
+        self._last_flush = time.time()
+        # a worker which goes idle would otherwise keep its touches until
+        # its next request, by which time the tasks may have expired
+        request_finished.connect(self._request_finished)
+    
+    def _request_finished(self, sender, **kwargs):
+        self.flush_touches()
+    
     def get_state(self, task_id):
-        try:
-            state_model = StateModel.objects.get(task_id=task_id)
-        except StateModel.DoesNotExist:
+        # with per-key storage, the state can be in the state column or in
+        # StateValueModels, so both are fetched at once
+        per_key = config.FLOWS_DJANGO_STATE_STORE_PER_KEY
+        rows = list(StateModel.objects.filter(task_id=task_id).values_list(*_state_fields(per_key)))
+        if not rows:
             raise StateNotFound
+        if rows[0][4] is None and not per_key:
+            # written while FLOWS_DJANGO_STATE_STORE_PER_KEY was set
+            rows = list(StateModel.objects.filter(task_id=task_id).values_list(*_state_fields(True)))
+        
+        # only record the access if the previous one is old enough to
+        # matter, to avoid a write on every single read
+        pk, last_access, expires = rows[0][:3]
+        now = timezone.now()
+        interval = timedelta(seconds=config.FLOWS_DJANGO_STATE_STORE_TOUCH_INTERVAL)
+        if last_access < now - interval:
+            if expires is None:
+                timeout = timedelta(seconds=config.FLOWS_TASK_IDLE_TIMEOUT)
+            else:
+                timeout = expires - last_access
+            self._touch(pk, now, timeout)
+        
+        return self._state_from_rows(rows)
+    
+    def _state_from_rows(self, rows):
+        # rows of (pk, last_access, expires, version, state) for a single
+        # task, followed by (key, value) if it has no state column
+        version, data = rows[0][3:5]
+        if data is not None:
+            state = self._deserialise(data)
         else:
-            state_model.last_access = timezone.now()
-            state_model.save()
-            return self._deserialise(state_model.state)
+            values = dict((key, base64.b64decode(value)) for _, _, _, _, _, key, value in rows if key is not None)
+            state = self._decode_values(values)
+        self._saved(state, version)
+        return state
+    
+    def _states_from_rows(self, rows):
+        # as above, but the rows for several tasks, each starting with the
+        # task ID, and with the rows for each task together
+        for task_id, task_rows in groupby(rows, itemgetter(0)):
+            yield task_id, self._state_from_rows([row[1:] for row in task_rows])
+    
+    def _touch(self, pk, now, timeout):
+        if not config.FLOWS_DJANGO_STATE_STORE_BATCH_TOUCHES:
+            StateModel.objects.filter(pk=pk).update(last_access=now, expires=now + timeout)
+            return
+        
+        with self._touch_lock:
+            self._pending_touches[pk] = timeout
+            due = time.time() - self._last_flush >= config.FLOWS_DJANGO_STATE_STORE_TOUCH_INTERVAL
+        if due:
+            self.flush_touches()
+    
+    def flush_touches(self):
+        """
+        Records the access time of all tasks read since the last flush in
+        a single query. This happens automatically at the end of each
+        request when batching touches, but can be called directly, for
+        example at the end of a job.
+        """
+        with self._touch_lock:
+            touches = self._pending_touches
+            self._pending_touches = {}
+            self._last_flush = time.time()
+        if not touches:
+            return
+        # one query for each idle timeout, of which there are only a few
+        by_timeout = {}
+        for pk, timeout in touches.iteritems():
+            by_timeout.setdefault(timeout, []).append(pk)
+        now = timezone.now()
+        for timeout, pks in by_timeout.iteritems():
+            # the default manager ignores expired state, so a task which
+            # expired while waiting to be flushed will not be revived
+            StateModel.objects.filter(pk__in=pks).update(last_access=now, expires=now + timeout)
         
     def put_state(self, task_id, state):
-        state_model, _ = StateModel.objects.get_or_create(task_id=task_id)
-        state_model.state = self._serialise(state)
-        state_model.save()
+        version = self._next_version(state)
+        bound_to = self._get_bound_to(state)
+        if config.FLOWS_DJANGO_STATE_STORE_PER_KEY:
+            self._put_values(task_id, self._encode_values(state), None, self._get_idle_timeout(state), version,
+                             bound_to=bound_to)
+        else:
+            StateModel.objects.upsert(task_id, self._serialise(state), self._get_idle_timeout(state), version,
+                                      bound_to)
+        self._saved(state, version)
+    
+    def _put_if_version(self, task_id, state, version):
+        StateModel.objects.update_if_version(task_id, self._serialise(state), self._get_idle_timeout(state),
+                                             version + 1)
+        self._saved(state, version + 1)
+    
+    def update_state(self, task_id, state):
+        if config.FLOWS_DJANGO_STATE_STORE_PER_KEY:
+            self._update_values(task_id, state)
+        else:
+            super(StateStore, self).update_state(task_id, state)
+    
+    def _put_values(self, task_id, values, removed, timeout, version, check_version=False, bound_to=None):
+        rows = [{'task': task_id, 'key': key, 'value': base64.b64encode(data)}
+                for key, data in values.iteritems()]
+        # the version is checked first, so that nothing is written if
+        # another request got there before; the row stays locked until the
+        # values are written, so the version never changes without them
+        with _atomic(router.db_for_write(StateModel)):
+            if check_version:
+                StateModel.objects.update_if_version(task_id, None, timeout, version)
+            else:
+                StateModel.objects.upsert(task_id, None, timeout, version, bound_to)
+            if removed is None:
+                StateValueModel.objects.filter(task=task_id).delete()
+                StateValueModel.objects.bulk_create([StateValueModel(task_id=row['task'], key=row['key'],
+                                                                     value=row['value'])
+                                                     for row in rows])
+                return
+            if removed:
+                StateValueModel.objects.filter(task=task_id, key__in=removed).delete()
+            if rows:
+                _upsert(StateValueModel, ('task', 'key'), rows)
         
     def delete_state(self, task_id):
-        StateModel.objects.filter(task_id=task_id).delete()
\ No newline at end of file
+        StateModel.objects.filter(task_id=task_id).delete()
+    
+    def remove_expired_state(self, progress=None):
+        StateLeaseModel.objects.filter(expires__lt=timezone.now()).delete()
+        return StateModel.objects.remove_expired_state(progress=progress)
+    
+    def acquire_lease(self, task_id, token, timeout):
+        now = timezone.now()
+        expires = now + timedelta(seconds=timeout)
+        # take over an expired lease, or else create one
+        if StateLeaseModel.objects.filter(key=task_id, expires__lt=now).update(value=token, expires=expires):
+            return True
+        using = router.db_for_write(StateLeaseModel)
+        try:
+            with _atomic(using):
+                StateLeaseModel.objects.using(using).create(key=task_id, value=token, expires=expires)
+        except IntegrityError:
+            # another request holds it
+            return False
+        return True
+    
+    def release_lease(self, task_id, token):
+        StateLeaseModel.objects.filter(key=task_id, value=token).delete()
+    
+    def set_lease_result(self, task_id, key, result, timeout):
+        expires = timezone.now() + timedelta(seconds=timeout)
+        _upsert(StateLeaseModel, ('key',), [{'key': '%s:%s' % (task_id, key), 'value': result, 'expires': expires}])
+    
+    def get_lease_result(self, task_id, key):
+        results = StateLeaseModel.objects.filter(key='%s:%s' % (task_id, key), expires__gte=timezone.now())
+        for result in results.values_list('value', flat=True):
+            return result
+        return None
+    
+    def get_binder_tasks(self, bound_to):
+        # in the order they were created, since writes keep the primary key
+        return list(StateModel.objects.filter(bound_to=bound_to).order_by('pk').values_list('task_id', flat=True))
+    
+    def count_created(self, bound_to, period):
+        number = int(time.time() // period)
+        key = 'created:%s:%d' % (hashlib.sha1(unicode(bound_to).encode('utf-8')).hexdigest(), number)
+        expires = timezone.now() + timedelta(seconds=period)
+        using = router.db_for_write(StateLeaseModel)
+        while True:
+            counts = list(StateLeaseModel.objects.filter(key=key).values_list('value', flat=True))
+            if counts:
+                count = int(counts[0]) + 1
+                # the count is only changed if no other request changed it first
+                if StateLeaseModel.objects.filter(key=key, value=counts[0]).update(value=str(count)):
+                    return count
+                continue
+            try:
+                with _atomic(using):
+                    StateLeaseModel.objects.using(using).create(key=key, value='1', expires=expires)
+                return 1
+            except IntegrityError:
+                # another request created it in the meantime
+                pass
+    
+    def _get_rows(self, queryset):
+        per_key = config.FLOWS_DJANGO_STATE_STORE_PER_KEY
+        rows = list(queryset.order_by('pk').values_list('task_id', *_state_fields(per_key)))
+        if not per_key:
+            # tasks written while FLOWS_DJANGO_STATE_STORE_PER_KEY was set
+            stored_per_key = [row[0] for row in rows if row[5] is None]
+            if stored_per_key:
+                rows = [row for row in rows if row[5] is not None]
+                rows += StateModel.objects.filter(task_id__in=stored_per_key).order_by('pk').values_list(
+                            'task_id', *_state_fields(True))
+        return rows
+    
+    def get_many(self, task_ids):
+        task_ids = list(task_ids)
+        states = {}
+        for start in range(0, len(task_ids), self.chunk_size):
+            chunk = task_ids[start:start + self.chunk_size]
+            rows = self._get_rows(StateModel.objects.filter(task_id__in=chunk))
+            states.update(self._states_from_rows(rows))
+        return states
+    
+    def put_many(self, states):
+        if config.FLOWS_DJANGO_STATE_STORE_PER_KEY:
+            super(StateStore, self).put_many(states)
+            return
+        now = timezone.now()
+        rows = [_state_row(task_id, self._serialise(state), now, self._get_idle_timeout(state),
+                           self._next_version(state), self._get_bound_to(state))
+                for task_id, state in states.iteritems()]
+        for start in range(0, len(rows), self.chunk_size):
+            _upsert(StateModel, ('task_id',), rows[start:start + self.chunk_size])
+        for row in rows:
+            self._saved(states[row['task_id']], row['version'])
+    
+    def delete_many(self, task_ids):
+        task_ids = list(task_ids)
+        for start in range(0, len(task_ids), self.chunk_size):
+            StateModel.objects.filter(task_id__in=task_ids[start:start + self.chunk_size]).delete()
+    
+    def iter_states(self):
+        # go through the tasks in order of primary key, a chunk at a time,
+        # rather than holding a cursor open for the whole time
+        last_pk = 0
+        while True:
+            pks = list(StateModel.objects.filter(pk__gt=last_pk).order_by('pk')
+                                         .values_list('pk', flat=True)[:self.chunk_size])
+            if not pks:
+                return
+            last_pk = pks[-1]
+            for task_id_and_state in self._states_from_rows(self._get_rows(StateModel.objects.filter(pk__in=pks))):
+                yield task_id_and_state
\ No newline at end of file
@@ -0,0 +1,48 @@
+"""
+A consistent hash ring, which spreads keys over a number of nodes such that
+adding or removing a node only moves the keys of that one node.
+"""
+from bisect import bisect
+import hashlib
+import struct
+
+
+_POINT = struct.Struct('>I')
+
+
+def _hash(value):
+    return _POINT.unpack_from(hashlib.md5(value).digest())[0]
+
+
+class HashRing(object):
+    """
+    Each node is placed at `replicas` pseudo-random points around the ring,
+    and a key belongs to the node at the first point after the key's hash.
+    Nodes are identified by name, so the order in which they are given
+    does not matter.
+    """
+
+    def __init__(self, nodes, replicas=160):
+        """
+        `nodes` is a dict of node name to node.
+        """
+        if not nodes:
+            raise ValueError('A hash ring needs at least one node')
+        points = []
+        for name, node in nodes.iteritems():
+            for i in range(replicas):
+                points.append((_hash('%s-%s' % (name, i)), name))
+        points.sort()
+        self._points = [point for point, _ in points]
+        self._names = [name for _, name in points]
+        self._nodes = dict(nodes)
+
+    def get_name(self, key):
+        index = bisect(self._points, _hash(key)) % len(self._points)
+        return self._names[index]
+
+    def get_node(self, key):
+        return self._nodes[self.get_name(key)]
+
+    def get_nodes(self):
+        return self._nodes.values()
@@ -0,0 +1,188 @@
+"""
+Keeps task state in the memory of the current process. State is lost when
+the process exits and is not shared between processes, so this is only
+suitable for single process deployments, tests and benchmarks.
+"""
+from collections import OrderedDict
+from flows import config
+from flows.statestore.base import StateStoreBase, StateNotFound, StateConflict
+import threading
+import time
+
+
+class StateStore(StateStoreBase):
+
+    supports_leases = True
+
+    def __init__(self):
+        # task ID -> (encoded state, last access time, idle timeout, version),
+        # least recently used first
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        # lease or lease result key -> (value, expiry time)
+        self._leases = {}
+        # binder value -> task IDs, oldest first, and task ID -> binder value
+        self._binder_tasks = {}
+        self._task_binders = {}
+        # binder value -> (period number, tasks created in it)
+        self._created = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._size,
+                    'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'expirations': self.expirations}
+
+    def _remove(self, task_id):
+        data = self._entries.pop(task_id)[0]
+        self._size -= len(data)
+        bound_to = self._task_binders.pop(task_id, None)
+        if bound_to is not None:
+            task_ids = self._binder_tasks[bound_to]
+            del task_ids[task_id]
+            if not task_ids:
+                del self._binder_tasks[bound_to]
+
+    def _evict(self, now):
+        # entries are in order of last access, so expired ones are mostly
+        # first; any behind a task with a longer idle timeout are removed
+        # when they are read, or when they reach the front
+        while self._entries:
+            task_id, (_, last_access, timeout, _) = next(self._entries.iteritems())
+            if last_access + timeout >= now:
+                break
+            self._remove(task_id)
+            self.expirations += 1
+
+        max_entries = config.FLOWS_MEMORY_STATE_STORE_MAX_ENTRIES
+        max_bytes = config.FLOWS_MEMORY_STATE_STORE_MAX_BYTES
+        while self._entries and ((max_entries is not None and len(self._entries) > max_entries) or
+                                 (max_bytes is not None and self._size > max_bytes)):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def get_state(self, task_id):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(task_id)
+            if entry is not None and entry[1] + entry[2] < now:
+                self._remove(task_id)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                raise StateNotFound
+            # re-insert to mark it as the most recently used
+            del self._entries[task_id]
+            self._entries[task_id] = (entry[0], now, entry[2], entry[3])
+            self.hits += 1
+        state = self._decode(entry[0])
+        self._saved(state, entry[3])
+        return state
+
+    def put_state(self, task_id, state):
+        self._put(task_id, state, self._next_version(state))
+
+    def _put_if_version(self, task_id, state, version):
+        self._put(task_id, state, version + 1, check_version=True)
+
+    def _put(self, task_id, state, version, check_version=False):
+        data = self._encode(state)
+        timeout = self._get_idle_timeout(state)
+        bound_to = self._get_bound_to(state)
+        now = time.time()
+        with self._lock:
+            if check_version:
+                entry = self._entries.get(task_id)
+                if entry is None or entry[1] + entry[2] < now or entry[3] != version - 1:
+                    raise StateConflict
+            if task_id in self._entries:
+                # the task keeps its place in the index of its binder value
+                self._size -= len(self._entries.pop(task_id)[0])
+            self._entries[task_id] = (data, now, timeout, version)
+            self._size += len(data)
+            if bound_to is not None and task_id not in self._task_binders:
+                self._task_binders[task_id] = bound_to
+                self._binder_tasks.setdefault(bound_to, OrderedDict())[task_id] = None
+            self._evict(now)
+        self._saved(state, version)
+
+    def delete_state(self, task_id):
+        with self._lock:
+            if task_id in self._entries:
+                self._remove(task_id)
+
+    def acquire_lease(self, task_id, token, timeout):
+        now = time.time()
+        with self._lock:
+            lease = self._leases.get(task_id)
+            if lease is not None and lease[1] >= now:
+                return False
+            self._leases[task_id] = (token, now + timeout)
+            return True
+
+    def release_lease(self, task_id, token):
+        with self._lock:
+            lease = self._leases.get(task_id)
+            if lease is not None and lease[0] == token:
+                del self._leases[task_id]
+
+    def set_lease_result(self, task_id, key, result, timeout):
+        now = time.time()
+        with self._lock:
+            # results are only ever kept briefly, so expired ones are
+            # removed whenever a new one is added
+            for lease_key, (_, expires) in self._leases.items():
+                if expires < now:
+                    del self._leases[lease_key]
+            self._leases[task_id, key] = (result, now + timeout)
+
+    def get_lease_result(self, task_id, key):
+        with self._lock:
+            result = self._leases.get((task_id, key))
+        if result is None or result[1] < time.time():
+            return None
+        return result[0]
+
+    def get_binder_tasks(self, bound_to):
+        now = time.time()
+        with self._lock:
+            task_ids = list(self._binder_tasks.get(bound_to, ()))
+            return [task_id for task_id in task_ids
+                    if self._entries[task_id][1] + self._entries[task_id][2] >= now]
+
+    def count_created(self, bound_to, period):
+        number = int(time.time() // period)
+        with self._lock:
+            if bound_to not in self._created:
+                # counts from earlier periods are no longer needed
+                for key, (created_in, _) in self._created.items():
+                    if created_in != number:
+                        del self._created[key]
+            created_in, count = self._created.get(bound_to, (number, 0))
+            if created_in != number:
+                count = 0
+            self._created[bound_to] = (number, count + 1)
+            return count + 1
+
+    def _get_data(self, task_ids):
+        # reads the encoded state without counting it as a use of the tasks
+        now = time.time()
+        with self._lock:
+            entries = [(task_id, self._entries.get(task_id)) for task_id in task_ids]
+        return [(task_id, entry[0]) for task_id, entry in entries
+                if entry is not None and entry[1] + entry[2] >= now]
+
+    def get_many(self, task_ids):
+        return dict((task_id, self._decode(data)) for task_id, data in self._get_data(task_ids))
+
+    def iter_states(self):
+        with self._lock:
+            task_ids = list(self._entries)
+        for task_id, data in self._get_data(task_ids):
+            yield task_id, self._decode(data)
@@ -1,6 +1,10 @@
+from contextlib import contextmanager
 from django.core.exceptions import ImproperlyConfigured
-from flows.statestore.base import StateStoreBase, StateNotFound
+from flows.statestore.base import StateStoreBase, StateNotFound, StateConflict
 from flows import config
+import os
+import threading
+import time
 
 try:
     import redis
@@ -8,30 +12,451 @@ except ImportError:
     raise ImproperlyConfigured('The "redis" python client package is required to use Redis as a task state store - get it here http://pypi.python.org/pypi/redis/')
 
 
+# Writes the commands in ARGV only if the version of the task in KEYS[1]
+# is still ARGV[1], then stores the new version ARGV[2], expiring after
+# ARGV[3] seconds. The commands follow as the number of arguments of each
+# and then the arguments themselves. A missing version counts as 0.
+_WRITE_IF_VERSION = '''
+local unpack = table.unpack or unpack
+local current = redis.call('GET', KEYS[1])
+if (current or '0') ~= ARGV[1] then
+    return 0
+end
+local i = 4
+while i <= #ARGV do
+    local n = tonumber(ARGV[i])
+    redis.call(unpack(ARGV, i + 1, i + n))
+    i = i + n + 1
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+'''
+
+
+# Deletes the lease in KEYS[1] only if it is still held with the token in
+# ARGV[1], so that a request whose lease expired cannot release another's.
+_RELEASE_LEASE = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+'''
+
+
+# Sets the key in KEYS[1] to expire after ARGV[1] seconds, unless it is
+# already set to expire later.
+_EXTEND_EXPIRY = '''
+if redis.call('TTL', KEYS[1]) < tonumber(ARGV[1]) then
+    return redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return 0
+'''
+
+
+def _version_key(task_id):
+    return task_id + ':version'
+
+
+def _lease_key(task_id):
+    return task_id + ':lease'
+
+
+def _binder_key(bound_to):
+    # a sorted set of the tasks bound to the value, scored by when they
+    # were created
+    return 'binder:%s' % bound_to
+
+
+_clients = {}
+_clients_pid = None
+_clients_lock = threading.Lock()
+
+
+def get_client(**settings):
+    """
+    Returns a redis client for the given connection settings which is
+    shared by the whole process, so that connections are pooled rather
+    than opened for every request. Clients are created lazily, and are
+    recreated after a fork so that child processes of pre-forking servers
+    never share sockets with their parent.
+    """
+    global _clients_pid
+    key = tuple(sorted(settings.items()))
+    pid = os.getpid()
+
+    client = _clients.get(key) if _clients_pid == pid else None
+    if client is None:
+        with _clients_lock:
+            if _clients_pid != pid:
+                # the parent's connections are simply forgotten rather than
+                # closed, since closing them would affect the parent too
+                _clients.clear()
+                _clients_pid = pid
+            client = _clients.get(key)
+            if client is None:
+                client = redis.Redis(connection_pool=redis.ConnectionPool(**settings))
+                _clients[key] = client
+    return client
+
+
 class StateStore(StateStoreBase):
+
+    supports_leases = True
+    
+    def __init__(self):
+        self._local = threading.local()
     
     def _get_settings(self):
         host = config.FLOWS_REDIS_STATE_STORE_HOST
         password = config.FLOWS_REDIS_STATE_STORE_PASSWORD
         port = config.FLOWS_REDIS_STATE_STORE_PORT
         db_id = config.FLOWS_REDIS_STATE_STORE_DB
+        max_connections = config.FLOWS_REDIS_STATE_STORE_MAX_CONNECTIONS
 
-        return {'host': host, 'port': port,
-                'password': password, 'db': db_id }
+        settings = {'host': host, 'port': port,
+                    'password': password, 'db': db_id,
+                    'max_connections': max_connections }
+
+        # only pass the timeouts if they are set, as older clients do not
+        # support socket_connect_timeout
+        if config.FLOWS_REDIS_STATE_STORE_SOCKET_TIMEOUT is not None:
+            settings['socket_timeout'] = config.FLOWS_REDIS_STATE_STORE_SOCKET_TIMEOUT
+        if config.FLOWS_REDIS_STATE_STORE_SOCKET_CONNECT_TIMEOUT is not None:
+            settings['socket_connect_timeout'] = config.FLOWS_REDIS_STATE_STORE_SOCKET_CONNECT_TIMEOUT
+
+        return settings
     
-    def _get_db(self):
-        return redis.Redis(**self._get_settings())
+    def _get_db(self, task_id=None):
+        """
+        Returns the client for the redis server holding the given task.
+        """
+        return get_client(**self._get_settings())
+    
+    def _get_dbs(self):
+        """
+        Returns the clients for all of the redis servers holding tasks.
+        """
+        return [self._get_db()]
+    
+    @contextmanager
+    def batch(self):
+        if self._get_pending() is not None:
+            # already batching - the outermost block will send the writes
+            yield
+            return
+
+        self._local.pending = pending = {}
+        try:
+            yield
+        finally:
+            self._local.pending = None
+        self._send(pending)
+    
+    def _get_pending(self):
+        return getattr(self._local, 'pending', None)
+    
+    def _send(self, writes):
+        # one pipeline for each server the tasks are held on
+        pipes = {}
+        for task_id, commands in writes.iteritems():
+            db = self._get_db(task_id)
+            pipe = pipes.get(id(db))
+            if pipe is None:
+                pipe = pipes[id(db)] = db.pipeline(transaction=False)
+            for name, args in commands:
+                getattr(pipe, name)(*args)
+        for pipe in pipes.itervalues():
+            pipe.execute()
+    
+    def _write(self, task_id, commands, replace=True):
+        """
+        Sends the commands which write the state of a task, or queues them
+        until the end of the batch. Unless `replace` is False, they replace
+        any writes already queued for the task.
+        """
+        pending = self._get_pending()
+        if pending is None:
+            self._send({task_id: commands})
+        elif replace or task_id not in pending:
+            pending[task_id] = commands
+        else:
+            pending[task_id] = pending[task_id] + commands
     
     def get_state(self, task_id):
-        data = self._get_db().get(task_id)
+        pending = self._get_pending()
+        if pending is not None and task_id in pending:
+            # make sure we read our own writes
+            self._send({task_id: pending.pop(task_id)})
+
+        # fetch the state and refresh its expiry in a single round trip,
+        # so that the idle timeout is measured from the last read too
+        per_key = config.FLOWS_REDIS_STATE_STORE_PER_KEY
+        data = self._read(task_id, per_key)
+        if isinstance(data, redis.ResponseError):
+            # the state was written with the other setting for per-key
+            # storage, and so has a different type in redis
+            data = self._read(task_id, not per_key)
+
+        data, version = data
         if not data:
             raise StateNotFound
-        return self._deserialise(data)
+        if isinstance(data, dict):
+            state = self._decode_values(data)
+        else:
+            state = self._decode(data)
+        self._saved(state, int(version or 0))
+
+        # the read restarted the default timeout, so tasks of flows with
+        # their own are set back to it along with the other writes
+        timeout = self._get_idle_timeout(state)
+        if timeout != config.FLOWS_TASK_IDLE_TIMEOUT:
+            self._write(task_id, [('expire', (task_id, timeout)),
+                                  ('expire', (_version_key(task_id), timeout))], replace=False)
+        return state
+    
+    def _read(self, task_id, per_key):
+        # returns the state and its version, or the error if the state has
+        # the wrong type
+        version_key = _version_key(task_id)
+        pipe = self._get_db(task_id).pipeline(transaction=False)
+        if per_key:
+            pipe.hgetall(task_id)
+        else:
+            pipe.get(task_id)
+        pipe.get(version_key)
+        pipe.expire(task_id, config.FLOWS_TASK_IDLE_TIMEOUT)
+        pipe.expire(version_key, config.FLOWS_TASK_IDLE_TIMEOUT)
+        data, version = pipe.execute(raise_on_error=False)[:2]
+        if isinstance(data, redis.ResponseError):
+            return data
+        return data, version
     
     def put_state(self, task_id, state):
-        ttl = config.FLOWS_TASK_IDLE_TIMEOUT
-        data = self._serialise(state)
-        self._get_db().setex(task_id, data, ttl)
+        version = self._next_version(state)
+        timeout = self._get_idle_timeout(state)
+        if config.FLOWS_REDIS_STATE_STORE_PER_KEY:
+            self._put_values(task_id, self._encode_values(state), None, timeout, version)
+        else:
+            data = self._encode(state)
+            self._write(task_id, [('set', (task_id, data, timeout)),
+                                  ('set', (_version_key(task_id), version, timeout))])
+        self._index(task_id, state, timeout)
+        self._saved(state, version)
+    
+    def _index(self, task_id, state, timeout):
+        """
+        Adds the task to the index of its binder value, if it is not there
+        already. The index is kept for as long as the tasks written to it,
+        and tasks which have since expired are removed when it is read.
+        """
+        bound_to = self._get_bound_to(state)
+        if bound_to is None:
+            return
+        key = _binder_key(bound_to)
+        self._write(key, [('execute_command', ('ZADD', key, 'NX', '%.6f' % time.time(), task_id)),
+                          ('execute_command', ('EVAL', _EXTEND_EXPIRY, 1, key, timeout))], replace=False)
+    
+    def _put_if_version(self, task_id, state, version):
+        timeout = self._get_idle_timeout(state)
+        self._write_if_version(task_id, version + 1, timeout, [('SET', task_id, self._encode(state), 'EX', timeout)])
+        self._index(task_id, state, timeout)
+        self._saved(state, version + 1)
+    
+    def _write_if_version(self, task_id, version, timeout, commands):
+        """
+        Runs the redis `commands` for a task, along with storing its new
+        `version`, in a single script which checks the version first, so
+        that nothing can change between the check and the writes. These
+        are never batched, since the caller needs to know at once if there
+        was a conflict.
+        """
+        pending = self._get_pending()
+        if pending is not None and task_id in pending:
+            # earlier writes for the task must happen first
+            self._send({task_id: pending.pop(task_id)})
+
+        args = [version - 1, version, timeout]
+        for command in commands:
+            args.append(len(command))
+            args.extend(command)
+        db = self._get_db(task_id)
+        if not db.register_script(_WRITE_IF_VERSION)(keys=[_version_key(task_id)], args=args):
+            raise StateConflict
+    
+    def update_state(self, task_id, state):
+        if config.FLOWS_REDIS_STATE_STORE_PER_KEY:
+            version = getattr(state, 'version', None)
+            self._update_values(task_id, state)
+            if getattr(state, 'version', None) != version:
+                # something was written, so the index should last as long
+                self._index(task_id, state, self._get_idle_timeout(state))
+        else:
+            super(StateStore, self).update_state(task_id, state)
+    
+    def _put_values(self, task_id, values, removed, timeout, version, check_version=False):
+        if check_version:
+            commands = []
+            if removed is None:
+                commands.append(('DEL', task_id))
+            elif removed:
+                commands.append(('HDEL', task_id) + tuple(removed))
+            if values:
+                commands.append(('HMSET', task_id) + sum(values.iteritems(), ()))
+            commands.append(('EXPIRE', task_id, timeout))
+            self._write_if_version(task_id, version, timeout, commands)
+            return
+
+        commands = []
+        if removed is None:
+            commands.append(('delete', (task_id,)))
+        elif removed:
+            commands.append(('hdel', (task_id,) + tuple(removed)))
+        if values:
+            commands.append(('hmset', (task_id, values)))
+        commands.append(('expire', (task_id, timeout)))
+        commands.append(('set', (_version_key(task_id), version, timeout)))
+        self._write(task_id, commands, replace=removed is None)
 
     def delete_state(self, task_id):
-        self._get_db().delete(task_id)
\ No newline at end of file
+        self._write(task_id, [('delete', (task_id, _version_key(task_id)))])
+    
+    def acquire_lease(self, task_id, token, timeout):
+        db = self._get_db(task_id)
+        if timeout <= 0:
+            # redis will not set a key which has already expired, so there
+            # is nothing to keep, but another request may hold the lease
+            return not db.exists(_lease_key(task_id))
+        return bool(db.set(_lease_key(task_id), token, nx=True, px=int(timeout * 1000)))
+    
+    def release_lease(self, task_id, token):
+        db = self._get_db(task_id)
+        db.register_script(_RELEASE_LEASE)(keys=[_lease_key(task_id)], args=[token])
+    
+    def set_lease_result(self, task_id, key, result, timeout):
+        self._get_db(task_id).set('%s:%s' % (_lease_key(task_id), key), result, px=int(timeout * 1000))
+    
+    def get_lease_result(self, task_id, key):
+        return self._get_db(task_id).get('%s:%s' % (_lease_key(task_id), key))
+    
+    def get_binder_tasks(self, bound_to):
+        key = _binder_key(bound_to)
+        pending = self._get_pending()
+        if pending and key in pending:
+            self._send({key: pending.pop(key)})
+        task_ids = self._get_db(key).zrange(key, 0, -1)
+        if pending:
+            # the tasks must be written before they are checked
+            self._send(dict((task_id, pending.pop(task_id)) for task_id in task_ids if task_id in pending))
+
+        # tasks which have expired or been deleted are still in the index
+        by_db = {}
+        for task_id in task_ids:
+            db = self._get_db(task_id)
+            by_db.setdefault(id(db), (db, []))[1].append(task_id)
+        live = set()
+        for db, db_task_ids in by_db.itervalues():
+            pipe = db.pipeline(transaction=False)
+            for task_id in db_task_ids:
+                pipe.exists(task_id)
+            live.update(task_id for task_id, exists in zip(db_task_ids, pipe.execute()) if exists)
+
+        gone = [task_id for task_id in task_ids if task_id not in live]
+        if gone:
+            self._get_db(key).zrem(key, *gone)
+        return [task_id for task_id in task_ids if task_id in live]
+    
+    def delete_for_binder(self, bound_to):
+        count = super(StateStore, self).delete_for_binder(bound_to)
+        key = _binder_key(bound_to)
+        self._write(key, [('delete', (key,))], replace=False)
+        return count
+    
+    def count_created(self, bound_to, period):
+        key = '%s:created:%d' % (_binder_key(bound_to), time.time() // period)
+        pipe = self._get_db(key).pipeline(transaction=False)
+        pipe.incr(key)
+        pipe.expire(key, int(period))
+        return pipe.execute()[0]
+    
+    def get_many(self, task_ids):
+        pending = self._get_pending()
+        if pending:
+            self._send(dict((task_id, pending.pop(task_id)) for task_id in task_ids if task_id in pending))
+
+        # one pipeline for each server the tasks are held on
+        by_db = {}
+        for task_id in task_ids:
+            db = self._get_db(task_id)
+            by_db.setdefault(id(db), (db, []))[1].append(task_id)
+
+        states = {}
+        for db, db_task_ids in by_db.itervalues():
+            states.update(self._get_many(db, db_task_ids, config.FLOWS_REDIS_STATE_STORE_PER_KEY))
+        return states
+    
+    def _get_many(self, db, task_ids, per_key, retry=True):
+        pipe = db.pipeline(transaction=False)
+        for task_id in task_ids:
+            if per_key:
+                pipe.hgetall(task_id)
+            else:
+                pipe.get(task_id)
+
+        states = {}
+        wrong_type = []
+        for task_id, data in zip(task_ids, pipe.execute(raise_on_error=False)):
+            if isinstance(data, redis.ResponseError):
+                wrong_type.append(task_id)
+            elif isinstance(data, dict) and data:
+                states[task_id] = self._decode_values(data)
+            elif data:
+                states[task_id] = self._decode(data)
+        if wrong_type and retry:
+            # written with the other setting for per-key storage
+            states.update(self._get_many(db, wrong_type, not per_key, retry=False))
+        return states
+    
+    def iter_states(self):
+        # task IDs are 32 hex digits, which tells them apart from other keys
+        # that may be in the same database
+        pattern = '[0-9a-f]' * 32
+        for db in self._get_dbs():
+            task_ids = []
+            for key in db.scan_iter(match=pattern, count=self.chunk_size):
+                task_ids.append(key)
+                if len(task_ids) >= self.chunk_size:
+                    for task_id_and_state in self._get_many(db, task_ids, config.FLOWS_REDIS_STATE_STORE_PER_KEY).iteritems():
+                        yield task_id_and_state
+                    task_ids = []
+            if task_ids:
+                for task_id_and_state in self._get_many(db, task_ids, config.FLOWS_REDIS_STATE_STORE_PER_KEY).iteritems():
+                    yield task_id_and_state
+
+
+class RedisChannel(object):
+    """
+    Sends invalidation messages for `flows.statestore.cached_store` to
+    every process using redis pub/sub. Messages are received by a
+    background thread in each subscribed process.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def subscribe(self, callback):
+        # a dedicated connection is needed to listen for messages
+        pubsub = StateStore()._get_db().pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.name)
+        listener = threading.Thread(target=self._listen, args=(pubsub, callback))
+        listener.daemon = True
+        listener.start()
+
+    def _listen(self, pubsub, callback):
+        for message in pubsub.listen():
+            if message['type'] != 'message':
+                continue
+            task_id, _, version = message['data'].partition(' ')
+            callback(task_id, version or None)
+
+    def publish(self, task_id, version):
+        StateStore()._get_db().publish(self.name, '%s %s' % (task_id, version or ''))
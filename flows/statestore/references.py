@@ -0,0 +1,101 @@
+# -*- coding: UTF-8 -*-
+"""
+Django model instances in task state are stored as a reference to their
+model and primary key rather than as a copy of all of their fields. This
+keeps the state small, and means that flows see the current version of
+each object rather than the one which was saved in the state.
+
+References are turned back into instances when the state is first used,
+with a single `in_bulk` query for each model however many instances of it
+the state holds. Instances which have since been deleted become None.
+"""
+from django.db import models
+
+try:
+    from django.apps import apps
+    _get_model = apps.get_model
+except ImportError:
+    # django < 1.7
+    from django.db.models import get_model as _get_model
+
+
+class ModelReference(object):
+    """
+    Stands in for a model instance in decoded state until the references
+    in the state are resolved.
+    """
+    __slots__ = ('label', 'pk')
+
+    def __init__(self, label, pk):
+        self.label = label
+        self.pk = pk
+
+    def __repr__(self):
+        return '<ModelReference %s %r>' % (self.label, self.pk)
+
+
+def get_reference(obj):
+    """
+    Returns the (model label, primary key) to store for a model instance,
+    or None if `obj` is not a saved model instance.
+    """
+    if isinstance(obj, ModelReference):
+        # it was never loaded, so is stored again as it was
+        return obj.label, obj.pk
+    if not isinstance(obj, models.Model) or obj.pk is None:
+        return None
+    model = type(obj)
+    if getattr(obj, '_deferred', False):
+        # instances loaded with only() or defer() have a generated class
+        model = model._meta.proxy_for_model
+    opts = model._meta
+    return '%s.%s' % (opts.app_label, opts.object_name.lower()), obj.pk
+
+
+def resolve(references):
+    """
+    Loads the instances for a list of references, with one query for each
+    model, and returns a dict of (model label, primary key) to instance.
+    """
+    by_label = {}
+    for reference in references:
+        by_label.setdefault(reference.label, set()).add(reference.pk)
+
+    instances = {}
+    for label, pks in by_label.iteritems():
+        app_label, _, model_name = label.partition('.')
+        model = _get_model(app_label, model_name)
+        for pk, instance in model._default_manager.in_bulk(list(pks)).iteritems():
+            instances[label, pk] = instance
+    return instances
+
+
+def replace(value, instances):
+    """
+    Returns `value` with the references in it replaced by the instances
+    from `resolve`. Lists and dicts are changed in place.
+    """
+    if isinstance(value, ModelReference):
+        return instances.get((value.label, value.pk))
+    if isinstance(value, dict):
+        for key, item in value.items():
+            value[key] = replace(item, instances)
+    elif isinstance(value, list):
+        value[:] = [replace(item, instances) for item in value]
+    elif isinstance(value, tuple):
+        items = [replace(item, instances) for item in value]
+        # named tuples are created from their fields
+        value = value._make(items) if hasattr(value, '_make') else tuple(items)
+    elif isinstance(value, (set, frozenset)):
+        value = type(value)(replace(item, instances) for item in value)
+    return value
+
+
+def contains_reference(value):
+    if isinstance(value, ModelReference):
+        return True
+    if isinstance(value, dict):
+        return any(contains_reference(item) for item in value.itervalues())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return any(contains_reference(item) for item in value)
+    return False
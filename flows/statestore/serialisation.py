@@ -0,0 +1,347 @@
+# -*- coding: UTF-8 -*-
+"""
+Codecs turn task state into bytes for storage, and back again.
+
+Every encoded value starts with a single header byte which records the
+format version, the codec which produced the payload and whether the
+payload was compressed. This means the codec and compression settings
+can be changed at any time - state written with a previous setting can
+still be read, because decoding only ever looks at the header.
+
+    +---------+------------+----------+
+    | 4 bits  | 1 bit      | 3 bits   |
+    | version | compressed | codec ID |
+    +---------+------------+----------+
+
+Codec ID 7 is reserved for a set of separately encoded values, which
+allows each key of the state to be decoded only when it is needed.
+
+Saved Django model instances are encoded as references to their model and
+primary key (see `flows.statestore.references`), which decode as
+`ModelReference` placeholders until the state resolves them.
+"""
+from datetime import datetime, date, time
+from decimal import Decimal
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+from django.utils import timezone
+from flows import config
+from flows.statestore import references
+from flows.statestore.references import ModelReference
+import json
+import marshal
+import struct
+import threading
+import zlib
+
+try:
+    import cPickle as pickle
+    from cStringIO import StringIO
+    # cPickle only calls this for instances of classes, so builtin types
+    # are pickled at full speed
+    _PERSISTENT_ID = 'inst_persistent_id'
+except ImportError:
+    import pickle
+    from StringIO import StringIO
+    _PERSISTENT_ID = 'persistent_id'
+
+try:
+    import msgpack
+    has_msgpack = True
+except ImportError:
+    has_msgpack = False
+
+
+FORMAT_VERSION = 1
+_COMPRESSED = 0x08
+_CODEC_MASK = 0x07
+
+# the codec ID used for a set of separately encoded values
+_VALUES = 0x07
+_LENGTH = struct.Struct('>I')
+
+# the model references found by the decode call in progress in this thread
+_decoding = threading.local()
+
+
+def _make_reference(label, pk):
+    reference = ModelReference(label, pk)
+    found = getattr(_decoding, 'references', None)
+    if found is not None:
+        found.append(reference)
+    return reference
+
+
+def _persistent_load(persistent_id):
+    label, pk = persistent_id
+    return _make_reference(label, pk)
+
+
+class PickleCodec(object):
+    """
+    Handles anything that can be pickled, including Django model
+    instances. This is the default, and the most flexible, but also
+    the slowest and largest.
+    """
+    codec_id = 1
+    name = 'pickle'
+
+    def dumps(self, value):
+        if not config.FLOWS_STATE_MODEL_REFERENCES:
+            return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        output = StringIO()
+        pickler = pickle.Pickler(output, pickle.HIGHEST_PROTOCOL)
+        setattr(pickler, _PERSISTENT_ID, references.get_reference)
+        pickler.dump(value)
+        return output.getvalue()
+
+    def loads(self, data):
+        unpickler = pickle.Unpickler(StringIO(data))
+        unpickler.persistent_load = _persistent_load
+        return unpickler.load()
+
+
+class MarshalCodec(object):
+    """
+    Very fast, but only handles the builtin types (dicts, lists, tuples,
+    strings, numbers and so on).
+    """
+    codec_id = 2
+    name = 'marshal'
+
+    def dumps(self, value):
+        return marshal.dumps(value)
+
+    def loads(self, data):
+        return marshal.loads(data)
+
+
+def _encode_type(value):
+    # types which JSON and msgpack cannot represent natively are
+    # written as a tagged dict and restored by _decode_type
+    if isinstance(value, datetime):
+        if timezone.is_aware(value):
+            value = timezone.make_naive(value, timezone.utc)
+            return {'__type__': 'datetime', 'value': value.isoformat(), 'utc': True}
+        return {'__type__': 'datetime', 'value': value.isoformat()}
+    if isinstance(value, date):
+        return {'__type__': 'date', 'value': value.isoformat()}
+    if isinstance(value, time):
+        return {'__type__': 'time', 'value': value.isoformat()}
+    if isinstance(value, Decimal):
+        return {'__type__': 'decimal', 'value': str(value)}
+    if isinstance(value, (set, frozenset)):
+        return {'__type__': 'set', 'value': list(value)}
+    reference = references.get_reference(value)
+    if reference is not None:
+        return {'__type__': 'model', 'value': list(reference)}
+    raise TypeError('%r cannot be encoded in flow state' % value)
+
+
+def _parse_iso(value, fmt):
+    if '.' not in value:
+        fmt = fmt.replace('.%f', '')
+    return datetime.strptime(value, fmt)
+
+
+def _decode_type(obj):
+    type_name = obj.get('__type__')
+    if type_name is None:
+        return obj
+    value = obj['value']
+    if type_name == 'datetime':
+        dt = _parse_iso(value, '%Y-%m-%dT%H:%M:%S.%f')
+        if obj.get('utc'):
+            dt = timezone.make_aware(dt, timezone.utc)
+        return dt
+    if type_name == 'date':
+        return _parse_iso(value, '%Y-%m-%d').date()
+    if type_name == 'time':
+        return _parse_iso(value, '%H:%M:%S.%f').time()
+    if type_name == 'decimal':
+        return Decimal(value)
+    if type_name == 'set':
+        return set(value)
+    if type_name == 'model':
+        return _make_reference(*value)
+    return obj
+
+
+class JsonCodec(object):
+    """
+    Produces portable, human-readable state. Dates, times, decimals and
+    sets are preserved using type hooks, as are references to saved model
+    instances; tuples are returned as lists.
+    """
+    codec_id = 3
+    name = 'json'
+
+    def dumps(self, value):
+        return json.dumps(value, default=_encode_type, separators=(',', ':'))
+
+    def loads(self, data):
+        return json.loads(data, object_hook=_decode_type)
+
+
+class MsgpackCodec(object):
+    """
+    A compact binary format with the same type support as `JsonCodec`.
+    Requires the `msgpack-python` package.
+    """
+    codec_id = 4
+    name = 'msgpack'
+
+    def __init__(self):
+        if not has_msgpack:
+            raise ImproperlyConfigured('The "msgpack-python" package is required to use the msgpack state codec - get it here http://pypi.python.org/pypi/msgpack-python/')
+
+    def dumps(self, value):
+        return msgpack.packb(value, default=_encode_type, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, object_hook=_decode_type, raw=False)
+
+
+_builtin_codecs = dict((c.name, c) for c in (PickleCodec, MarshalCodec, JsonCodec, MsgpackCodec))
+_codec_instances = {}
+
+
+def _get_codec_class(name_or_path):
+    if name_or_path in _builtin_codecs:
+        return _builtin_codecs[name_or_path]
+    module_name, _, attr_name = name_or_path.rpartition('.')
+    if not module_name:
+        raise ImproperlyConfigured("No such state codec: '%s'" % name_or_path)
+    return getattr(import_module(module_name), attr_name)
+
+
+def get_codec(name_or_path=None):
+    """
+    Returns the codec registered under the given name, or the codec class
+    at the given dotted path. With no argument, the codec configured by
+    `FLOWS_STATE_CODEC` is returned.
+    """
+    if name_or_path is None:
+        name_or_path = config.FLOWS_STATE_CODEC
+    codec_class = _get_codec_class(name_or_path)
+    if codec_class.codec_id not in _codec_instances:
+        _codec_instances[codec_class.codec_id] = codec_class()
+    return _codec_instances[codec_class.codec_id]
+
+
+def _codec_for_id(codec_id):
+    if codec_id not in _codec_instances:
+        # a builtin codec which has not been used yet in this process
+        for codec_class in _builtin_codecs.values():
+            if codec_class.codec_id == codec_id:
+                return get_codec(codec_class.name)
+        raise ValueError('State was encoded with unknown codec %s' % codec_id)
+    return _codec_instances[codec_id]
+
+
+def is_encoded(data):
+    """
+    Returns whether `data` was produced by `encode`, as opposed to state
+    written by earlier versions of django-flows.
+    """
+    return len(data) > 0 and ord(data[0]) >> 4 == FORMAT_VERSION
+
+
+def _pack(codec_id, payload):
+    header = (FORMAT_VERSION << 4) | codec_id
+
+    threshold = config.FLOWS_STATE_COMPRESS_THRESHOLD
+    if threshold is not None and len(payload) > threshold:
+        compressed = zlib.compress(payload, config.FLOWS_STATE_COMPRESS_LEVEL)
+        # only keep the compressed version if it actually helped
+        if len(compressed) < len(payload):
+            header |= _COMPRESSED
+            payload = compressed
+
+    return chr(header) + payload
+
+
+def _unpack(data):
+    if not is_encoded(data):
+        raise ValueError('Data is not encoded flow state')
+    header = ord(data[0])
+    payload = data[1:]
+    if header & _COMPRESSED:
+        payload = zlib.decompress(payload)
+    return header & _CODEC_MASK, payload
+
+
+def encode(value, codec=None):
+    """
+    Encodes `value` using the given codec (or the configured one) and
+    compresses the result if it is larger than
+    `FLOWS_STATE_COMPRESS_THRESHOLD`.
+    """
+    if codec is None:
+        codec = get_codec()
+    return _pack(codec.codec_id, codec.dumps(value))
+
+
+def decode(data, found_references=None, codec=None):
+    """
+    Decodes a value encoded by `encode`. Model references in it are
+    appended to the `found_references` list, if one is given. If a
+    `codec` is given, data encoded with any other is refused, so that
+    data from users is never unpickled.
+    """
+    codec_id, payload = _unpack(data)
+    if codec is not None and codec_id != codec.codec_id:
+        raise ValueError('State was not encoded with codec %s' % codec.codec_id)
+    if codec_id == _VALUES:
+        return dict((key, decode(value, found_references)) for key, value in _unpack_values(payload))
+    if found_references is None:
+        return _codec_for_id(codec_id).loads(payload)
+    _decoding.references = found_references
+    try:
+        return _codec_for_id(codec_id).loads(payload)
+    finally:
+        _decoding.references = None
+
+
+def encode_values(values):
+    """
+    Combines a dict of separately encoded values, such as the keys of a
+    task's state, so that each can be decoded only when it is needed.
+    Keys must be strings.
+    """
+    parts = []
+    for key, value in values.iteritems():
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        parts.append(_LENGTH.pack(len(key)))
+        parts.append(key)
+        parts.append(_LENGTH.pack(len(value)))
+        parts.append(value)
+    return _pack(_VALUES, ''.join(parts))
+
+
+def is_values(data):
+    return is_encoded(data) and ord(data[0]) & _CODEC_MASK == _VALUES
+
+
+def decode_values(data):
+    """
+    Returns the dict of still-encoded values combined by `encode_values`.
+    """
+    codec_id, payload = _unpack(data)
+    if codec_id != _VALUES:
+        raise ValueError('Data is not encoded as separate values')
+    return dict(_unpack_values(payload))
+
+
+def _unpack_values(payload):
+    offset = 0
+    while offset < len(payload):
+        length, = _LENGTH.unpack_from(payload, offset)
+        offset += _LENGTH.size
+        key = payload[offset:offset + length]
+        offset += length
+        length, = _LENGTH.unpack_from(payload, offset)
+        offset += _LENGTH.size
+        yield key, payload[offset:offset + length]
+        offset += length
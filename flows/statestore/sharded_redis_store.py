@@ -0,0 +1,45 @@
+"""
+Spreads task state over several redis servers, using a consistent hash
+ring so that adding a server only moves the tasks it takes over. Each server
+has its own pool of connections.
+
+The servers are listed in FLOWS_REDIS_STATE_STORE_NODES; settings which are
+not given for a node are taken from the FLOWS_REDIS_STATE_STORE_* settings.
+"""
+from django.core.exceptions import ImproperlyConfigured
+from flows import config
+from flows.statestore import redis_store
+from flows.statestore.hashring import HashRing
+
+
+class StateStore(redis_store.StateStore):
+
+    def __init__(self, nodes=None):
+        super(StateStore, self).__init__()
+        if nodes is None:
+            nodes = config.FLOWS_REDIS_STATE_STORE_NODES
+        if not nodes:
+            raise ImproperlyConfigured('FLOWS_REDIS_STATE_STORE_NODES must list at least one redis server')
+
+        defaults = self._get_settings()
+        ring_nodes = {}
+        for node in nodes:
+            node = dict(node)
+            # nodes are named after where they are, unless they say otherwise,
+            # so that the ring does not change if the list is reordered
+            name = node.pop('name', None) or '%s:%s/%s' % (node.get('host', defaults['host']),
+                                                          node.get('port', defaults['port']),
+                                                          node.get('db', defaults['db']))
+            settings = dict(defaults)
+            settings.update(node)
+            ring_nodes[name] = settings
+        self._ring = HashRing(ring_nodes, config.FLOWS_REDIS_STATE_STORE_VIRTUAL_NODES)
+
+    def _get_db(self, task_id=None):
+        if task_id is None:
+            raise ValueError('The sharded redis state store needs a task ID to choose a server')
+        # clients are shared by the whole process, and are pooled per server
+        return redis_store.get_client(**self._ring.get_node(task_id))
+
+    def _get_dbs(self):
+        return [redis_store.get_client(**settings) for settings in self._ring.get_nodes()]
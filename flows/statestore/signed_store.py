@@ -0,0 +1,255 @@
+"""
+Keeps task state on the client rather than on the server. The encoded
+state is signed - and optionally encrypted - and is carried either in
+place of the task ID in URLs and forms, or in a cookie per task.
+
+Unless they are encrypted, tokens can be read by anyone who sees them, so
+they leave out the binder value of the task, which is usually the user's
+session key. They are signed for it instead, and it is set again from the
+request when they are used.
+
+Tokens cannot be revoked once they have been handed out, so a user could
+go back to an earlier step, or repeat a completed flow, for as long as the
+idle timeout of the flow allows. Flows which must not be repeated should
+use a server-side store.
+
+Tokens come from users, so they are always encoded as JSON, whatever
+FLOWS_STATE_CODEC is, and tokens encoded in any other way are refused, so
+that a leaked SECRET_KEY cannot be used to have the server unpickle data.
+
+State which would make a token larger than FLOWS_SIGNED_STATE_STORE_MAX_SIZE,
+or which cannot be encoded as JSON, is kept in the store configured by
+FLOWS_SIGNED_STATE_STORE_FALLBACK instead, and is then referred to by its
+task ID as usual.
+"""
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import baseconv
+from django.utils.importlib import import_module
+from flows import config
+from flows.binder import binder
+from flows.statestore import serialisation
+from flows.statestore.base import StateStoreBase, StateNotFound
+from flows.statestore.tracking import TrackedState
+import base64
+import hashlib
+import re
+import threading
+import time
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+    has_cryptography = True
+except ImportError:
+    has_cryptography = False
+    class InvalidToken(Exception):
+        pass
+
+
+_TASK_ID = re.compile('^[0-9a-f]{32}$')
+_TOKEN_CODEC = 'json'
+
+
+class StateStore(StateStoreBase):
+
+    # task IDs, or the characters used by signed and encrypted tokens
+    reference_pattern = '^[\w\-:=]+$'
+
+    def __init__(self, fallback=None):
+        if fallback is None:
+            fallback = import_module(config.FLOWS_SIGNED_STATE_STORE_FALLBACK).StateStore()
+        self.fallback = fallback
+        self._local = threading.local()
+        self._reset()
+
+    def _reset(self, request=None):
+        self._local.request = request
+        # tasks whose state is kept in the fallback store
+        self._local.server_side = set()
+        # for cookies, the state of each task used in this request, or
+        # None if the task was deleted
+        self._local.states = {}
+
+    def _get_local(self, name):
+        if not hasattr(self._local, 'request'):
+            # first use in this thread
+            self._reset()
+        return getattr(self._local, name)
+
+    def _get_fernet(self):
+        if not has_cryptography:
+            raise ImproperlyConfigured('The "cryptography" package is required to encrypt client-side task state - get it here http://pypi.python.org/pypi/cryptography/')
+        key = hashlib.sha256('flows.statestore.signed_store' + settings.SECRET_KEY).digest()
+        return Fernet(base64.urlsafe_b64encode(key))
+
+    def _get_signer(self, bound_to):
+        return signing.TimestampSigner(salt='flows.statestore.signed_store:%s' % (bound_to or ''))
+
+    def _get_request_binder_value(self):
+        request = self._get_local('request')
+        return binder(request) if request is not None else None
+
+    def _encode_token(self, state):
+        return serialisation.encode(state, serialisation.get_codec(_TOKEN_CODEC))
+
+    def _decode_token(self, data, bound_to=None):
+        found = []
+        state = serialisation.decode(data, found, codec=serialisation.get_codec(_TOKEN_CODEC))
+        if bound_to is not None:
+            state['_bound_to'] = bound_to
+        return TrackedState(state, self._digest(data), found_references=found)
+
+    def _sign(self, state):
+        if isinstance(state, TrackedState):
+            state = state.as_dict()
+        if config.FLOWS_SIGNED_STATE_STORE_ENCRYPT:
+            return self._get_fernet().encrypt(self._encode_token(state))
+        state = dict(state)
+        bound_to = state.pop('_bound_to', None)
+        return self._get_signer(bound_to).sign(signing.b64_encode(self._encode_token(state)))
+
+    def _unsign(self, token):
+        # the age of the token can only be checked once the state has been
+        # decoded, since that holds the idle timeout of its flow
+        try:
+            if config.FLOWS_SIGNED_STATE_STORE_ENCRYPT:
+                fernet = self._get_fernet()
+                state = self._decode_token(fernet.decrypt(token))
+                fernet.decrypt(token, ttl=self._get_idle_timeout(state))
+            else:
+                # the timestamp is signed along with the value, which is only
+                # valid for requests with the same binder value
+                bound_to = self._get_request_binder_value()
+                value, timestamp = signing.Signer.unsign(self._get_signer(bound_to), token).rsplit(':', 1)
+                state = self._decode_token(signing.b64_decode(value.encode('ascii')), bound_to)
+                if time.time() - baseconv.base62.decode(timestamp) > self._get_idle_timeout(state):
+                    raise StateNotFound
+        except (signing.BadSignature, InvalidToken, TypeError, ValueError):
+            # this includes tokens which are too old
+            raise StateNotFound
+        return state
+
+    def _cookie_name(self, task_id):
+        return '%s%s' % (config.FLOWS_SIGNED_STATE_STORE_COOKIE_PREFIX, task_id)
+
+    def _move_to_server(self, task_id, state):
+        self._get_local('server_side').add(task_id)
+        self.fallback.put_state(task_id, state)
+
+    def get_reference(self, task_id, state):
+        if config.FLOWS_SIGNED_STATE_STORE_COOKIE or task_id in self._get_local('server_side'):
+            return task_id
+        token = self._get_token(state)
+        if token is None:
+            self._move_to_server(task_id, state)
+            return task_id
+        return token
+
+    def _get_token(self, state):
+        """
+        Returns the token carrying the state, or None if it must be kept on
+        the server instead.
+        """
+        try:
+            token = self._sign(state)
+        except (TypeError, ValueError):
+            # the state holds values which JSON cannot represent
+            return None
+        if len(token) > config.FLOWS_SIGNED_STATE_STORE_MAX_SIZE:
+            return None
+        return token
+
+    def process_request(self, request):
+        self._reset(request)
+
+    def process_response(self, request, response):
+        states = self._get_local('states')
+        server_side = self._get_local('server_side')
+        # which tasks are kept on the server is still needed while the
+        # response is rendered, so that is only reset by the next request
+        self._local.request = None
+        self._local.states = {}
+        if response is None:
+            return response
+
+        for task_id, state in states.iteritems():
+            name = self._cookie_name(task_id)
+            if state is None:
+                response.delete_cookie(name)
+                continue
+            token = None
+            if task_id not in server_side:
+                token = self._get_token(state)
+                if token is None:
+                    self.fallback.put_state(task_id, state)
+            if token is None:
+                if name in request.COOKIES:
+                    response.delete_cookie(name)
+            else:
+                response.set_cookie(name, token, max_age=self._get_idle_timeout(state), httponly=True)
+        return response
+
+    def _is_client_side(self, task_id):
+        if task_id in self._get_local('server_side'):
+            return False
+        if config.FLOWS_SIGNED_STATE_STORE_COOKIE:
+            # cookies can only be set while a flow is handling the request
+            return self._get_local('request') is not None
+        return True
+
+    def batch(self):
+        return self.fallback.batch()
+
+    def get_state(self, task_id):
+        if config.FLOWS_SIGNED_STATE_STORE_COOKIE:
+            request = self._get_local('request')
+            token = request.COOKIES.get(self._cookie_name(task_id)) if request is not None else None
+            if token is not None:
+                state = self._unsign(token)
+                # the cookie is sent again so that it does not expire
+                self._get_local('states')[task_id] = state
+                return state
+        elif not _TASK_ID.match(task_id):
+            return self._unsign(task_id)
+
+        state = self.fallback.get_state(task_id)
+        self._get_local('server_side').add(task_id)
+        return state
+
+    def put_state(self, task_id, state):
+        if not self._is_client_side(task_id):
+            self._move_to_server(task_id, state)
+        elif config.FLOWS_SIGNED_STATE_STORE_COOKIE:
+            self._get_local('states')[task_id] = state
+        # otherwise the state is signed whenever a URL or form for the task
+        # is created
+
+    def update_state(self, task_id, state):
+        if task_id in self._get_local('server_side'):
+            self.fallback.update_state(task_id, state)
+        else:
+            self.put_state(task_id, state)
+
+    @property
+    def iter_states(self):
+        # only state which is too large for the client is on the server
+        return self.fallback.iter_states
+
+    def delete_for_binder(self, bound_to):
+        # tokens on the client cannot be revoked, so only the state on the
+        # server can be deleted
+        return self.fallback.delete_for_binder(bound_to)
+
+    def get_binder_tasks(self, bound_to):
+        # the tasks kept on the server, as tokens cannot be revoked
+        return self.fallback.get_binder_tasks(bound_to)
+
+    def count_created(self, bound_to, period):
+        return self.fallback.count_created(bound_to, period)
+
+    def delete_state(self, task_id):
+        if task_id in self._get_local('server_side'):
+            self.fallback.delete_state(task_id)
+        elif config.FLOWS_SIGNED_STATE_STORE_COOKIE:
+            self._get_local('states')[task_id] = None
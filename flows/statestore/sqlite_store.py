@@ -0,0 +1,234 @@
+"""
+Stores task state in a SQLite database file, which can be shared safely by
+several processes on the same machine, such as the workers of a single
+gunicorn server, without needing a database or redis server.
+
+The database uses write-ahead logging, so that reads are never blocked by
+writes. Each thread keeps its connection open, and SQLite caches the
+prepared statements used for each connection. Expired state is removed,
+and the space it used is returned to the file system, every
+FLOWS_SQLITE_STATE_STORE_CLEANUP_INTERVAL seconds while the store is used,
+and by `remove_expired_state`, which the `cleanupflows` management command
+calls.
+"""
+from flows import config
+from flows.statestore.base import StateStoreBase, StateNotFound, StateConflict
+import os
+import sqlite3
+import threading
+import time
+
+
+_SCHEMA = (
+    # auto_vacuum must be set before any tables are created
+    'PRAGMA auto_vacuum = INCREMENTAL',
+    'CREATE TABLE IF NOT EXISTS flows_state ('
+    '    task_id TEXT PRIMARY KEY,'
+    '    state BLOB NOT NULL,'
+    '    last_access REAL NOT NULL,'
+    '    expires REAL NOT NULL,'
+    '    version INTEGER NOT NULL DEFAULT 0,'
+    '    bound_to TEXT,'
+    '    created REAL)',
+    'CREATE INDEX IF NOT EXISTS flows_state_expires ON flows_state (expires)',
+    'CREATE INDEX IF NOT EXISTS flows_state_bound_to ON flows_state (bound_to, created)',
+    # how many tasks each binder value created in each period
+    'CREATE TABLE IF NOT EXISTS flows_created ('
+    '    key TEXT PRIMARY KEY,'
+    '    count INTEGER NOT NULL,'
+    '    expires REAL NOT NULL)',
+)
+
+_SELECT = 'SELECT state, last_access, version FROM flows_state WHERE task_id = ? AND expires >= ?'
+# the difference between the two times is the idle timeout of the task
+_TOUCH = 'UPDATE flows_state SET expires = expires - last_access + ?, last_access = ? WHERE task_id = ?'
+# a task which is replaced keeps the time it was created
+_REPLACE = ('INSERT OR REPLACE INTO flows_state (task_id, state, last_access, expires, version, bound_to, created) '
+            'VALUES (?, ?, ?, ?, ?, ?, COALESCE((SELECT created FROM flows_state WHERE task_id = ?), ?))')
+# the version is checked by the update itself, so that only one of two
+# requests which loaded the same version can write
+_UPDATE_IF_VERSION = ('UPDATE flows_state SET state = ?, last_access = ?, expires = ?, version = version + 1 '
+                      'WHERE task_id = ? AND version = ? AND expires >= ?')
+_DELETE = 'DELETE FROM flows_state WHERE task_id = ?'
+_DELETE_EXPIRED = 'DELETE FROM flows_state WHERE expires < ?'
+_SELECT_MANY = 'SELECT task_id, state FROM flows_state WHERE task_id IN (%s) AND expires >= ?'
+_SELECT_AFTER = ('SELECT task_id, state FROM flows_state WHERE task_id > ? AND expires >= ? '
+                 'ORDER BY task_id LIMIT ?')
+_SELECT_BOUND_TO = ('SELECT task_id FROM flows_state WHERE bound_to = ? AND expires >= ? '
+                    'ORDER BY created, rowid')
+_DELETE_BOUND_TO = 'DELETE FROM flows_state WHERE bound_to = ?'
+_INSERT_CREATED = 'INSERT OR IGNORE INTO flows_created (key, count, expires) VALUES (?, 0, ?)'
+_INCREMENT_CREATED = 'UPDATE flows_created SET count = count + 1 WHERE key = ?'
+_SELECT_CREATED = 'SELECT count FROM flows_created WHERE key = ?'
+_DELETE_EXPIRED_CREATED = 'DELETE FROM flows_created WHERE expires < ?'
+
+
+class StateStore(StateStoreBase):
+
+    def __init__(self):
+        self._local = threading.local()
+        self._last_cleanup = time.time()
+        self._cleanup_lock = threading.Lock()
+
+    def _get_connection(self):
+        # connections cannot be shared between threads, nor survive a fork
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            self._local.connection = self._connect()
+            self._local.pid = pid
+        return self._local.connection
+
+    def _connect(self):
+        # isolation_level=None means each statement is committed at once,
+        # rather than the sqlite3 module opening transactions implicitly
+        connection = sqlite3.connect(config.FLOWS_SQLITE_STATE_STORE_PATH,
+                                     timeout=config.FLOWS_SQLITE_STATE_STORE_TIMEOUT,
+                                     isolation_level=None, check_same_thread=False)
+        connection.text_factory = str
+        connection.execute('PRAGMA journal_mode = WAL')
+        # with WAL this is still safe against corruption, but only syncs
+        # to disk at checkpoints rather than on every write
+        connection.execute('PRAGMA synchronous = NORMAL')
+        for statement in _SCHEMA:
+            connection.execute(statement)
+        return connection
+
+    def get_state(self, task_id):
+        # stores which are only read from and updated are cleaned up too
+        self._maybe_cleanup()
+        now = time.time()
+        connection = self._get_connection()
+        row = connection.execute(_SELECT, (task_id, now)).fetchone()
+        if row is None:
+            raise StateNotFound
+        data, last_access, version = row
+
+        if now - last_access > config.FLOWS_SQLITE_STATE_STORE_TOUCH_INTERVAL:
+            connection.execute(_TOUCH, (now, now, task_id))
+
+        state = self._decode(str(data))
+        self._saved(state, version)
+        return state
+
+    def put_state(self, task_id, state):
+        row = self._row(task_id, state, time.time())
+        self._get_connection().execute(_REPLACE, row)
+        self._saved(state, row[4])
+        self._maybe_cleanup()
+
+    def _put_if_version(self, task_id, state, version):
+        now = time.time()
+        cursor = self._get_connection().execute(_UPDATE_IF_VERSION, (
+            sqlite3.Binary(self._encode(state)), now, now + self._get_idle_timeout(state), task_id, version, now))
+        if not cursor.rowcount:
+            raise StateConflict
+        self._saved(state, version + 1)
+        self._maybe_cleanup()
+
+    def _row(self, task_id, state, now):
+        return (task_id, sqlite3.Binary(self._encode(state)), now, now + self._get_idle_timeout(state),
+                self._next_version(state), self._get_bound_to(state), task_id, now)
+
+    def delete_state(self, task_id):
+        self._get_connection().execute(_DELETE, (task_id,))
+
+    def get_many(self, task_ids):
+        task_ids = list(task_ids)
+        connection = self._get_connection()
+        now = time.time()
+        states = {}
+        # SQLite limits how many parameters a statement can have
+        for start in range(0, len(task_ids), self.chunk_size):
+            chunk = task_ids[start:start + self.chunk_size]
+            sql = _SELECT_MANY % ', '.join(['?'] * len(chunk))
+            for task_id, data in connection.execute(sql, chunk + [now]):
+                states[task_id] = self._decode(str(data))
+        return states
+
+    def put_many(self, states):
+        now = time.time()
+        rows = [self._row(task_id, state, now) for task_id, state in states.iteritems()]
+        connection = self._get_connection()
+        # a single transaction, rather than one for each task
+        connection.execute('BEGIN')
+        try:
+            connection.executemany(_REPLACE, rows)
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        for row in rows:
+            self._saved(states[row[0]], row[4])
+
+    def delete_many(self, task_ids):
+        connection = self._get_connection()
+        connection.execute('BEGIN')
+        try:
+            connection.executemany(_DELETE, [(task_id,) for task_id in task_ids])
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def get_binder_tasks(self, bound_to):
+        rows = self._get_connection().execute(_SELECT_BOUND_TO, (bound_to, time.time()))
+        return [task_id for task_id, in rows]
+
+    def delete_for_binder(self, bound_to):
+        return self._get_connection().execute(_DELETE_BOUND_TO, (bound_to,)).rowcount
+
+    def count_created(self, bound_to, period):
+        number = int(time.time() // period)
+        key = '%s:%d' % (bound_to, number)
+        connection = self._get_connection()
+        # taking the write lock at once means no other process can count
+        # between the increment and the read
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(_INSERT_CREATED, (key, (number + 1) * period))
+            connection.execute(_INCREMENT_CREATED, (key,))
+            count, = connection.execute(_SELECT_CREATED, (key,)).fetchone()
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return count
+
+    def iter_states(self):
+        connection = self._get_connection()
+        last_task_id = ''
+        while True:
+            rows = connection.execute(_SELECT_AFTER, (last_task_id, time.time(), self.chunk_size)).fetchall()
+            if not rows:
+                return
+            last_task_id = rows[-1][0]
+            for task_id, data in rows:
+                yield task_id, self._decode(str(data))
+
+    def _maybe_cleanup(self):
+        now = time.time()
+        if now - self._last_cleanup < config.FLOWS_SQLITE_STATE_STORE_CLEANUP_INTERVAL:
+            return
+        # only one thread in each process needs to do this
+        if not self._cleanup_lock.acquire(False):
+            return
+        try:
+            self._last_cleanup = now
+            self.remove_expired_state()
+        finally:
+            self._cleanup_lock.release()
+
+    def remove_expired_state(self, progress=None):
+        """
+        Deletes the state of expired tasks, and releases the unused space
+        in the database file. Returns how many tasks were deleted.
+        """
+        connection = self._get_connection()
+        now = time.time()
+        cursor = connection.execute(_DELETE_EXPIRED, (now,))
+        connection.execute(_DELETE_EXPIRED_CREATED, (now,))
+        # the pragma frees one page each time it is stepped through
+        connection.execute('PRAGMA incremental_vacuum').fetchall()
+        if progress is not None:
+            progress(cursor.rowcount)
+        return cursor.rowcount
@@ -1,2 +1,13 @@
 
-from flows.statestore.tests.django_tests import *
\ No newline at end of file
+from flows.statestore.tests.cache_tests import *
+from flows.statestore.tests.cached_tests import *
+from flows.statestore.tests.django_tests import *
+from flows.statestore.tests.hashring_tests import *
+from flows.statestore.tests.memory_tests import *
+from flows.statestore.tests.redis_tests import *
+from flows.statestore.tests.references_tests import *
+from flows.statestore.tests.serialisation_tests import *
+from flows.statestore.tests.signed_tests import *
+from flows.statestore.tests.sqlite_tests import *
+from flows.statestore.tests.tmpfile_tests import *
+from flows.statestore.tests.tracking_tests import *
\ No newline at end of file
@@ -0,0 +1,69 @@
+from django.test import TestCase
+from flows import config
+from flows.statestore.base import StateNotFound, StateConflict
+from flows.statestore.cache_store import StateStore
+from flows.statestore.tests.utils import StateStoreTests
+import time
+
+
+class CacheStateStoreTest(StateStoreTests, TestCase):
+
+    task_id = 'a' * 32
+
+    def setUp(self):
+        self.store = StateStore()
+        self.cache = self.store._get_cache()
+        self.cache.clear()
+
+    def make_store(self):
+        return self.store
+
+    def test_delete_state(self):
+        self.store.put_state(self.task_id, {'a': 1})
+        self.store.delete_state(self.task_id)
+        self.assertRaises(StateNotFound, self.store.get_state, self.task_id)
+
+    def test_recent_state_is_not_rewritten(self):
+        self.store.put_state(self.task_id, {'a': 1})
+        written, _ = self.cache.get(self.store._key(self.task_id))
+        self.store.get_state(self.task_id)
+        self.assertEqual(written, self.cache.get(self.store._key(self.task_id))[0])
+
+    def test_stale_state_is_rewritten(self):
+        key = self.store._key(self.task_id)
+        self.store.put_state(self.task_id, {'a': 1})
+        written = time.time() - config.FLOWS_CACHE_STATE_STORE_TOUCH_INTERVAL - 1
+        self.cache.set(key, (written, self.cache.get(key)[1]))
+        self.assertEqual(1, self.store.get_state(self.task_id)['a'])
+        self.assertTrue(self.cache.get(key)[0] > written)
+
+    def test_touch_keeps_other_writes(self):
+        key = self.store._key(self.task_id)
+        self.store.put_state(self.task_id, {'a': 1})
+        written = time.time() - config.FLOWS_CACHE_STATE_STORE_TOUCH_INTERVAL - 1
+        self.cache.set(key, (written, self.cache.get(key)[1]))
+
+        other = StateStore()
+        with self.store.batch():
+            state = self.store.get_state(self.task_id)
+            with other.batch():
+                other_state = other.get_state(self.task_id)
+                other_state['a'] = 2
+                other.update_state(self.task_id, other_state)
+            # the other request's write is not undone by the touch, and this
+            # one's stale state is refused
+            state['a'] = 3
+            self.assertRaises(StateConflict, self.store.update_state, self.task_id, state)
+        self.assertEqual(2, other.get_state(self.task_id)['a'])
+
+    def test_batched_writes(self):
+        with self.store.batch():
+            self.store.put_state(self.task_id, {'a': 1})
+            self.store.put_state('b' * 32, {'b': 1})
+            self.assertEqual(None, self.cache.get(self.store._key('b' * 32)))
+        self.assertEqual(1, self.store.get_state('b' * 32)['b'])
+
+    def test_tasks_cannot_be_listed(self):
+        self.store.put_state(self.task_id, {'_id': self.task_id, '_bound_to': 'alice'})
+        self.assertFalse(hasattr(self.store, 'iter_states'))
+        self.assertEqual(None, self.store.delete_for_binder('alice'))
@@ -0,0 +1,74 @@
+from django.test import TestCase
+from flows import config
+from flows.statestore import cached_store, django_store
+from flows.statestore.tests.utils import StateStoreTests
+
+
+class CachedStateStoreTest(StateStoreTests, TestCase):
+
+    task_id = 'a' * 32
+
+    def setUp(self):
+        # two processes sharing the same backend and invalidation channel
+        channel_name = 'test-%s' % id(self)
+        self.store = self._make_store(channel_name)
+        self.other_store = self._make_store(channel_name)
+
+    def _make_store(self, channel_name):
+        return cached_store.StateStore(django_store.StateStore(), cached_store.LocalChannel(channel_name))
+
+    def make_store(self):
+        return self.store
+
+    def test_reads_are_cached(self):
+        self.store.put_state(self.task_id, {'a': 1})
+        with self.assertNumQueries(0):
+            self.assertEqual(1, self.store.get_state(self.task_id)['a'])
+
+    def test_writes_invalidate_other_processes(self):
+        self.store.put_state(self.task_id, {'a': 1})
+        self.assertEqual(1, self.other_store.get_state(self.task_id)['a'])
+
+        state = self.store.get_state(self.task_id)
+        state['a'] = 2
+        self.store.update_state(self.task_id, state)
+        self.assertEqual(2, self.other_store.get_state(self.task_id)['a'])
+
+        self.store.delete_state(self.task_id)
+        self.assertRaises(django_store.StateNotFound, self.other_store.get_state, self.task_id)
+
+    def test_batched_writes_are_cached_when_sent(self):
+        with self.store.batch():
+            self.store.put_state(self.task_id, {'a': 1})
+            self.assertEqual(0, len(self.store._entries))
+        with self.assertNumQueries(0):
+            self.assertEqual(1, self.store.get_state(self.task_id)['a'])
+
+    def test_failed_batch_is_not_cached(self):
+        try:
+            with self.store.batch():
+                self.store.put_state(self.task_id, {'a': 1})
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(0, len(self.store._entries))
+
+    def test_least_recently_used_is_evicted(self):
+        old_max = config.FLOWS_CACHED_STATE_STORE_MAX_ENTRIES
+        config.FLOWS_CACHED_STATE_STORE_MAX_ENTRIES = 2
+        try:
+            for task_id in ('a' * 32, 'b' * 32, 'c' * 32):
+                self.store.put_state(task_id, {'a': 1})
+            self.assertEqual(['b' * 32, 'c' * 32], list(self.store._entries))
+        finally:
+            config.FLOWS_CACHED_STATE_STORE_MAX_ENTRIES = old_max
+
+    def test_expired_entries_are_reloaded(self):
+        old_ttl = config.FLOWS_CACHED_STATE_STORE_TTL
+        config.FLOWS_CACHED_STATE_STORE_TTL = -1
+        try:
+            self.store.put_state(self.task_id, {'a': 1})
+            with self.assertNumQueries(1):
+                self.store.get_state(self.task_id)
+        finally:
+            config.FLOWS_CACHED_STATE_STORE_TTL = old_ttl
@@ -1,12 +1,241 @@
-
+from datetime import timedelta
+from django.core.signals import request_finished
+from django.db import connection
 from django.test import TestCase
-from flows.statestore.django_store import StateStore
-from flows.statestore.tests.utils import test_store_state
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from flows import config
+from flows.statestore import django_store
+from flows.statestore.base import StateNotFound
+from flows.statestore.django_store import StateStore, StateModel, StateValueModel
+from flows.statestore.tests.utils import StateStoreTests
+    
+
+class DjangoStateStoreTest(StateStoreTests, TestCase):
+    
+    def make_store(self):
+        return StateStore()
+        
+    def _age_task(self, task_id, seconds, timeout=None):
+        if timeout is None:
+            timeout = config.FLOWS_TASK_IDLE_TIMEOUT
+        last_access = timezone.now() - timedelta(seconds=seconds)
+        StateModel.objects.filter(task_id=task_id).update(last_access=last_access,
+                                                          expires=last_access + timedelta(seconds=timeout))
+        return last_access
+        
+    def test_remove_expired_state(self):
+        store = StateStore()
+        task_ids = ['%032x' % i for i in range(5)]
+        for task_id in task_ids:
+            store.put_state(task_id, {'a': 1})
+            self._age_task(task_id, config.FLOWS_TASK_IDLE_TIMEOUT + 1)
+        store.put_state('f' * 32, {'a': 1})
+        
+        progress = []
+        self.assertEqual(3, StateModel.objects.remove_expired_state(chunk_size=2, max_rows=3,
+                                                                    progress=progress.append))
+        self.assertEqual([2, 3], progress)
+        # the next run carries on where the last one stopped
+        self.assertEqual(2, StateModel.objects.remove_expired_state(chunk_size=2))
+        self.assertEqual(['f' * 32], list(StateModel.objects._all().values_list('task_id', flat=True)))
+        
+    def test_remove_expired_state_time_budget(self):
+        store = StateStore()
+        store.put_state('a' * 32, {'a': 1})
+        self._age_task('a' * 32, config.FLOWS_TASK_IDLE_TIMEOUT + 1)
+        self.assertEqual(0, StateModel.objects.remove_expired_state(max_seconds=0))
+        self.assertEqual(1, StateModel.objects.remove_expired_state())
+        
+    def test_flow_idle_timeout(self):
+        store = StateStore()
+        store.put_state('a' * 32, {'_idle_timeout': 30})
+        store.put_state('b' * 32, {'a': 1})
+        self._age_task('a' * 32, 31, timeout=30)
+        self._age_task('b' * 32, 31)
+        self.assertRaises(StateNotFound, store.get_state, 'a' * 32)
+        self.assertEqual(1, store.get_state('b' * 32)['a'])
+        self.assertEqual(1, StateModel.objects.remove_expired_state())
+        
+    def test_state_without_expiry_uses_idle_timeout(self):
+        # as written before tasks recorded when they expire
+        store = StateStore()
+        store.put_state('a' * 32, {'a': 1})
+        StateModel.objects.filter(task_id='a' * 32).update(expires=None)
+        self.assertEqual(1, store.get_state('a' * 32)['a'])
+        StateModel.objects.filter(task_id='a' * 32).update(
+            last_access=timezone.now() - timedelta(seconds=config.FLOWS_TASK_IDLE_TIMEOUT + 1))
+        self.assertRaises(StateNotFound, store.get_state, 'a' * 32)
+        self.assertEqual(1, StateModel.objects.remove_expired_state())
+        
+    def test_stale_access_keeps_flow_idle_timeout(self):
+        store = StateStore()
+        store.put_state('a' * 32, {'_idle_timeout': 100})
+        self._age_task('a' * 32, config.FLOWS_DJANGO_STATE_STORE_TOUCH_INTERVAL + 1, timeout=100)
+        store.get_state('a' * 32)
+        task = StateModel.objects.get(task_id='a' * 32)
+        self.assertEqual(timedelta(seconds=100), task.expires - task.last_access)
+        
+    def test_recent_access_is_not_touched(self):
+        store = StateStore()
+        store.put_state('a' * 32, {'a': 1})
+        with self.assertNumQueries(1):
+            store.get_state('a' * 32)
+            
+    def test_stale_access_is_touched(self):
+        store = StateStore()
+        store.put_state('a' * 32, {'a': 1})
+        last_access = self._age_task('a' * 32, config.FLOWS_DJANGO_STATE_STORE_TOUCH_INTERVAL + 1)
+        with self.assertNumQueries(2):
+            store.get_state('a' * 32)
+        self.assertTrue(StateModel.objects.get(task_id='a' * 32).last_access > last_access)
+        
+    def test_batched_touches(self):
+        store = StateStore()
+        old_batch = config.FLOWS_DJANGO_STATE_STORE_BATCH_TOUCHES
+        config.FLOWS_DJANGO_STATE_STORE_BATCH_TOUCHES = True
+        try:
+            for task_id in ('a' * 32, 'b' * 32):
+                store.put_state(task_id, {'a': 1})
+                last_access = self._age_task(task_id, config.FLOWS_DJANGO_STATE_STORE_TOUCH_INTERVAL + 1)
+                with self.assertNumQueries(1):
+                    store.get_state(task_id)
+            with self.assertNumQueries(1):
+                store.flush_touches()
+            for task_id in ('a' * 32, 'b' * 32):
+                self.assertTrue(StateModel.objects.get(task_id=task_id).last_access > last_access)
+        finally:
+            config.FLOWS_DJANGO_STATE_STORE_BATCH_TOUCHES = old_batch
     
+    def test_batched_touches_are_flushed_after_request(self):
+        store = StateStore()
+        old_batch = config.FLOWS_DJANGO_STATE_STORE_BATCH_TOUCHES
+        config.FLOWS_DJANGO_STATE_STORE_BATCH_TOUCHES = True
+        try:
+            store.put_state('a' * 32, {'a': 1})
+            last_access = self._age_task('a' * 32, config.FLOWS_DJANGO_STATE_STORE_TOUCH_INTERVAL + 1)
+            store.get_state('a' * 32)
+            self.assertEqual(last_access, StateModel.objects.get(task_id='a' * 32).last_access)
+            request_finished.send(sender=self.__class__)
+            self.assertTrue(StateModel.objects.get(task_id='a' * 32).last_access > last_access)
+        finally:
+            config.FLOWS_DJANGO_STATE_STORE_BATCH_TOUCHES = old_batch
+            
+    def test_put_state_is_one_query(self):
+        store = StateStore()
+        with self.assertNumQueries(1):
+            store.put_state('a' * 32, {'a': 1})
+        with self.assertNumQueries(1):
+            store.put_state('a' * 32, {'a': 2})
+        self.assertEqual({'a': 2}, store.get_state('a' * 32))
+        
+    def test_put_state_without_native_upsert(self):
+        store = StateStore()
+        backends = django_store._upsert_backends
+        django_store._upsert_backends = {}
+        try:
+            store.put_state('a' * 32, {'a': 1})
+            store.put_state('a' * 32, {'a': 2})
+        finally:
+            django_store._upsert_backends = backends
+        self.assertEqual({'a': 2}, store.get_state('a' * 32))
+        
+    def test_put_state_reuses_expired_task(self):
+        store = StateStore()
+        store.put_state('a' * 32, {'a': 1})
+        self._age_task('a' * 32, config.FLOWS_TASK_IDLE_TIMEOUT + 1)
+        store.put_state('a' * 32, {'a': 2})
+        self.assertEqual({'a': 2}, store.get_state('a' * 32))
+
 
-class DjangoStateStoreTest(TestCase):
+class DjangoPerKeyStateStoreTest(StateStoreTests, TestCase):
+    
+    task_id = 'a' * 32
+    
+    def setUp(self):
+        self._per_key = config.FLOWS_DJANGO_STATE_STORE_PER_KEY
+        config.FLOWS_DJANGO_STATE_STORE_PER_KEY = True
+        
+    def tearDown(self):
+        config.FLOWS_DJANGO_STATE_STORE_PER_KEY = self._per_key
+    
+    def make_store(self):
+        return StateStore()
+        
+    def test_only_changed_keys_are_written(self):
+        store = StateStore()
+        store.put_state(self.task_id, {'a': 1, 'b': [1, 2], 'c': 'cake'})
+        self.assertEqual(3, StateValueModel.objects.filter(task=self.task_id).count())
+        
+        state = store.get_state(self.task_id)
+        state['a'] = 2
+        state['b'].append(3)
+        del state['c']
+        # checking the version, then deleting and updating the keys, in a
+        # savepoint since the test is already in a transaction
+        with self.assertNumQueries(5):
+            store.update_state(self.task_id, state)
+        
+        self.assertEqual({'a': 2, 'b': [1, 2, 3]}, store.get_state(self.task_id))
+        with self.assertNumQueries(0):
+            store.update_state(self.task_id, state)
+    
+    def test_failed_write_keeps_version(self):
+        store = StateStore()
+        store.put_state(self.task_id, {'a': 1, 'b': 2})
+        state = store.get_state(self.task_id)
+        state['a'] = 3
+        
+        def failing_upsert(model, unique_fields, rows):
+            raise ValueError
+        upsert = django_store._upsert
+        django_store._upsert = failing_upsert
+        try:
+            self.assertRaises(ValueError, store.update_state, self.task_id, state)
+        finally:
+            django_store._upsert = upsert
+        self.assertEqual(1, StateModel.objects.get(task_id=self.task_id).version)
+        self.assertEqual({'a': 1, 'b': 2}, store.get_state(self.task_id))
+    
+    def test_changed_keys_without_native_upsert(self):
+        store = StateStore()
+        store.put_state(self.task_id, {'a': 1, 'b': 2})
+        backends = django_store._upsert_backends
+        django_store._upsert_backends = {}
+        try:
+            state = store.get_state(self.task_id)
+            state['a'] = 3
+            state['d'] = 4
+            store.update_state(self.task_id, state)
+        finally:
+            django_store._upsert_backends = backends
+        self.assertEqual({'a': 3, 'b': 2, 'd': 4}, store.get_state(self.task_id))
+    
+    def test_reads_whole_state(self):
+        store = StateStore()
+        config.FLOWS_DJANGO_STATE_STORE_PER_KEY = False
+        store.put_state(self.task_id, {'a': 1, 'b': 2})
+        config.FLOWS_DJANGO_STATE_STORE_PER_KEY = True
+        
+        state = store.get_state(self.task_id)
+        self.assertEqual({'a': 1, 'b': 2}, state)
+        state['a'] = 3
+        store.update_state(self.task_id, state)
+        self.assertEqual(2, StateValueModel.objects.filter(task=self.task_id).count())
+        self.assertEqual({'a': 3, 'b': 2}, store.get_state(self.task_id))
     
-    def test_django_store_state(self):
+    def test_keys_are_only_joined_with_per_key_storage(self):
         store = StateStore()
-        test_store_state(self, store)
+        store.put_state(self.task_id, {'a': 1})
+        config.FLOWS_DJANGO_STATE_STORE_PER_KEY = False
+        store.put_state('b' * 32, {'b': 2})
         
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual({'b': 2}, store.get_state('b' * 32))
+        self.assertEqual(1, len(queries))
+        self.assertFalse('JOIN' in queries[0]['sql'])
+        # state written with per-key storage can still be read
+        with self.assertNumQueries(2):
+            self.assertEqual({'a': 1}, store.get_state(self.task_id))
+        self.assertEqual({self.task_id: {'a': 1}, 'b' * 32: {'b': 2}},
+                         dict((task_id, state.as_dict()) for task_id, state in store.iter_states()))
@@ -0,0 +1,30 @@
+import unittest
+from flows.statestore.hashring import HashRing
+
+
+class HashRingTest(unittest.TestCase):
+
+    keys = ['%032x' % i for i in range(2000)]
+
+    def _assign(self, ring):
+        return dict((key, ring.get_name(key)) for key in self.keys)
+
+    def test_keys_are_spread(self):
+        ring = HashRing(dict((name, name) for name in ('a', 'b', 'c', 'd')))
+        counts = {}
+        for name in self._assign(ring).itervalues():
+            counts[name] = counts.get(name, 0) + 1
+        self.assertEqual(4, len(counts))
+        for count in counts.itervalues():
+            self.assertTrue(300 < count < 700, counts)
+
+    def test_adding_a_node_only_moves_its_keys(self):
+        before = self._assign(HashRing({'a': 1, 'b': 2, 'c': 3}))
+        after = self._assign(HashRing({'a': 1, 'b': 2, 'c': 3, 'd': 4}))
+        moved = [key for key in self.keys if before[key] != after[key]]
+        self.assertTrue(all(after[key] == 'd' for key in moved))
+        self.assertTrue(len(moved) < len(self.keys) / 3)
+
+    def test_get_node(self):
+        ring = HashRing({'only': 'node'})
+        self.assertEqual('node', ring.get_node(self.keys[0]))
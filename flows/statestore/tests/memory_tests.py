@@ -0,0 +1,64 @@
+from django.test import TestCase
+from flows import config
+from flows.statestore.base import StateNotFound
+from flows.statestore.memory_store import StateStore
+from flows.statestore.tests.utils import StateStoreTests
+
+
+class MemoryStateStoreTest(StateStoreTests, TestCase):
+
+    def setUp(self):
+        self.store = StateStore()
+
+    def make_store(self):
+        return self.store
+
+    def test_counters(self):
+        self.store.put_state('a' * 32, {'a': 1})
+        self.store.get_state('a' * 32)
+        self.assertRaises(StateNotFound, self.store.get_state, 'b' * 32)
+        stats = self.store.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(1, stats['entries'])
+
+    def test_least_recently_used_is_evicted(self):
+        old_max = config.FLOWS_MEMORY_STATE_STORE_MAX_ENTRIES
+        config.FLOWS_MEMORY_STATE_STORE_MAX_ENTRIES = 2
+        try:
+            self.store.put_state('a' * 32, {'a': 1})
+            self.store.put_state('b' * 32, {'b': 1})
+            self.store.get_state('a' * 32)
+            self.store.put_state('c' * 32, {'c': 1})
+            self.assertRaises(StateNotFound, self.store.get_state, 'b' * 32)
+            self.store.get_state('a' * 32)
+            self.assertEqual(1, self.store.stats()['evictions'])
+        finally:
+            config.FLOWS_MEMORY_STATE_STORE_MAX_ENTRIES = old_max
+
+    def test_byte_budget(self):
+        old_max = config.FLOWS_MEMORY_STATE_STORE_MAX_BYTES
+        config.FLOWS_MEMORY_STATE_STORE_MAX_BYTES = 100
+        try:
+            self.store.put_state('a' * 32, {'a': 'x' * 60})
+            self.store.put_state('b' * 32, {'b': 'x' * 60})
+            self.assertRaises(StateNotFound, self.store.get_state, 'a' * 32)
+            self.assertTrue(self.store.stats()['bytes'] <= 100)
+        finally:
+            config.FLOWS_MEMORY_STATE_STORE_MAX_BYTES = old_max
+
+    def test_idle_state_expires(self):
+        old_timeout = config.FLOWS_TASK_IDLE_TIMEOUT
+        config.FLOWS_TASK_IDLE_TIMEOUT = -1
+        try:
+            self.store.put_state('a' * 32, {'a': 1})
+            self.assertRaises(StateNotFound, self.store.get_state, 'a' * 32)
+            self.assertEqual(1, self.store.stats()['expirations'])
+        finally:
+            config.FLOWS_TASK_IDLE_TIMEOUT = old_timeout
+
+    def test_flow_idle_timeout(self):
+        self.store.put_state('a' * 32, {'_idle_timeout': -1})
+        self.store.put_state('b' * 32, {'b': 1})
+        self.assertRaises(StateNotFound, self.store.get_state, 'a' * 32)
+        self.assertEqual(1, self.store.get_state('b' * 32)['b'])
@@ -0,0 +1,136 @@
+from django.test import TestCase
+from flows import config
+from flows.statestore.base import StateNotFound
+from flows.statestore.tests.utils import StateStoreTests
+import unittest
+
+try:
+    import fakeredis
+    # fakeredis needs lupa to run scripts
+    import lupa #@UnusedImport
+except ImportError:
+    fakeredis = None
+else:
+    from flows.statestore import redis_store, sharded_redis_store
+
+    class _FakeConnection(fakeredis.FakeConnection):
+        # connects to the fake server given in the settings, whatever the
+        # address of the real one
+        def __init__(self, host=None, port=None, **kwargs):
+            super(_FakeConnection, self).__init__(**kwargs)
+
+    class _StateStore(redis_store.StateStore):
+        def __init__(self, server):
+            super(_StateStore, self).__init__()
+            self.server = server
+
+        def _get_settings(self):
+            settings = super(_StateStore, self)._get_settings()
+            settings.update(connection_class=_FakeConnection, server=self.server)
+            return settings
+
+
+@unittest.skipUnless(fakeredis, 'fakeredis and lupa are not installed')
+class RedisStateStoreTest(StateStoreTests, TestCase):
+
+    task_id = 'a' * 32
+    per_key = False
+
+    def setUp(self):
+        self._per_key = config.FLOWS_REDIS_STATE_STORE_PER_KEY
+        config.FLOWS_REDIS_STATE_STORE_PER_KEY = self.per_key
+        self.server = fakeredis.FakeServer()
+        self.store = _StateStore(self.server)
+        self.db = self.store._get_db()
+
+    def tearDown(self):
+        config.FLOWS_REDIS_STATE_STORE_PER_KEY = self._per_key
+
+    def make_store(self):
+        return self.store
+
+    def test_client_is_shared(self):
+        self.assertTrue(self.db is _StateStore(self.server)._get_db())
+        # but not with a forked process
+        redis_store._clients_pid = None
+        self.assertFalse(self.db is self.store._get_db())
+
+    def test_batched_writes_are_sent_at_the_end(self):
+        with self.store.batch():
+            self.store.put_state(self.task_id, {'a': 1})
+            self.store.put_state('b' * 32, {'b': 1})
+            self.assertFalse(self.db.exists(self.task_id))
+            # but are seen by the same request
+            self.assertEqual(1, self.store.get_state('b' * 32)['b'])
+        self.assertEqual(1, self.store.get_state(self.task_id)['a'])
+
+    def test_binder_tasks_only_send_their_writes(self):
+        with self.store.batch():
+            self.store.put_state(self.task_id, {'_id': self.task_id, '_bound_to': 'alice'})
+            self.store.put_state('b' * 32, {'b': 1})
+            self.assertEqual([self.task_id], self.store.get_binder_tasks('alice'))
+            self.assertFalse(self.db.exists('b' * 32))
+        self.assertTrue(self.db.exists('b' * 32))
+
+    def test_failed_batch_is_not_sent(self):
+        try:
+            with self.store.batch():
+                self.store.put_state(self.task_id, {'a': 1})
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertRaises(StateNotFound, self.store.get_state, self.task_id)
+
+    def test_flow_idle_timeout(self):
+        self.store.put_state(self.task_id, {'_idle_timeout': 30})
+        self.assertTrue(0 < self.db.ttl(self.task_id) <= 30)
+        # reading the task restarts its own timeout, not the default one
+        self.store.get_state(self.task_id)
+        self.assertTrue(0 < self.db.ttl(self.task_id) <= 30)
+
+    def test_reads_state_written_with_other_per_key_setting(self):
+        self.store.put_state(self.task_id, {'a': 1})
+        config.FLOWS_REDIS_STATE_STORE_PER_KEY = not self.per_key
+        self.assertEqual(1, self.store.get_state(self.task_id)['a'])
+        self.assertEqual(1, self.store.get_many([self.task_id])[self.task_id]['a'])
+
+    def test_binder_index_is_deleted(self):
+        self.store.put_state(self.task_id, {'_id': self.task_id, '_bound_to': 'alice'})
+        self.assertTrue(self.db.exists('binder:alice'))
+        self.store.delete_for_binder('alice')
+        self.assertFalse(self.db.exists('binder:alice'))
+
+
+class RedisPerKeyStateStoreTest(RedisStateStoreTest):
+
+    per_key = True
+
+    def test_only_changed_keys_are_written(self):
+        self.store.put_state(self.task_id, {'a': 1, 'b': 2})
+        state = self.store.get_state(self.task_id)
+        state['a'] = 3
+        del state['b']
+        self.store.update_state(self.task_id, state)
+        self.assertEqual({'a': self.store._encode_values({'a': 3})['a']}, self.db.hgetall(self.task_id))
+
+
+@unittest.skipUnless(fakeredis, 'fakeredis and lupa are not installed')
+class ShardedRedisStateStoreTest(StateStoreTests, TestCase):
+
+    def setUp(self):
+        self.servers = [fakeredis.FakeServer() for _ in range(2)]
+        self.store = self.make_store()
+
+    def make_store(self):
+        nodes = [{'name': str(i), 'server': server, 'connection_class': _FakeConnection}
+                 for i, server in enumerate(self.servers)]
+        return sharded_redis_store.StateStore(nodes)
+
+    def test_tasks_are_spread(self):
+        task_ids = ['%032x' % i for i in range(20)]
+        self.store.put_many(dict((task_id, {'a': 1}) for task_id in task_ids))
+        dbs = self.store._get_dbs()
+        self.assertEqual(2, len(dbs))
+        for db in dbs:
+            self.assertTrue(0 < len(db.keys('[0-9a-f]' * 32)) < 20)
+        self.assertEqual(set(task_ids), set(task_id for task_id, _ in self.store.iter_states()))
@@ -0,0 +1,90 @@
+from django.test import TestCase
+from flows import config
+from flows.statestore import serialisation
+from flows.statestore.base import StateStoreBase
+from flows.statestore.memory_store import StateStore
+from flows.statestore.references import ModelReference
+from flows.statestore.tests.models import TestModel
+import unittest
+
+
+class ModelReferenceTest(TestCase):
+
+    def setUp(self):
+        self._references = config.FLOWS_STATE_MODEL_REFERENCES
+        config.FLOWS_STATE_MODEL_REFERENCES = True
+        self.apple = TestModel.objects.create(fruit='apple', count=1)
+        self.pear = TestModel.objects.create(fruit='pear', count=2)
+
+    def tearDown(self):
+        config.FLOWS_STATE_MODEL_REFERENCES = self._references
+
+    def _roundtrip(self, codec_name):
+        data = serialisation.encode({'model': self.apple}, serialisation.get_codec(codec_name))
+        found = []
+        value = serialisation.decode(data, found)['model']
+        self.assertTrue(isinstance(value, ModelReference))
+        self.assertEqual(('tests.testmodel', self.apple.pk), (value.label, value.pk))
+        self.assertEqual([value], found)
+
+    def test_pickle_stores_reference(self):
+        self._roundtrip('pickle')
+
+    def test_json_stores_reference(self):
+        self._roundtrip('json')
+
+    @unittest.skipUnless(serialisation.has_msgpack, 'msgpack is not installed')
+    def test_msgpack_stores_reference(self):
+        self._roundtrip('msgpack')
+
+    def test_unsaved_instance_is_pickled(self):
+        data = serialisation.encode({'model': TestModel(fruit='plum', count=3)})
+        self.assertEqual('plum', serialisation.decode(data, [])['model'].fruit)
+
+    def test_references_can_be_disabled(self):
+        config.FLOWS_STATE_MODEL_REFERENCES = False
+        data = serialisation.encode({'model': self.apple})
+        self.assertTrue(isinstance(serialisation.decode(data, [])['model'], TestModel))
+
+    def test_loaded_in_bulk_when_used(self):
+        store = StateStore()
+        store.put_state('a' * 32, {'fruit': [self.apple, self.pear], 'favourite': self.pear, 'a': 1})
+        TestModel.objects.filter(pk=self.apple.pk).update(count=10)
+
+        with self.assertNumQueries(0):
+            state = store.get_state('a' * 32)
+            self.assertEqual(1, state['a'])
+        with self.assertNumQueries(1):
+            fruit = state['fruit']
+            favourite = state['favourite']
+        # the current version is loaded, not the one which was stored
+        self.assertEqual([10, 2], [f.count for f in fruit])
+        self.assertEqual(self.pear, favourite)
+
+    def test_lazily_decoded_keys(self):
+        old_lazy = config.FLOWS_STATE_LAZY_DECODE
+        config.FLOWS_STATE_LAZY_DECODE = True
+        try:
+            store = StateStore()
+            store.put_state('a' * 32, {'apple': self.apple, 'pear': self.pear})
+            state = store.get_state('a' * 32)
+        finally:
+            config.FLOWS_STATE_LAZY_DECODE = old_lazy
+        with self.assertNumQueries(1):
+            self.assertEqual('apple', state['apple'].fruit)
+        with self.assertNumQueries(1):
+            self.assertEqual('pear', state['pear'].fruit)
+
+    def test_deleted_instance_is_none(self):
+        store = StateStore()
+        store.put_state('a' * 32, {'model': self.apple})
+        self.apple.delete()
+        self.assertEqual(None, store.get_state('a' * 32)['model'])
+
+    def test_unused_references_are_not_loaded_to_write(self):
+        store = StateStoreBase()
+        state = store._decode(store._encode({'model': self.apple, 'a': 1}))
+        state['a'] = 2
+        with self.assertNumQueries(0):
+            state = store._decode(store._encode(state))
+        self.assertEqual(self.apple, state['model'])
@@ -0,0 +1,49 @@
+from datetime import datetime, date
+from decimal import Decimal
+from django.test import TestCase
+from django.utils import timezone
+from flows import config
+from flows.statestore import serialisation
+from flows.statestore.base import StateStoreBase
+import base64
+import pickle
+import unittest
+
+
+class SerialisationTest(TestCase):
+
+    state = {'a': 1, 'b': 'cake', 'pies': {'r': 2, 'theta': 20}, 'l': [1, 2, 3]}
+
+    def test_roundtrip_all_codecs(self):
+        for name in ('pickle', 'marshal', 'json'):
+            codec = serialisation.get_codec(name)
+            data = serialisation.encode(self.state, codec)
+            self.assertEqual(self.state, serialisation.decode(data))
+
+    @unittest.skipUnless(serialisation.has_msgpack, 'msgpack is not installed')
+    def test_roundtrip_msgpack(self):
+        codec = serialisation.get_codec('msgpack')
+        data = serialisation.encode(self.state, codec)
+        self.assertEqual(self.state, serialisation.decode(data))
+
+    def test_json_type_hooks(self):
+        state = {'when': timezone.now(),
+                 'naive': datetime(2013, 4, 5, 6, 7, 8),
+                 'day': date(2013, 4, 5),
+                 'price': Decimal('10.50'),
+                 'tags': set(['x', 'y'])}
+        data = serialisation.encode(state, serialisation.get_codec('json'))
+        self.assertEqual(state, serialisation.decode(data))
+
+    def test_compression_threshold(self):
+        state = {'big': 'x' * (config.FLOWS_STATE_COMPRESS_THRESHOLD * 2)}
+        data = serialisation.encode(state)
+        self.assertTrue(len(data) < config.FLOWS_STATE_COMPRESS_THRESHOLD)
+        self.assertEqual(state, serialisation.decode(data))
+
+    def test_legacy_state(self):
+        store = StateStoreBase()
+        legacy = base64.b64encode(pickle.dumps(self.state))
+        self.assertEqual(self.state, store._decode(legacy))
+        self.assertEqual(self.state, store._deserialise(legacy))
+        self.assertEqual(self.state, store._deserialise(store._serialise(self.state)))
@@ -0,0 +1,108 @@
+from django.http import HttpResponse
+from django.core import signing
+from django.test import TestCase
+from django.test.client import RequestFactory
+from flows import config
+from flows.statestore import memory_store, serialisation
+from flows.statestore.base import StateNotFound
+from flows.statestore.signed_store import StateStore
+from flows.statestore.tracking import TrackedState
+import os
+
+
+class _Session(object):
+    def __init__(self, session_key=None):
+        self.session_key = session_key
+
+
+class SignedStateStoreTest(TestCase):
+
+    task_id = 'a' * 32
+
+    def setUp(self):
+        self.fallback = memory_store.StateStore()
+        self.store = StateStore(self.fallback)
+        self.store.process_request(self._make_request())
+
+    def _make_request(self, session_key=None):
+        request = RequestFactory().get('/')
+        request.session = _Session(session_key)
+        return request
+
+    def test_binder_value_is_not_in_reference(self):
+        self.store.process_request(self._make_request('alice-session'))
+        state = {'_id': self.task_id, '_bound_to': 'alice-session', 'a': 1}
+        reference = self.store.get_reference(self.task_id, state)
+        self.assertNotIn('alice-session', signing.b64_decode(reference.split(':')[0].encode('ascii')))
+        loaded = self.store.get_state(reference)
+        self.assertEqual('alice-session', loaded['_bound_to'])
+        self.assertFalse(loaded.is_changed)
+
+        # and it cannot be used by anyone else
+        self.store.process_request(self._make_request('bob-session'))
+        self.assertRaises(StateNotFound, self.store.get_state, reference)
+        self.store.process_request(self._make_request())
+        self.assertRaises(StateNotFound, self.store.get_state, reference)
+
+    def test_state_is_carried_in_reference(self):
+        state = TrackedState({'_id': self.task_id, 'a': 1})
+        self.store.put_state(self.task_id, state)
+        reference = self.store.get_reference(self.task_id, state)
+        self.assertNotEqual(self.task_id, reference)
+        self.assertEqual(1, self.store.get_state(reference)['a'])
+        self.assertEqual(0, self.fallback.stats()['entries'])
+
+    def test_tampered_reference(self):
+        reference = self.store.get_reference(self.task_id, {'_id': self.task_id, 'a': 1})
+        self.assertRaises(StateNotFound, self.store.get_state, reference[:-2] + 'xx')
+
+    def test_expired_reference(self):
+        reference = self.store.get_reference(self.task_id, {'_id': self.task_id, 'a': 1})
+        old_timeout = config.FLOWS_TASK_IDLE_TIMEOUT
+        config.FLOWS_TASK_IDLE_TIMEOUT = -1
+        try:
+            self.assertRaises(StateNotFound, self.store.get_state, reference)
+        finally:
+            config.FLOWS_TASK_IDLE_TIMEOUT = old_timeout
+
+    def test_flow_idle_timeout(self):
+        reference = self.store.get_reference(self.task_id, {'_id': self.task_id, '_idle_timeout': -1})
+        self.assertRaises(StateNotFound, self.store.get_state, reference)
+
+    def test_large_state_falls_back(self):
+        state = {'_id': self.task_id, 'a': os.urandom(config.FLOWS_SIGNED_STATE_STORE_MAX_SIZE)}
+        self.assertEqual(self.task_id, self.store.get_reference(self.task_id, state))
+        self.assertEqual(state, self.store.get_state(self.task_id).as_dict())
+
+        self.store.delete_state(self.task_id)
+        self.assertRaises(StateNotFound, self.fallback.get_state, self.task_id)
+
+    def test_pickled_token_is_refused(self):
+        data = serialisation.encode({'_id': self.task_id, 'a': 1}, serialisation.get_codec('pickle'))
+        reference = self.store._get_signer(None).sign(signing.b64_encode(data))
+        self.assertRaises(StateNotFound, self.store.get_state, reference)
+
+    def test_state_which_json_cannot_encode_falls_back(self):
+        state = {'_id': self.task_id, 'a': object()}
+        self.assertEqual(self.task_id, self.store.get_reference(self.task_id, state))
+        self.assertEqual(1, self.fallback.stats()['entries'])
+
+    def test_state_in_cookie(self):
+        old_cookie = config.FLOWS_SIGNED_STATE_STORE_COOKIE
+        config.FLOWS_SIGNED_STATE_STORE_COOKIE = True
+        try:
+            state = {'_id': self.task_id, 'a': 1}
+            self.store.put_state(self.task_id, state)
+            self.assertEqual(self.task_id, self.store.get_reference(self.task_id, state))
+            response = self.store.process_response(None, HttpResponse())
+            token = response.cookies['flows_' + self.task_id].value
+
+            request = self._make_request()
+            request.COOKIES['flows_' + self.task_id] = token
+            self.store.process_request(request)
+            self.assertEqual(1, self.store.get_state(self.task_id)['a'])
+            self.store.delete_state(self.task_id)
+            response = self.store.process_response(request, HttpResponse())
+            self.assertEqual('', response.cookies['flows_' + self.task_id].value)
+        finally:
+            config.FLOWS_SIGNED_STATE_STORE_COOKIE = old_cookie
@@ -0,0 +1,81 @@
+from django.test import TestCase
+from flows import config
+from flows.statestore.base import StateNotFound
+from flows.statestore.sqlite_store import StateStore
+from flows.statestore.tests.utils import StateStoreTests
+import os
+import shutil
+import tempfile
+import time
+
+
+class SqliteStateStoreTest(StateStoreTests, TestCase):
+
+    task_id = 'a' * 32
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self._path = config.FLOWS_SQLITE_STATE_STORE_PATH
+        config.FLOWS_SQLITE_STATE_STORE_PATH = os.path.join(self.directory, 'state.sqlite3')
+        self.store = StateStore()
+
+    def tearDown(self):
+        config.FLOWS_SQLITE_STATE_STORE_PATH = self._path
+        shutil.rmtree(self.directory)
+
+    def _last_access(self, task_id):
+        return self.store._get_connection().execute('SELECT last_access FROM flows_state WHERE task_id = ?',
+                                                    (task_id,)).fetchone()[0]
+
+    def _age_task(self, task_id, seconds):
+        # moves the expiry time back along with the last access
+        last_access = time.time() - seconds
+        self.store._get_connection().execute('UPDATE flows_state SET expires = expires - last_access + ?, '
+                                             'last_access = ? WHERE task_id = ?',
+                                             (last_access, last_access, task_id))
+        return last_access
+
+    def make_store(self):
+        return self.store
+
+    def test_uses_wal(self):
+        mode = self.store._get_connection().execute('PRAGMA journal_mode').fetchone()[0]
+        self.assertEqual('wal', mode)
+
+    def test_shared_between_connections(self):
+        self.store.put_state(self.task_id, {'a': 1})
+        self.assertEqual(1, StateStore().get_state(self.task_id)['a'])
+        StateStore().delete_state(self.task_id)
+        self.assertRaises(StateNotFound, self.store.get_state, self.task_id)
+
+    def test_stale_access_is_touched(self):
+        self.store.put_state(self.task_id, {'a': 1})
+        last_access = self._age_task(self.task_id, config.FLOWS_SQLITE_STATE_STORE_TOUCH_INTERVAL + 1)
+        self.store.get_state(self.task_id)
+        self.assertTrue(self._last_access(self.task_id) > last_access)
+
+    def test_expired_state(self):
+        self.store.put_state(self.task_id, {'a': 1})
+        self.store.put_state('b' * 32, {'b': 1})
+        self._age_task(self.task_id, config.FLOWS_TASK_IDLE_TIMEOUT + 1)
+        self.assertRaises(StateNotFound, self.store.get_state, self.task_id)
+        self.assertEqual(1, self.store.remove_expired_state())
+        self.assertEqual(1, self.store.get_state('b' * 32)['b'])
+
+    def test_expired_state_is_removed_when_reading(self):
+        self.store.put_state(self.task_id, {'a': 1})
+        self.store.put_state('b' * 32, {'b': 1})
+        self._age_task(self.task_id, config.FLOWS_TASK_IDLE_TIMEOUT + 1)
+        self.store._last_cleanup = time.time() - config.FLOWS_SQLITE_STATE_STORE_CLEANUP_INTERVAL - 1
+        self.store.get_state('b' * 32)
+        count, = self.store._get_connection().execute('SELECT COUNT(*) FROM flows_state').fetchone()
+        self.assertEqual(1, count)
+
+    def test_flow_idle_timeout(self):
+        self.store.put_state(self.task_id, {'_idle_timeout': 30})
+        self.store.put_state('b' * 32, {'b': 1})
+        self._age_task(self.task_id, 31)
+        self._age_task('b' * 32, 31)
+        self.assertRaises(StateNotFound, self.store.get_state, self.task_id)
+        self.assertEqual(1, self.store.get_state('b' * 32)['b'])
+        self.assertEqual(1, self.store.remove_expired_state())
@@ -0,0 +1,82 @@
+from django.test import TestCase
+from flows import config
+from flows.statestore.base import StateNotFound
+from flows.statestore.tmpfile_store import StateStore
+from flows.statestore.tests.utils import StateStoreTests
+import os
+import shutil
+import tempfile
+import time
+
+
+class TmpfileStateStoreTest(StateStoreTests, TestCase):
+
+    task_id = 'a' * 32
+
+    def setUp(self):
+        self._root = config.FLOWS_TMPFILE_STATE_STORE_ROOT
+        config.FLOWS_TMPFILE_STATE_STORE_ROOT = tempfile.mkdtemp()
+        self.store = StateStore()
+
+    def tearDown(self):
+        shutil.rmtree(config.FLOWS_TMPFILE_STATE_STORE_ROOT)
+        config.FLOWS_TMPFILE_STATE_STORE_ROOT = self._root
+
+    def _age_task(self, task_id, seconds, timeout=None):
+        # the modification time of the file is when the task expires
+        if timeout is None:
+            timeout = config.FLOWS_TASK_IDLE_TIMEOUT
+        last_access = time.time() - seconds
+        os.utime(self.store._get_file_name(task_id), (last_access, last_access + timeout))
+        return last_access
+
+    def make_store(self):
+        return self.store
+
+    def test_files_are_sharded(self):
+        self.store.put_state(self.task_id, {'a': 1})
+        fname = self.store._get_file_name(self.task_id)
+        self.assertTrue(os.path.exists(fname))
+        self.assertNotEqual(config.FLOWS_TMPFILE_STATE_STORE_ROOT, os.path.dirname(fname))
+        # no temporary files are left behind
+        self.assertEqual([os.path.basename(fname)], os.listdir(os.path.dirname(fname)))
+
+    def test_expired_counts_are_removed(self):
+        self.assertEqual(1, self.store.count_created('alice', 60))
+        fname = self.store._get_created_file_name('alice', int(time.time() // 60))
+        self.assertTrue(os.path.exists(fname))
+        os.utime(fname, (time.time() - 1, time.time() - 1))
+        self.store.remove_expired_state()
+        self.assertFalse(os.path.exists(fname))
+
+    def test_delete_state(self):
+        self.store.put_state(self.task_id, {'a': 1})
+        self.store.delete_state(self.task_id)
+        self.assertRaises(StateNotFound, self.store.get_state, self.task_id)
+        # deleting again does nothing
+        self.store.delete_state(self.task_id)
+
+    def test_stale_access_is_touched(self):
+        self.store.put_state(self.task_id, {'a': 1})
+        last_access = self._age_task(self.task_id, config.FLOWS_TMPFILE_STATE_STORE_TOUCH_INTERVAL + 1)
+        self.store.get_state(self.task_id)
+        self.assertTrue(os.stat(self.store._get_file_name(self.task_id)).st_mtime >
+                        last_access + config.FLOWS_TASK_IDLE_TIMEOUT)
+
+    def test_expired_state(self):
+        self.store.put_state(self.task_id, {'a': 1})
+        self.store.put_state('b' * 32, {'b': 1})
+        self._age_task(self.task_id, config.FLOWS_TASK_IDLE_TIMEOUT + 1)
+        self.assertRaises(StateNotFound, self.store.get_state, self.task_id)
+        self.assertEqual(1, self.store.remove_expired_state())
+        self.assertFalse(os.path.exists(self.store._get_file_name(self.task_id)))
+        self.assertEqual(1, self.store.get_state('b' * 32)['b'])
+
+    def test_flow_idle_timeout(self):
+        self.store.put_state(self.task_id, {'_idle_timeout': 30})
+        self.store.put_state('b' * 32, {'b': 1})
+        self._age_task(self.task_id, 31, timeout=30)
+        self._age_task('b' * 32, 31)
+        self.assertRaises(StateNotFound, self.store.get_state, self.task_id)
+        self.assertEqual(1, self.store.get_state('b' * 32)['b'])
+        self.assertEqual(1, self.store.remove_expired_state())
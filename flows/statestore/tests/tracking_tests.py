@@ -0,0 +1,106 @@
+from django.test import TestCase
+from flows import config
+from flows.statestore.django_store import StateStore
+from flows.statestore.tracking import TrackedState
+
+
+class TrackedStateTest(TestCase):
+
+    def test_tracks_changes(self):
+        state = TrackedState({'a': 1, 'b': [1, 2], 'c': 'cake'})
+        self.assertEqual(1, state['a'])
+        self.assertEqual('cake', state.get('c'))
+        self.assertFalse(state.is_changed)
+        self.assertEqual(set(), state.exposed_keys)
+
+        state['b'].append(3)
+        self.assertEqual(set(['b']), state.exposed_keys)
+        self.assertFalse(state.is_changed)
+
+        state['d'] = 4
+        del state['a']
+        self.assertTrue(state.is_changed)
+        self.assertEqual(set(['d']), state.changed_keys)
+        self.assertEqual(set(['a']), state.removed_keys)
+
+    def test_peek_does_not_expose(self):
+        state = TrackedState({'b': [1, 2]})
+        self.assertEqual([1, 2], state.peek('b'))
+        self.assertEqual(set(), state.exposed_keys)
+
+
+class UpdateStateTest(TestCase):
+
+    task_id = 'a' * 32
+
+    def setUp(self):
+        self.store = StateStore()
+        self.store.put_state(self.task_id, {'a': 1, 'b': [1, 2]})
+
+    def test_unchanged_state_is_not_written(self):
+        state = self.store.get_state(self.task_id)
+        state.get('a')
+        with self.assertNumQueries(0):
+            self.store.update_state(self.task_id, state)
+
+    def test_exposed_but_unchanged_state_is_not_written(self):
+        state = self.store.get_state(self.task_id)
+        self.assertEqual([1, 2], state['b'])
+        with self.assertNumQueries(0):
+            self.store.update_state(self.task_id, state)
+
+    def test_changed_in_place_is_written(self):
+        state = self.store.get_state(self.task_id)
+        state['b'].append(3)
+        with self.assertNumQueries(1):
+            self.store.update_state(self.task_id, state)
+        self.assertEqual([1, 2, 3], self.store.get_state(self.task_id)['b'])
+
+    def test_changed_key_is_written(self):
+        state = self.store.get_state(self.task_id)
+        state['a'] = 2
+        with self.assertNumQueries(1):
+            self.store.update_state(self.task_id, state)
+        self.assertEqual(2, self.store.get_state(self.task_id)['a'])
+        with self.assertNumQueries(0):
+            self.store.update_state(self.task_id, state)
+
+
+class LazyStateTest(TestCase):
+
+    task_id = 'a' * 32
+
+    def setUp(self):
+        self._lazy = config.FLOWS_STATE_LAZY_DECODE
+        config.FLOWS_STATE_LAZY_DECODE = True
+        self.store = StateStore()
+        self.store.put_state(self.task_id, {'a': 1, 'b': [1, 2], 'c': 'cake'})
+
+    def tearDown(self):
+        config.FLOWS_STATE_LAZY_DECODE = self._lazy
+
+    def test_keys_are_decoded_when_used(self):
+        state = self.store.get_state(self.task_id)
+        self.assertTrue('b' in state)
+        self.assertEqual(3, len(state))
+        self.assertEqual(set(['a', 'b', 'c']), state._undecoded)
+        self.assertEqual('cake', state['c'])
+        self.assertEqual(set(['a', 'b']), state._undecoded)
+        self.assertEqual({'a': 1, 'b': [1, 2], 'c': 'cake'}, state)
+
+    def test_exposed_keys_are_compared_separately(self):
+        state = self.store.get_state(self.task_id)
+        self.assertEqual([1, 2], state['b'])
+        with self.assertNumQueries(0):
+            self.store.update_state(self.task_id, state)
+        state['b'].append(3)
+        with self.assertNumQueries(1):
+            self.store.update_state(self.task_id, state)
+        self.assertEqual({'a': 1, 'b': [1, 2, 3], 'c': 'cake'}, self.store.get_state(self.task_id))
+
+    def test_unused_keys_are_not_encoded_again(self):
+        state = self.store.get_state(self.task_id)
+        state['a'] = 2
+        self.store.update_state(self.task_id, state)
+        self.assertEqual(set(['b', 'c']), state._undecoded)
+        self.assertEqual({'a': 2, 'b': [1, 2], 'c': 'cake'}, self.store.get_state(self.task_id))
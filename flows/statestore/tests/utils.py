@@ -1,35 +1,154 @@
+from flows.statestore.base import StateConflict, StateNotFound
 from flows.statestore.tests.models import TestModel
 
-    
-
-def test_store_state(case, store):
-    
-    test_model = TestModel.objects.create(fruit='apple', count=34)
-    
-    task_id = '10293847565647382910abdcef1029384756'
-    
-    state = {'a': 1,
-             'b': 'cake',
-             'model': test_model,
-             'pies': {'r': 2, 'theta': 20 }
-             }
-    
-    store.put_state(task_id, state)
-    
-    fetched_state = store.get_state(task_id)
-    
-    case.assertTrue('a' in fetched_state)
-    case.assertEqual(1, fetched_state['a'])
-    
-    case.assertTrue('b' in fetched_state)
-    case.assertEqual('cake', fetched_state['b'])
-    
-    case.assertTrue('model' in fetched_state)
-    fetched_model = fetched_state['model']
-    case.assertEqual(test_model.id, fetched_model.id)
-    case.assertEqual(test_model.fruit, fetched_model.fruit)
-    case.assertEqual(test_model.count, fetched_model.count)
-    
-    case.assertTrue('pies' in fetched_state)
-    case.assertEqual({'r': 2, 'theta': 20 }, fetched_state['pies'])
-        
\ No newline at end of file
+
+class StateStoreTests(object):
+    """
+    Tests which every state store must pass. Test cases for each store mix
+    this in and implement `make_store`. Tests of the optional parts of the
+    state store API are skipped for stores which do not support them.
+    """
+
+    def make_store(self):
+        raise NotImplementedError
+
+    def test_store_state(self):
+        store = self.make_store()
+
+        test_model = TestModel.objects.create(fruit='apple', count=34)
+
+        task_id = '10293847565647382910abdcef1029384756'
+
+        state = {'a': 1,
+                 'b': 'cake',
+                 'model': test_model,
+                 'pies': {'r': 2, 'theta': 20 }
+                 }
+
+        store.put_state(task_id, state)
+
+        fetched_state = store.get_state(task_id)
+
+        self.assertTrue('a' in fetched_state)
+        self.assertEqual(1, fetched_state['a'])
+
+        self.assertTrue('b' in fetched_state)
+        self.assertEqual('cake', fetched_state['b'])
+
+        self.assertTrue('model' in fetched_state)
+        fetched_model = fetched_state['model']
+        self.assertEqual(test_model.id, fetched_model.id)
+        self.assertEqual(test_model.fruit, fetched_model.fruit)
+        self.assertEqual(test_model.count, fetched_model.count)
+
+        self.assertTrue('pies' in fetched_state)
+        self.assertEqual({'r': 2, 'theta': 20 }, fetched_state['pies'])
+
+    def test_batch_operations(self):
+        store = self.make_store()
+
+        task_ids = ['%032x' % i for i in range(5)]
+
+        store.put_many(dict((task_id, {'i': i}) for i, task_id in enumerate(task_ids)))
+
+        fetched = store.get_many(task_ids[:3] + ['f' * 32])
+        self.assertEqual(set(task_ids[:3]), set(fetched))
+        for i, task_id in enumerate(task_ids[:3]):
+            self.assertEqual(i, fetched[task_id]['i'])
+
+        store.delete_many(task_ids[3:])
+        self.assertEqual({}, store.get_many(task_ids[3:]))
+
+    def test_iter_states(self):
+        store = self.make_store()
+        if not hasattr(store, 'iter_states'):
+            self.skipTest('the store cannot list its tasks')
+
+        task_ids = ['%032x' % i for i in range(3)]
+        store.put_many(dict((task_id, {'i': i}) for i, task_id in enumerate(task_ids)))
+        # fetch a few at a time, to check that every chunk is read
+        store.chunk_size = 2
+        states = dict(store.iter_states())
+        self.assertEqual(set(task_ids[:3]), set(states))
+        self.assertEqual(2, states[task_ids[2]]['i'])
+
+    def test_conflicting_writes(self):
+        store = self.make_store()
+
+        task_id = 'c' * 32
+        store.put_state(task_id, {'a': 1})
+
+        # two requests load the same version, and the first one writes it
+        first = store.get_state(task_id)
+        second = store.get_state(task_id)
+        first['a'] = 2
+        store.update_state(task_id, first)
+
+        second['a'] = 3
+        self.assertRaises(StateConflict, store.update_state, task_id, second)
+        self.assertEqual(2, store.get_state(task_id)['a'])
+
+        # state loaded after the write can be written, and written again
+        third = store.get_state(task_id)
+        third['a'] = 4
+        store.update_state(task_id, third)
+        third['a'] = 5
+        store.update_state(task_id, third)
+        self.assertEqual(5, store.get_state(task_id)['a'])
+
+        # nor can the state be written once the task is deleted
+        store.delete_state(task_id)
+        third['a'] = 6
+        self.assertRaises(StateConflict, store.update_state, task_id, third)
+
+    def test_leases(self):
+        store = self.make_store()
+        if not store.supports_leases:
+            self.skipTest('the store does not support leases')
+
+        task_id = 'd' * 32
+        self.assertTrue(store.acquire_lease(task_id, 'first', 10))
+        self.assertFalse(store.acquire_lease(task_id, 'second', 10))
+
+        # only the holder can release it
+        store.release_lease(task_id, 'second')
+        self.assertFalse(store.acquire_lease(task_id, 'second', 10))
+
+        self.assertEqual(None, store.get_lease_result(task_id, 'key'))
+        store.set_lease_result(task_id, 'key', '/next/', 10)
+        store.release_lease(task_id, 'first')
+        self.assertEqual('/next/', store.get_lease_result(task_id, 'key'))
+        self.assertEqual(None, store.get_lease_result(task_id, 'other'))
+        self.assertTrue(store.acquire_lease(task_id, 'second', 10))
+
+        # an expired lease can be taken over
+        self.assertTrue(store.acquire_lease('e' * 32, 'first', -1))
+        self.assertTrue(store.acquire_lease('e' * 32, 'second', 10))
+
+    def test_binder_tasks(self):
+        store = self.make_store()
+        if store.get_binder_tasks('alice') is None:
+            self.skipTest('the store does not index tasks by binder value')
+
+        first, second, other = 'f' * 32, '1' * 32, '2' * 32
+        store.put_state(first, {'_id': first, '_bound_to': 'alice'})
+        store.put_state(second, {'_id': second, '_bound_to': 'alice'})
+        store.put_state(other, {'_id': other, '_bound_to': 'bob'})
+        # writing a task again does not make it newer
+        store.put_state(first, {'_id': first, '_bound_to': 'alice', 'a': 1})
+        self.assertEqual([first, second], store.get_binder_tasks('alice'))
+
+        store.delete_state(first)
+        self.assertEqual([second], store.get_binder_tasks('alice'))
+        self.assertEqual([], store.get_binder_tasks('carol'))
+
+        self.assertEqual(1, store.delete_for_binder('alice'))
+        self.assertEqual([], store.get_binder_tasks('alice'))
+        self.assertRaises(StateNotFound, store.get_state, second)
+        self.assertEqual([other], store.get_binder_tasks('bob'))
+
+    def test_count_created(self):
+        store = self.make_store()
+
+        self.assertEqual([1, 2], [store.count_created('alice', 60) for _ in range(2)])
+        self.assertEqual(1, store.count_created('bob', 60))
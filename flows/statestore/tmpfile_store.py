@@ -1,23 +1,312 @@
-from flows.statestore.base import StateStoreBase, StateNotFound
+"""
+Stores the state of each task in its own file. Files are spread over 256
+subdirectories of FLOWS_TMPFILE_STATE_STORE_ROOT, and are written to a
+temporary file which is then renamed, so that readers never see a partly
+written file.
+
+The modification time of each file is set to when the task expires, which
+is in the future while it is in use, so that the idle timeout of the task's
+flow is known without reading the file. Expired files are removed by
+`remove_expired_state`, which the `cleanupflows` management command calls.
+
+Each file starts with the version of the state. Writers which check it
+lock the file first, so that only one of them can replace each version.
+
+The tasks bound to each binder value are listed by empty files named after
+them in a directory for the value, whose modification times are when the
+tasks were created. How many tasks each value created in each period is
+kept in a file which is locked while it is counted, whose modification
+time is when the period ends.
+"""
+from flows import config
+from flows.statestore.base import StateStoreBase, StateNotFound, StateConflict
+import errno
+import fcntl
+import hashlib
 import os
+import struct
+import tempfile
+import time
+
+
+_SUFFIX = '.task'
+_TEMP_PREFIX = 'tmp'
+_BINDERS_DIRECTORY = 'binders'
+_CREATED_DIRECTORY = 'created'
+_CREATED_SUFFIX = '.count'
+
+# files written before state had versions start with the encoded state,
+# whose first byte is never zero
+_VERSION_MARKER = '\x00'
+_VERSION = struct.Struct('>Q')
+_HEADER_SIZE = len(_VERSION_MARKER) + _VERSION.size
+
+
+def _split_version(data):
+    if data[:1] != _VERSION_MARKER:
+        return 0, data
+    return _VERSION.unpack(data[1:_HEADER_SIZE])[0], data[_HEADER_SIZE:]
+
 
 class StateStore(StateStoreBase):
-    
+
     def _get_file_name(self, task_id):
-        return '/tmp/%s.task' % task_id
-    
+        # task IDs are random, but the subdirectory is taken from a hash so
+        # that files are spread evenly whatever the IDs look like
+        shard = hashlib.md5(task_id).hexdigest()[:2]
+        return os.path.join(config.FLOWS_TMPFILE_STATE_STORE_ROOT, shard, task_id + _SUFFIX)
+
+    def _get_binder_directory(self, bound_to):
+        digest = hashlib.sha1(unicode(bound_to).encode('utf-8')).hexdigest()
+        return os.path.join(config.FLOWS_TMPFILE_STATE_STORE_ROOT, _BINDERS_DIRECTORY, digest[:2], digest)
+
+    def _get_created_file_name(self, bound_to, number):
+        digest = hashlib.sha1(unicode(bound_to).encode('utf-8')).hexdigest()
+        return os.path.join(config.FLOWS_TMPFILE_STATE_STORE_ROOT, _CREATED_DIRECTORY, digest[:2],
+                            '%s-%d%s' % (digest, number, _CREATED_SUFFIX))
+
     def get_state(self, task_id):
-        # TODO: use os.tempfile, i didn't have internet access when writing this initially
-        # so i couldn't lookup the API
+        return self._read(task_id, touch=True)
+
+    def _read(self, task_id, touch):
         fname = self._get_file_name(task_id)
-        if not os.path.exists(fname):
-            raise StateNotFound
-        with open(fname) as f:
-            return self._deserialise(f.read())
-        
+        try:
+            f = open(fname, 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                raise StateNotFound
+            raise
+
+        with f:
+            expires = os.fstat(f.fileno()).st_mtime
+            now = time.time()
+            if expires < now:
+                raise StateNotFound
+            version, data = _split_version(f.read())
+        state = self._decode(data)
+        self._saved(state, version)
+
+        timeout = self._get_idle_timeout(state)
+        if touch and expires - timeout < now - config.FLOWS_TMPFILE_STATE_STORE_TOUCH_INTERVAL:
+            try:
+                os.utime(fname, (now, now + timeout))
+            except OSError, e:
+                # it was deleted in the meantime
+                if e.errno != errno.ENOENT:
+                    raise
+
+        return state
+
     def put_state(self, task_id, state):
-        with open(self._get_file_name(task_id), 'w') as f:
-            f.write(self._serialise(state)) 
-        
+        version = self._next_version(state)
+        self._write(self._get_file_name(task_id), state, version)
+        self._index(task_id, state)
+        self._saved(state, version)
+
+    def _index(self, task_id, state):
+        bound_to = self._get_bound_to(state)
+        if bound_to is None:
+            return
+        directory = self._get_binder_directory(bound_to)
+        name = os.path.join(directory, task_id)
+        # the file is only created once, so its time is when the task was
+        # created
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+        try:
+            try:
+                fd = os.open(name, flags)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                self._make_directory(directory)
+                fd = os.open(name, flags)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            return
+        os.close(fd)
+
+    def _put_if_version(self, task_id, state, version):
+        fname = self._get_file_name(task_id)
+        try:
+            f = open(fname, 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                raise StateConflict
+            raise
+
+        with f:
+            # the lock is released when the file is closed, by which time
+            # it has been replaced, so writers waiting for it will see that
+            # the file they locked is no longer the task's
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            locked = os.fstat(f.fileno())
+            try:
+                current = os.stat(fname)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                raise StateConflict
+            if (current.st_ino, current.st_dev) != (locked.st_ino, locked.st_dev) or locked.st_mtime < time.time():
+                raise StateConflict
+            if _split_version(f.read(_HEADER_SIZE))[0] != version:
+                raise StateConflict
+            self._write(fname, state, version + 1)
+        self._saved(state, version + 1)
+
+    def _write(self, fname, state, version):
+        directory = os.path.dirname(fname)
+        try:
+            fd, temp_name = tempfile.mkstemp(prefix=_TEMP_PREFIX, dir=directory)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            self._make_directory(directory)
+            fd, temp_name = tempfile.mkstemp(prefix=_TEMP_PREFIX, dir=directory)
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(_VERSION_MARKER + _VERSION.pack(version))
+                f.write(self._encode(state))
+            now = time.time()
+            os.utime(temp_name, (now, now + self._get_idle_timeout(state)))
+            # renaming is atomic, so the file is either the old state or the new
+            os.rename(temp_name, fname)
+        except:
+            os.remove(temp_name)
+            raise
+
+    def _make_directory(self, directory):
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            # another process may have just created it
+            if e.errno != errno.EEXIST:
+                raise
+
     def delete_state(self, task_id):
-        os.remove(self._get_file_name(task_id))
+        self._remove_file(self._get_file_name(task_id))
+
+    def get_many(self, task_ids):
+        states = {}
+        for task_id in task_ids:
+            try:
+                states[task_id] = self._read(task_id, touch=False)
+            except StateNotFound:
+                pass
+        return states
+
+    def get_binder_tasks(self, bound_to):
+        directory = self._get_binder_directory(bound_to)
+        try:
+            task_ids = os.listdir(directory)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+
+        now = time.time()
+        tasks = []
+        for task_id in task_ids:
+            name = os.path.join(directory, task_id)
+            try:
+                if os.stat(self._get_file_name(task_id)).st_mtime >= now:
+                    tasks.append((os.stat(name).st_mtime, task_id))
+                    continue
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+            # the task has expired or been deleted
+            self._remove_file(name)
+        return [task_id for _, task_id in sorted(tasks)]
+
+    def count_created(self, bound_to, period):
+        number = int(time.time() // period)
+        fname = self._get_created_file_name(bound_to, number)
+        flags = os.O_RDWR | os.O_CREAT
+        try:
+            fd = os.open(fname, flags)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            self._make_directory(os.path.dirname(fname))
+            fd = os.open(fname, flags)
+
+        with os.fdopen(fd, 'r+b') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            count = int(f.read() or 0) + 1
+            f.seek(0)
+            f.write(str(count))
+            f.flush()
+            # so that remove_expired_state removes it once the period is over
+            end = (number + 1) * period
+            os.utime(fname, (end, end))
+        return count
+
+    def _remove_file(self, name):
+        try:
+            os.remove(name)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def iter_states(self):
+        for directory, _, file_names in os.walk(config.FLOWS_TMPFILE_STATE_STORE_ROOT):
+            for file_name in file_names:
+                if not file_name.endswith(_SUFFIX):
+                    continue
+                task_id = file_name[:-len(_SUFFIX)]
+                try:
+                    yield task_id, self._read(task_id, touch=False)
+                except StateNotFound:
+                    # it expired or was deleted in the meantime
+                    pass
+
+    def remove_expired_state(self, progress=None):
+        """
+        Deletes the files of expired tasks, as well as temporary files left
+        behind by interrupted writes. `progress` is called with the number
+        of tasks deleted so far after each directory. Returns how many tasks
+        were deleted.
+        """
+        root = config.FLOWS_TMPFILE_STATE_STORE_ROOT
+        now = time.time()
+        # temporary files have not had their expiry time set yet
+        temp_cutoff = now - config.FLOWS_TASK_IDLE_TIMEOUT
+        count = 0
+        for directory, _, file_names in os.walk(root):
+            for file_name in file_names:
+                is_task = file_name.endswith(_SUFFIX)
+                # like tasks, counts of created tasks expire at their time
+                expires = is_task or file_name.endswith(_CREATED_SUFFIX)
+                if not expires and not file_name.startswith(_TEMP_PREFIX):
+                    continue
+                path = os.path.join(directory, file_name)
+                try:
+                    if os.stat(path).st_mtime < (now if expires else temp_cutoff):
+                        os.remove(path)
+                        count += is_task
+                except OSError, e:
+                    # it was deleted or replaced in the meantime
+                    if e.errno != errno.ENOENT:
+                        raise
+            if progress is not None and file_names:
+                progress(count)
+        self._remove_stale_binder_files()
+        return count
+
+    def _remove_stale_binder_files(self):
+        # the files listing the tasks of each binder value are otherwise
+        # only removed when the tasks of the value are next listed
+        root = os.path.join(config.FLOWS_TMPFILE_STATE_STORE_ROOT, _BINDERS_DIRECTORY)
+        for directory, _, task_ids in os.walk(root, topdown=False):
+            for task_id in task_ids:
+                if not os.path.exists(self._get_file_name(task_id)):
+                    self._remove_file(os.path.join(directory, task_id))
+            if directory != root:
+                try:
+                    os.rmdir(directory)
+                except OSError, e:
+                    # it is still in use
+                    if e.errno not in (errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT):
+                        raise
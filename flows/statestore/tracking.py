@@ -0,0 +1,159 @@
+# -*- coding: UTF-8 -*-
+from collections import MutableMapping
+from datetime import datetime, date, time
+from decimal import Decimal
+from flows.statestore import references, serialisation
+
+
+# values of these types cannot be changed in place, so handing them out
+# does not make the state 'possibly changed'
+_IMMUTABLE_TYPES = (basestring, int, long, float, bool, type(None), tuple,
+                    frozenset, datetime, date, time, Decimal)
+
+
+class TrackedState(MutableMapping):
+    """
+    A dict-like container for task state which keeps track of whether it
+    has been changed since it was loaded, so that unchanged state does not
+    need to be written back to the state store.
+
+    Keys which are set or deleted are recorded directly. Values which could
+    be changed in place, such as lists or model instances, are recorded as
+    'exposed' when they are read; the store then has to compare the encoded
+    state against the `digest` of what was loaded to know if it changed.
+
+    State which was stored with each key encoded separately keeps those
+    `encoded_values`, and only decodes a key when it is first used. Exposed
+    values can then be compared key by key.
+
+    Model instances are decoded as references, which are all loaded at once
+    when the first value containing one is used.
+    """
+
+    # set by the state store while writing, if it already had to encode
+    # the state to find out whether it changed
+    _encoded = None
+
+    # the version of the stored state this was loaded from or last written
+    # as, which stores check to refuse writes based on an older version
+    version = None
+
+    def __init__(self, data=None, digest=None, encoded_values=None, found_references=None):
+        self._data = data if type(data) is dict else dict(data or {})
+        self.digest = digest
+        self.encoded_values = encoded_values
+        self._undecoded = set(encoded_values or ()) - set(self._data)
+        self.changed_keys = set()
+        self.removed_keys = set()
+        self.exposed_keys = set()
+        # model references which have been decoded but not yet loaded, and
+        # the keys whose values contain them
+        self._references = list(found_references or ())
+        self._unresolved = set()
+        if self._references:
+            self._unresolved.update(key for key, value in self._data.iteritems()
+                                    if references.contains_reference(value))
+
+    def _load(self, key, resolve=True):
+        if key in self._undecoded:
+            found = []
+            self._data[key] = serialisation.decode(self.encoded_values[key], found)
+            self._undecoded.discard(key)
+            if found:
+                self._references.extend(found)
+                self._unresolved.add(key)
+        if resolve and key in self._unresolved:
+            self._resolve()
+        return self._data[key]
+
+    def _resolve(self):
+        instances = references.resolve(self._references)
+        for key in self._unresolved:
+            if key in self._data:
+                self._data[key] = references.replace(self._data[key], instances)
+        self._references = []
+        self._unresolved = set()
+
+    def __getitem__(self, key):
+        value = self._load(key)
+        if not isinstance(value, _IMMUTABLE_TYPES):
+            self.exposed_keys.add(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+        self._undecoded.discard(key)
+        self._unresolved.discard(key)
+        self.changed_keys.add(key)
+        self.removed_keys.discard(key)
+
+    def __delitem__(self, key):
+        if key in self._undecoded:
+            self._undecoded.discard(key)
+        else:
+            del self._data[key]
+        self._unresolved.discard(key)
+        self.changed_keys.discard(key)
+        self.removed_keys.add(key)
+
+    def __contains__(self, key):
+        return key in self._data or key in self._undecoded
+
+    def __iter__(self):
+        # reading values while iterating decodes them, so iterate over a copy
+        return iter(list(self._data) + list(self._undecoded))
+
+    def __len__(self):
+        return len(self._data) + len(self._undecoded)
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+    def copy(self):
+        return dict(self.iteritems())
+
+    def peek(self, key, default=None):
+        """
+        Returns the value for `key` without recording it as exposed. This
+        must only be used by code which will not change the value in place.
+        """
+        if key not in self:
+            return default
+        return self._load(key)
+
+    def as_dict(self):
+        """
+        Returns the underlying state as a plain dict, for encoding. Model
+        references which have not been loaded yet are left as they are.
+        """
+        for key in list(self._undecoded):
+            self._load(key, resolve=False)
+        return self._data
+
+    def encoded_value(self, key):
+        """
+        Returns the encoded value of `key` as it was loaded, or None if it
+        may have changed since.
+        """
+        if self.encoded_values is None or key in self.changed_keys or key in self.exposed_keys:
+            return None
+        return self.encoded_values.get(key)
+
+    def mark_saved(self, digest=None, encoded_values=None):
+        """
+        Called once the state has been written, so that only changes made
+        after this point are tracked.
+        """
+        if encoded_values is None and self._undecoded:
+            # keep hold of the keys which have still not been used
+            encoded_values = dict((key, self.encoded_values[key]) for key in self._undecoded)
+        self.digest = digest
+        self.encoded_values = encoded_values
+        self.changed_keys = set()
+        self.removed_keys = set()
+        self.exposed_keys = set()
+        self._encoded = None
+
+    @property
+    def is_changed(self):
+        return bool(self.changed_keys or self.removed_keys)
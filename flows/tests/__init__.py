@@ -1,6 +1,9 @@
 
 from flows.tests.preconditions_tests import *
 from flows.tests.components_tests import *
+from flows.tests.loaders_tests import *
+from flows.tests.handler_tests import *
 from flows.tests.transitions_tests import *
+from flows.tests.client_tests import *
 
 from flows.statestore.tests import *
\ No newline at end of file
@@ -0,0 +1,125 @@
+from django.conf import settings
+from django.test import TestCase
+from django.utils.importlib import import_module
+from flows import config
+from flows.handler import _unsign_new_task
+from flows.statestore.memory_store import StateStore
+from flows.tests.urls import handler, ClientStartAction
+import re
+
+
+class _LeaseRecordingStore(StateStore):
+
+    def __init__(self):
+        super(_LeaseRecordingStore, self).__init__()
+        self.leased = []
+
+    def acquire_lease(self, task_id, token, timeout):
+        self.leased.append(task_id)
+        return super(_LeaseRecordingStore, self).acquire_lease(task_id, token, timeout)
+
+
+class FlowClientTest(TestCase):
+
+    lazy_tasks = False
+
+    def setUp(self):
+        self._settings = (config.FLOWS_TASK_LEASE_TIMEOUT, config.FLOWS_TASK_LEASE_MAX_WAIT,
+                          config.FLOWS_LAZY_TASKS)
+        config.FLOWS_TASK_LEASE_TIMEOUT = 10
+        config.FLOWS_LAZY_TASKS = self.lazy_tasks
+        ClientStartAction.submissions = 0
+        handler.state_store = _LeaseRecordingStore()
+        self._start_session()
+
+    def _start_session(self):
+        # the task binder needs a session key
+        session = import_module(settings.SESSION_ENGINE).SessionStore()
+        session.save()
+        self.session_key = session.session_key
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+
+    def tearDown(self):
+        (config.FLOWS_TASK_LEASE_TIMEOUT, config.FLOWS_TASK_LEASE_MAX_WAIT,
+         config.FLOWS_LAZY_TASKS) = self._settings
+
+    def _get_form(self, url):
+        response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        action = re.search("action='([^']*)'", response.content).group(1)
+        fields = dict(re.findall("name='([^']*)' value='([^']*)'", response.content))
+        return action, fields
+
+    def test_flow_completes(self):
+        action, fields = self._get_form('/flows/client/start/?_on_complete=/done/')
+        end_url = self.client.post(action, fields)['Location']
+        self.assertTrue('/flows/client/end/' in end_url)
+        end_action, end_fields = self._get_form(end_url)
+        self.assertTrue(self.client.post(end_action, end_fields)['Location'].endswith('/done/'))
+        self.assertEqual(0, handler.state_store.stats()['entries'])
+
+    def test_duplicate_submission_reuses_redirect(self):
+        action, fields = self._get_form('/flows/client/start/?_on_complete=/done/')
+        response = self.client.post(action, fields)
+        self.assertEqual(302, response.status_code)
+        duplicate = self.client.post(action, fields)
+        self.assertEqual(response['Location'], duplicate['Location'])
+        self.assertEqual(1, ClientStartAction.submissions)
+
+    def test_submission_waits_for_lease(self):
+        action, fields = self._get_form('/flows/client/start/?_on_complete=/done/')
+        handler.state_store.acquire_lease(fields['_id'], 'other', 10)
+        config.FLOWS_TASK_LEASE_MAX_WAIT = 0.1
+        self.assertEqual(409, self.client.post(action, fields).status_code)
+        self.assertEqual(0, ClientStartAction.submissions)
+
+    def test_other_users_task_is_not_leased(self):
+        action, fields = self._get_form('/flows/client/start/?_on_complete=/done/')
+        handler.state_store.acquire_lease(fields['_id'], 'other', 10)
+        config.FLOWS_TASK_LEASE_MAX_WAIT = 0.1
+        self._start_session()
+        # refused at once, rather than waiting for the lease
+        self.assertEqual(404, self.client.post(action, fields).status_code)
+        # only the lease taken above
+        self.assertEqual([fields['_id']], handler.state_store.leased)
+
+    def test_invalid_task_id_is_not_leased(self):
+        action, fields = self._get_form('/flows/client/start/?_on_complete=/done/')
+        fields['_id'] = 'a' * 1000
+        self.assertEqual(404, self.client.post(action.split('?')[0], fields).status_code)
+        self.assertEqual([], handler.state_store.leased)
+
+
+class LazyFlowClientTest(FlowClientTest):
+
+    lazy_tasks = True
+
+    def test_page_is_in_token_history_once(self):
+        action, fields = self._get_form('/flows/client/start/?_on_complete=/done/')
+        history = _unsign_new_task(fields['_new'], self.session_key)['_history']
+        self.assertEqual(['/flows/client/start/'], [url for _, url, _ in history])
+        # so the first page is not stored when it is shown again
+        action, fields = self._get_form(action)
+        self.assertEqual(0, handler.state_store.stats()['entries'])
+
+    def test_used_token_is_refused(self):
+        action, fields = self._get_form('/flows/client/start/?_on_complete=/done/')
+        self.assertTrue('_new' in fields)
+        end_url = self.client.post(action, fields)['Location']
+        end_action, end_fields = self._get_form(end_url)
+        self.assertTrue(self.client.post(end_action, end_fields)['Location'].endswith('/done/'))
+        # the first page's link would otherwise start the completed task again
+        self.assertEqual(404, self.client.get(action).status_code)
+
+    def test_redirect_to_sibling_carries_task(self):
+        response = self.client.get('/flows/jump/start/?_on_complete=/done/')
+        self.assertEqual(302, response.status_code)
+        self.assertTrue('_new=' in response['Location'])
+        self.assertEqual(200, self.client.get(response['Location']).status_code)
+        self.assertEqual(0, handler.state_store.stats()['entries'])
+
+    def test_link_to_other_flow_carries_task(self):
+        response = self.client.get('/flows/link/start/?_on_complete=/done/')
+        url = re.search("href='([^']*)'", response.content).group(1).replace('&amp;', '&')
+        self.assertTrue('/flows/link/other/page/' in url and '_new=' in url)
+        self.assertEqual(200, self.client.get(url).status_code)
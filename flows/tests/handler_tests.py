@@ -0,0 +1,156 @@
+from django.core import signing
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+from flows import config, handler, signals, statestore
+from flows.components import Scaffold, Action
+from flows.handler import PossibleFlowPosition, TooManyTasks, _sign_new_task, _unsign_new_task, \
+    _count_new_task, _limit_binder_tasks
+from flows.statestore.base import StateNotFound, StateStoreBase
+from flows.statestore import cache_store, serialisation
+from flows.statestore.memory_store import StateStore
+import time
+
+
+class NewTaskAction(Action):
+    url = '^action/$'
+
+
+class NewTaskScaffold(Scaffold):
+    url = '^new/'
+    action_set = [NewTaskAction]
+
+
+class _LaterTime(object):
+
+    def time(self):
+        return time.time() + 3600
+
+
+class NewTaskTest(TestCase):
+
+    def _create_instance(self, store):
+        position = PossibleFlowPosition(None, None, [NewTaskScaffold, NewTaskAction])
+        return position.create_instance({'_id': 'a' * 32, '_bound_to': 'alice', 'a': 1}, store, [], {},
+                                        new_task=True)
+
+    def test_token_roundtrip(self):
+        state = {'_id': 'a' * 32, '_bound_to': 'alice', 'a': 1}
+        token = _sign_new_task(state)
+        self.assertEqual(state, _unsign_new_task(token, 'alice').as_dict())
+        self.assertEqual(None, _unsign_new_task(token[:-3] + 'abc', 'alice'))
+        self.assertEqual(None, _unsign_new_task('nonsense', 'alice'))
+
+    def test_token_is_bound(self):
+        token = _sign_new_task({'_id': 'a' * 32, '_bound_to': 'alice-session', 'a': 1})
+        self.assertNotIn('alice-session', signing.b64_decode(token.split(':')[0].encode('ascii')))
+        self.assertEqual(None, _unsign_new_task(token, 'bob-session'))
+
+    def test_token_is_not_pickled(self):
+        signer = signing.TimestampSigner(salt='%s:alice' % handler._NEW_TASK_SALT)
+        data = serialisation.encode({'_id': 'a' * 32}, serialisation.get_codec('pickle'))
+        token = signer.sign(signing.b64_encode(data))
+        self.assertEqual(None, _unsign_new_task(token, 'alice'))
+
+    def test_token_expires(self):
+        token = _sign_new_task({'_id': 'a' * 32, '_bound_to': 'alice', '_idle_timeout': 60})
+        old_time = handler.time
+        handler.time = _LaterTime()
+        try:
+            self.assertEqual(None, _unsign_new_task(token, 'alice'))
+        finally:
+            handler.time = old_time
+
+    def test_unchanged_task_is_not_stored(self):
+        store = StateStore()
+        instance = self._create_instance(store)
+        self.assertEqual(1, _unsign_new_task(instance.get_new_task_token(), 'alice')['a'])
+        instance._save_state(False)
+        self.assertRaises(StateNotFound, store.get_state, 'a' * 32)
+
+    def test_changed_task_is_stored(self):
+        store = StateStore()
+        instance = self._create_instance(store)
+        instance._state['a'] = 2
+        instance._save_state(False)
+        self.assertEqual(2, store.get_state('a' * 32)['a'])
+        # the task is found by its ID from now on
+        self.assertEqual(None, instance.get_new_task_token())
+        self.assertEqual([('_id', 'a' * 32)], instance.get_task_fields())
+
+    def test_lazy_tasks_need_leases(self):
+        old_lazy = config.FLOWS_LAZY_TASKS
+        config.FLOWS_LAZY_TASKS = True
+        try:
+            self.assertRaises(ImproperlyConfigured, handler.FlowHandler, state_store=cache_store.StateStore())
+            handler.FlowHandler(state_store=StateStore())
+        finally:
+            config.FLOWS_LAZY_TASKS = old_lazy
+
+    def test_token_is_refused_without_leases(self):
+        flow_handler = handler.FlowHandler(state_store=cache_store.StateStore())
+        token = _sign_new_task({'_id': 'a' * 32, '_bound_to': 'alice'})
+        old_lazy = config.FLOWS_LAZY_TASKS
+        config.FLOWS_LAZY_TASKS = True
+        try:
+            self.assertEqual(None, flow_handler._get_new_task('a' * 32, token, 'alice'))
+        finally:
+            config.FLOWS_LAZY_TASKS = old_lazy
+
+
+class BinderLimitsTest(TestCase):
+
+    def setUp(self):
+        self._settings = (config.FLOWS_TASK_CREATION_LIMIT, config.FLOWS_MAX_TASKS_PER_BINDER)
+        self.store = StateStore()
+
+    def tearDown(self):
+        config.FLOWS_TASK_CREATION_LIMIT, config.FLOWS_MAX_TASKS_PER_BINDER = self._settings
+
+    def test_creation_limit(self):
+        config.FLOWS_TASK_CREATION_LIMIT = 2
+        _count_new_task(self.store, 'alice')
+        _count_new_task(self.store, 'alice')
+        self.assertRaises(TooManyTasks, _count_new_task, self.store, 'alice')
+        _count_new_task(self.store, 'bob')
+
+    def test_oldest_tasks_are_removed(self):
+        config.FLOWS_MAX_TASKS_PER_BINDER = 2
+        task_ids = ['a' * 32, 'b' * 32, 'c' * 32]
+        for task_id in task_ids:
+            self.store.put_state(task_id, {'_id': task_id, '_bound_to': 'alice'})
+            _limit_binder_tasks(self.store, 'alice', task_id)
+        self.store.put_state('d' * 32, {'_id': 'd' * 32, '_bound_to': 'bob'})
+        self.assertRaises(StateNotFound, self.store.get_state, 'a' * 32)
+        self.assertEqual(task_ids[1:], self.store.get_binder_tasks('alice'))
+
+    def test_limits_need_store_support(self):
+        store = StateStoreBase()
+        config.FLOWS_TASK_CREATION_LIMIT = 2
+        self.assertRaises(ImproperlyConfigured, _count_new_task, store, 'alice')
+        config.FLOWS_MAX_TASKS_PER_BINDER = 2
+        self.assertRaises(ImproperlyConfigured, _limit_binder_tasks, store, 'alice', 'a' * 32)
+
+
+class _Session(object):
+    session_key = 'alice'
+
+
+class _Request(object):
+    session = _Session()
+
+
+class DeleteBinderTasksTest(TestCase):
+
+    def setUp(self):
+        self._state_store = statestore.state_store
+        self.store = statestore.state_store = StateStore()
+
+    def tearDown(self):
+        statestore.state_store = self._state_store
+
+    def test_tasks_are_deleted(self):
+        self.store.put_state('a' * 32, {'_id': 'a' * 32, '_bound_to': 'alice'})
+        self.store.put_state('b' * 32, {'_id': 'b' * 32, '_bound_to': 'bob'})
+        signals.delete_binder_tasks(None, request=_Request())
+        self.assertRaises(StateNotFound, self.store.get_state, 'a' * 32)
+        self.assertEqual(['b' * 32], self.store.get_binder_tasks('bob'))
@@ -0,0 +1,60 @@
+from django.test import TestCase
+from flows.components import Scaffold, Action
+from flows.handler import PossibleFlowPosition
+from flows.loaders import ModelLoader, RequestLoader, get_request_loader
+from flows.statestore.memory_store import StateStore
+from flows.statestore.tests.models import TestModel
+from flows.tests.utils import MockFlow
+
+
+class LoaderAction(Action):
+    url = '^action/$'
+    loaders = {'fruit': ModelLoader(TestModel, state_key='fruit_id')}
+
+
+class LoaderScaffold(Scaffold):
+    url = '^loaders/(?P<fruit_id>\d+)/'
+    action_set = [LoaderAction]
+    loaders = {'fruit': ModelLoader(TestModel, url_kwarg='fruit_id'),
+               'by_name': ModelLoader(TestModel, field='fruit', key=lambda component: 'pear')}
+
+
+class ModelLoaderTest(TestCase):
+
+    def setUp(self):
+        self.apple = TestModel.objects.create(fruit='apple', count=1)
+        self.pear = TestModel.objects.create(fruit='pear', count=2)
+
+    def test_key_from_state_or_url(self):
+        flow = MockFlow()
+        flow.state = {'fruit_id': self.apple.pk}
+        flow.kwargs = {'fruit_id': str(self.pear.pk)}
+        self.assertEqual(self.apple.pk, ModelLoader(TestModel, state_key='fruit_id').get_key(flow))
+        self.assertEqual(self.pear.pk, ModelLoader(TestModel, url_kwarg='fruit_id').get_key(flow))
+        flow.kwargs = {'fruit_id': 'x'}
+        self.assertEqual(None, ModelLoader(TestModel, url_kwarg='fruit_id').get_key(flow))
+
+    def test_loaders_share_queries_and_cache(self):
+        request_loader = RequestLoader()
+        first, second = ModelLoader(TestModel, state_key='a'), ModelLoader(TestModel, url_kwarg='b')
+        with self.assertNumQueries(1):
+            objects = request_loader.load_many([(first, self.apple.pk), (second, self.pear.pk),
+                                                (first, 0), (second, None)])
+        self.assertEqual([self.apple, self.pear, None, None], objects)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.pear, request_loader.load(first, self.pear.pk))
+
+    def test_components_are_loaded_before_prepare(self):
+        position = PossibleFlowPosition(None, None, [LoaderScaffold, LoaderAction])
+        state = {'_id': 'a' * 32, 'fruit_id': self.pear.pk}
+        instance = position.create_instance(state, StateStore(), [], {'fruit_id': str(self.apple.pk)})
+        request = MockFlow()
+        with self.assertNumQueries(2):
+            instance._run_loaders(request)
+        scaffold, action = instance._flow_components
+        self.assertEqual(self.apple, scaffold.fruit)
+        self.assertEqual(self.pear, scaffold.by_name)
+        self.assertEqual(self.pear, action.fruit)
+        # the objects are kept for the rest of the request
+        with self.assertNumQueries(0):
+            self.assertEqual(self.apple, get_request_loader(request).load(action.loaders['fruit'], self.apple.pk))
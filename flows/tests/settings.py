@@ -11,6 +11,12 @@ INSTALLED_APPS = ['flows', 'flows.statestore.tests']
 
 SECRET_KEY = 'flow_tests'
 
+# the client tests use the flows in flows.tests.urls, whose tasks are bound
+# to the session
+SESSION_ENGINE = 'django.contrib.sessions.backends.cache'
+MIDDLEWARE_CLASSES = ('django.contrib.sessions.middleware.SessionMiddleware',)
+ROOT_URLCONF = 'flows.tests.urls'
+
 TEST_RUNNER = 'django.test.simple.DjangoTestSuiteRunner'
 
 _optional = ['django_jenkins', 'south']
@@ -0,0 +1,86 @@
+from django.conf.urls import patterns, include, url
+from django.template import Template
+from flows.components import Scaffold, Action, COMPLETE
+from flows.handler import FlowHandler
+from flows.statestore.memory_store import StateStore
+
+
+class ClientAction(Action):
+    template = Template('{{ flow.render_form_header }}</form>')
+
+    def get_template_names(self):
+        # the page is rendered lazily, after the request has been handled
+        return self.template
+
+
+class ClientStartAction(ClientAction):
+    url = '^start/$'
+    submissions = 0
+
+    def form_valid(self, form):
+        ClientStartAction.submissions += 1
+        return ClientEndAction
+
+
+class ClientEndAction(ClientAction):
+    url = '^end/$'
+
+    def form_valid(self, form):
+        return COMPLETE
+
+
+class ClientFlow(Scaffold):
+    url = '^client/'
+    action_set = [ClientStartAction, ClientEndAction]
+
+
+class JumpStartAction(ClientAction):
+    url = '^start/$'
+
+    def prepare(self, request, *args, **kwargs):
+        # sends the user on before the task has been stored
+        if request.method == 'GET':
+            return JumpTargetAction
+
+
+class JumpTargetAction(ClientAction):
+    url = '^target/$'
+
+
+class JumpFlow(Scaffold):
+    url = '^jump/'
+    action_set = [JumpStartAction, JumpTargetAction]
+
+
+class OtherAction(ClientAction):
+    url = '^page/$'
+
+
+class OtherFlow(Scaffold):
+    url = '^other/'
+    action_set = [OtherAction]
+
+
+class LinkStartAction(ClientAction):
+    url = '^start/$'
+    template = Template("<a href='{{ other_url }}'>other</a>")
+
+    def get_context_data(self, **kwargs):
+        ctx = super(LinkStartAction, self).get_context_data(**kwargs)
+        ctx['other_url'] = self.link_to(OtherFlow)
+        return ctx
+
+
+class LinkFlow(Scaffold):
+    url = '^link/'
+    action_set = [LinkStartAction, OtherFlow]
+
+
+handler = FlowHandler(state_store=StateStore())
+handler.register_entry_point(ClientFlow)
+handler.register_entry_point(JumpFlow)
+handler.register_entry_point(LinkFlow)
+
+urlpatterns = patterns('',
+    url(r'^flows/', include(handler.urls)),
+)